@@ -0,0 +1,531 @@
+"""离线性能测试：本地模拟IMAP服务器、EWS和Webhook，测量检查和投递整条链路的性能
+
+不需要网络和真实邮箱，例如：
+    python benchmark.py --scenario fleet
+    python benchmark.py --accounts 100 --mails 20 --attachment 1048576 --imap-latency 20
+    python benchmark.py --scenario flaky-webhook --json
+
+模拟的IMAP服务器和Webhook接收端运行在子进程中，报告的峰值内存只包含转发服务本身。
+"""
+import argparse
+import email.utils
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from datetime import timezone
+from email.message import EmailMessage
+from email.policy import SMTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+# 预置场景，命令行参数会覆盖其中的值
+SCENARIOS = {
+    'fleet': {'accounts': 1000, 'mails': 50},
+    'attachments': {'accounts': 10, 'mails': 5, 'attachment': 20 * 1024 * 1024},
+    'outlook': {'accounts': 0, 'ews_accounts': 200, 'mails': 20},
+    'flaky-webhook': {'accounts': 50, 'mails': 20, 'webhook_5xx': 0.05, 'webhook_429': 0.05},
+    'slow-imap': {'accounts': 100, 'mails': 10, 'imap_latency': 50},
+}
+DEFAULTS = {
+    'accounts': 20, 'ews_accounts': 0, 'mails': 10, 'body_size': 2048, 'attachment': 0, 'html': False,
+    'imap_latency': 0, 'ews_latency': 0, 'webhook_latency': 0, 'webhook_5xx': 0.0, 'webhook_429': 0.0,
+    'sweeps': 1, 'concurrency': 16,
+}
+
+# ---------- 模拟邮件 ----------
+
+def bodystructure(part):
+    """生成BODYSTRUCTURE响应，只包含main.find_text_part用到的字段"""
+    if part.is_multipart():
+        children = ''.join(bodystructure(child) for child in part.get_payload())
+        return f'({children} "{part.get_content_subtype().upper()}")'
+    payload = part.get_payload(decode=False)
+    size = len(payload.encode() if isinstance(payload, str) else payload)
+    charset = part.get_content_charset()
+    params = f'("CHARSET" "{charset}")' if charset else 'NIL'
+    encoding = (part.get('Content-Transfer-Encoding') or '7bit').upper()
+    result = (
+        f'("{part.get_content_maintype().upper()}" "{part.get_content_subtype().upper()}" '
+        f'{params} NIL NIL "{encoding}" {size}'
+    )
+    if part.get_content_maintype() == 'text':
+        result += f' {payload.count(chr(10))}'
+    return result + ')'
+
+def leaf_sections(part, prefix=''):
+    """返回 {段号: 编码后的原始内容}"""
+    if not part.is_multipart():
+        raw = part.as_bytes(policy=SMTP)
+        return {prefix or '1': raw.split(b'\r\n\r\n', 1)[1]}
+    sections = {}
+    for i, child in enumerate(part.get_payload(), 1):
+        sections.update(leaf_sections(child, f"{prefix}.{i}" if prefix else str(i)))
+    return sections
+
+class MailTemplate:
+    """所有邮件共用同一个正文和附件，只有邮件头不同，避免大邮箱占用大量内存"""
+    def __init__(self, body_size, attachment_size, html):
+        message = EmailMessage()
+        words = "邮件转发性能测试 benchmark payload "
+        message.set_content((words * (body_size // len(words.encode()) + 1))[:body_size])
+        if html:
+            message.add_alternative(f"<html><body><p>{'性能测试 ' * (body_size // 16)}</p></body></html>", subtype='html')
+        if attachment_size:
+            message.add_attachment(
+                random.Random(0).randbytes(attachment_size),
+                maintype='application', subtype='octet-stream', filename='attachment.bin'
+            )
+        raw = message.as_bytes(policy=SMTP)
+        self.mime_headers, self.body = raw.split(b'\r\n\r\n', 1)
+        self.bodystructure = bodystructure(message)
+        self.sections = leaf_sections(message)
+        self.date = email.utils.formatdate(localtime=True)
+
+    def headers(self, uid):
+        return {
+            'Date': self.date,
+            'From': f'Sender {uid % 97} <sender{uid % 97}@example.com>',
+            'Subject': f'性能测试邮件 #{uid}',
+            'Message-ID': f'<{uid}.{time.time_ns()}@bench.local>',
+        }
+
+# ---------- 模拟IMAP服务器 ----------
+
+def parse_set(spec, max_value):
+    values = set()
+    for part in spec.split(','):
+        if ':' in part:
+            low, high = (max_value if x == '*' else int(x) for x in part.split(':'))
+            values.update(range(min(low, high), max(low, high) + 1))
+        else:
+            values.add(max_value if part == '*' else int(part))
+    return values
+
+class Mailbox:
+    def __init__(self, template, count):
+        self.template = template
+        self.count = count  # UID为1..count
+        self.seen = set()
+        self.headers = {}
+
+    def header(self, uid):
+        if uid not in self.headers:
+            self.headers[uid] = self.template.headers(uid)
+        return self.headers[uid]
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    """实现main.py用到的IMAP命令：LOGIN、ID、SELECT、NOOP、UID SEARCH/FETCH/STORE、IDLE、LOGOUT"""
+    FETCH_ITEM = re.compile(r'BODY(?:\.PEEK)?\[[^\]]*\](?:<[\d.]+>)?|\S+', re.I)
+
+    def setup(self):
+        super().setup()
+        # 响应逐行写出，关闭Nagle算法，否则会和客户端的延迟确认叠加出40ms的停顿
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.wfile.write(data)
+        with self.server.stats['imap_bytes'].get_lock():
+            self.server.stats['imap_bytes'].value += len(data)
+
+    def line(self, text):
+        self.write(text + '\r\n')
+
+    def handle(self):
+        mailbox = None
+        self.line('* OK benchmark IMAP ready')
+        while True:
+            raw = self.rfile.readline()
+            if not raw:
+                return
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            with self.server.stats['imap_commands'].get_lock():
+                self.server.stats['imap_commands'].value += 1
+            tag, _, rest = raw.decode().rstrip('\r\n').partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            use_uid = command == 'UID'
+            if use_uid:
+                command, _, args = args.partition(' ')
+                command = command.upper()
+
+            if command == 'CAPABILITY':
+                self.line('* CAPABILITY IMAP4rev1 IDLE ID')
+            elif command == 'LOGIN':
+                user = args.split(' ')[0].strip('"')
+                mailbox = self.server.mailbox(user)
+            elif command == 'ID':
+                self.line('* ID NIL')
+            elif command in ('SELECT', 'EXAMINE'):
+                self.line(f'* {mailbox.count} EXISTS')
+                self.line('* OK [UIDVALIDITY 1] UIDs valid')
+                self.line(f'* OK [UIDNEXT {mailbox.count + 1}] next')
+            elif command == 'SEARCH':
+                self.line(' '.join(['* SEARCH'] + [str(uid) for uid in self.search(mailbox, args)]))
+            elif command == 'FETCH':
+                message_set, _, items = args.partition(' ')
+                for uid in sorted(parse_set(message_set, mailbox.count)):
+                    if 1 <= uid <= mailbox.count:
+                        self.fetch(mailbox, uid, items)
+            elif command == 'STORE':
+                message_set = args.split(' ')[0]
+                mailbox.seen.update(parse_set(message_set, mailbox.count))
+            elif command == 'IDLE':
+                self.line('+ idling')
+                self.rfile.readline()
+            elif command == 'LOGOUT':
+                self.line('* BYE')
+                self.line(f'{tag} OK LOGOUT completed')
+                return
+            elif command not in ('NOOP', 'CLOSE'):
+                self.line(f'{tag} BAD unknown command')
+                continue
+            self.line(f'{tag} OK {command} completed')
+
+    def search(self, mailbox, args):
+        uids = range(1, mailbox.count + 1)
+        match = re.search(r'UID (\S+)', args)
+        if match:
+            wanted = parse_set(match.group(1), mailbox.count)
+            uids = [uid for uid in uids if uid in wanted]
+        if 'UNSEEN' in args.upper():
+            uids = [uid for uid in uids if uid not in mailbox.seen]
+        return uids
+
+    def fetch(self, mailbox, uid, items):
+        template = mailbox.template
+        atoms = [f'UID {uid}']
+        literals = []
+        for item in self.FETCH_ITEM.findall(items.strip('()')):
+            upper = item.upper()
+            if upper == 'UID':
+                continue
+            if upper == 'FLAGS':
+                atoms.append('FLAGS (\\Seen)' if uid in mailbox.seen else 'FLAGS ()')
+            elif upper == 'BODYSTRUCTURE':
+                atoms.append('BODYSTRUCTURE ' + template.bodystructure)
+            elif upper in ('RFC822', 'BODY[]', 'BODY.PEEK[]', 'RFC822.SIZE'):
+                header = ''.join(f'{k}: {v}\r\n' for k, v in mailbox.header(uid).items()).encode()
+                raw = header + template.mime_headers + b'\r\n\r\n' + template.body
+                if upper == 'RFC822.SIZE':
+                    atoms.append(f'RFC822.SIZE {len(raw)}')
+                else:
+                    literals.append(('BODY[]', raw))
+            elif upper.startswith('BODY'):
+                match = re.match(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', item, re.I)
+                section, offset, length = match.groups()
+                if section.upper().startswith('HEADER.FIELDS'):
+                    names = {name.lower() for name in re.search(r'\((.*)\)', section).group(1).split()}
+                    data = ''.join(
+                        f'{k}: {v}\r\n' for k, v in mailbox.header(uid).items() if k.lower() in names
+                    ).encode() + b'\r\n'
+                else:
+                    data = template.sections.get(section, b'')
+                name = f'BODY[{section}]'
+                if offset is not None:
+                    data = data[int(offset):int(offset) + int(length)]
+                    name += f'<{offset}>'
+                literals.append((name, data))
+        response = f'* {uid} FETCH (' + ' '.join(atoms)
+        if not literals:
+            self.line(response + ')')
+            return
+        buffer = [response.encode()]
+        for name, data in literals:
+            buffer.append(f' {name} {{{len(data)}}}\r\n'.encode())
+            buffer.append(data)
+        buffer.append(b')\r\n')
+        self.write(b''.join(buffer))
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, options, stats):
+        super().__init__(('127.0.0.1', 0), FakeIMAPHandler)
+        self.template = MailTemplate(options['body_size'], options['attachment'], options['html'])
+        self.count = options['mails']
+        self.latency = options['imap_latency'] / 1000
+        self.stats = stats
+        self.mailboxes = {}
+        self.lock = threading.Lock()
+
+    def mailbox(self, user):
+        with self.lock:
+            if user not in self.mailboxes:
+                self.mailboxes[user] = Mailbox(self.template, self.count)
+            return self.mailboxes[user]
+
+# ---------- 模拟Webhook ----------
+
+class WebhookSinkHandler(BaseHTTPRequestHandler):
+    """按比例返回429/5xx，其余返回企业微信格式的成功响应"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        stats, options = self.server.stats, self.server.options
+        if options['webhook_latency']:
+            time.sleep(options['webhook_latency'] / 1000)
+        roll = random.random()
+        if roll < options['webhook_429']:
+            status, reply = 429, b'{"errcode":45009,"errmsg":"api freq out of limit"}'
+        elif roll < options['webhook_429'] + options['webhook_5xx']:
+            status, reply = 503, b'service unavailable'
+        else:
+            status, reply = 200, b'{"errcode":0,"errmsg":"ok"}'
+        with stats['webhook_requests'].get_lock():
+            stats['webhook_requests'].value += 1
+            stats['webhook_bytes'].value += len(body)
+            if status != 200:
+                stats['webhook_errors'].value += 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+def serve(options, stats, ports):
+    """子进程：启动模拟IMAP服务器和Webhook接收端"""
+    imap_server = FakeIMAPServer(options, stats)
+    sink = ThreadingHTTPServer(('127.0.0.1', 0), WebhookSinkHandler)
+    sink.daemon_threads = True
+    sink.stats, sink.options = stats, options
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    ports.put((imap_server.server_address[1], sink.server_address[1]))
+    imap_server.serve_forever()
+
+# ---------- 模拟EWS ----------
+
+def install_fake_ews(main, options, stats):
+    """用内存中的收件箱替换exchangelib的Account，按EWS请求次数注入延迟"""
+    latency = options['ews_latency'] / 1000
+    body = ("Outlook性能测试正文 " * (options['body_size'] // 24 + 1))[:options['body_size']]
+
+    lock = threading.Lock()
+
+    def request():
+        with lock:
+            stats['ews_requests'] += 1
+        if latency:
+            time.sleep(latency)
+
+    class FakeQuery(list):
+        page_size = None
+
+    class FakeInbox:
+        def __init__(self, address):
+            self.address = address
+            self.item_sync_state = None
+            self.messages = [
+                SimpleNamespace(
+                    id=f'{address}-{i}', changekey='ck', subject=f'Outlook性能测试邮件 #{i}',
+                    sender=f'sender{i % 97}@example.com', text_body=body,
+                    datetime_received=main.datetime.now(timezone.utc)
+                )
+                for i in range(options['mails'])
+            ]
+
+        def filter(self, **kwargs):
+            return self
+
+        def only(self, *fields):
+            request()
+            return FakeQuery(self.messages)
+
+        def sync_items(self, sync_state=None, only_fields=None, **kwargs):
+            request()
+            if sync_state is None:
+                self.item_sync_state = 'synced'
+            return iter(())
+
+    class FakeAccount(main.Account):
+        def __init__(self, primary_smtp_address=None, **kwargs):
+            self.inbox = FakeInbox(primary_smtp_address)
+            self.version = SimpleNamespace(build=main.EXCHANGE_2013)
+
+        def bulk_update(self, items, chunk_size=None, **kwargs):
+            items = list(items)
+            for _ in range(0, len(items), chunk_size or len(items) or 1):
+                request()
+            return [(item.id, item.changekey) for item, _ in items]
+
+    main.Account = FakeAccount
+
+# ---------- 运行 ----------
+
+def write_providers(path, options, imap_port):
+    lines = [
+        '[providers.bench]',
+        'host = "127.0.0.1"',
+        f'port = {imap_port}',
+        'ssl = false',
+        'label = "Bench"',
+        'window_minutes = 1440',
+        f'concurrency = {options["concurrency"]}',
+        '',
+        '[providers.bench-ews]',
+        'host = "ews.bench.local"',
+        'protocol = "ews"',
+        'label = "BenchEWS"',
+        f'concurrency = {options["concurrency"]}',
+        '',
+    ]
+    for provider, count in (('bench', options['accounts']), ('bench-ews', options['ews_accounts'])):
+        for i in range(count):
+            lines += ['[[accounts]]', f'provider = "{provider}"', f'email = "user{i}@{provider}.local"',
+                      'password = "password"', '']
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+
+def run(options):
+    stats = {
+        'imap_bytes': multiprocessing.Value('q', 0),
+        'imap_commands': multiprocessing.Value('q', 0),
+        'webhook_requests': multiprocessing.Value('q', 0),
+        'webhook_bytes': multiprocessing.Value('q', 0),
+        'webhook_errors': multiprocessing.Value('q', 0),
+    }
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(options, stats, ports), daemon=True)
+    server.start()
+    imap_port, sink_port = ports.get(timeout=60)
+
+    workdir = tempfile.mkdtemp(prefix='mail-bench-')
+    providers_path = os.path.join(workdir, 'providers.toml')
+    write_providers(providers_path, options, imap_port)
+    # 环境变量中已有的设置（如FETCH_MODE、WEBHOOK_WORKERS）优先
+    os.environ['PROVIDERS_CONFIG'] = providers_path
+    os.environ['STATE_DB'] = os.path.join(workdir, 'state.db')
+    os.environ['WEIXIN_WEBHOOK'] = f'http://127.0.0.1:{sink_port}/cgi-bin/webhook/send?key=bench'
+    for name in ('GMAIL_EMAILS', 'QQ_EMAILS', 'OUTLOOK_EMAILS', 'WECOM_WEBHOOKS', 'DINGTALK_WEBHOOKS',
+                 'FEISHU_WEBHOOKS', 'PUSHME_KEYS'):
+        os.environ.pop(name, None)
+    os.environ.setdefault('WEBHOOK_RATE_LIMIT', '1000000')  # 默认不限流，测原始吞吐
+    os.environ.setdefault('WEBHOOK_RETRY_DELAY', '0.05')
+    os.environ.setdefault('MAX_WORKERS', str(max(options['concurrency'], 16)))
+
+    import asyncio
+    import logging
+    logging.disable(logging.WARNING)
+    import main
+    ews_stats = {'ews_requests': 0}
+    install_fake_ews(main, options, ews_stats)
+
+    async def sweeps():
+        results = []
+        for _ in range(options['sweeps']):
+            start = time.monotonic()
+            checked = await main.run_sweep()
+            sweep_time = time.monotonic() - start
+            await asyncio.get_running_loop().run_in_executor(None, main.webhook_sender.drain, 3600)
+            results.append({
+                'sweep_seconds': round(sweep_time, 3),
+                'delivered_seconds': round(time.monotonic() - start, 3),
+                'failed_accounts': sum(1 for result in checked if result['status'] != '成功'),
+            })
+        return results
+
+    start = time.monotonic()
+    sweep_results = asyncio.run(sweeps())
+    total = time.monotonic() - start
+    delivery = main.service_status['delivery']
+    expected = (options['accounts'] + options['ews_accounts']) * options['mails']
+    report = {
+        'options': options,
+        'sweeps': sweep_results,
+        'mails_expected': expected,
+        'mails_delivered': delivery['sent'],
+        'mails_per_second': round(delivery['sent'] / sweep_results[0]['delivered_seconds'], 1)
+        if sweep_results[0]['delivered_seconds'] else 0,
+        'total_seconds': round(total, 3),
+        'imap_commands': stats['imap_commands'].value,
+        'imap_bytes': stats['imap_bytes'].value,
+        'ews_requests': ews_stats['ews_requests'],
+        'webhook_requests': stats['webhook_requests'].value,
+        'webhook_bytes': stats['webhook_bytes'].value,
+        'webhook_errors': stats['webhook_errors'].value,
+        'delivery': {key: value for key, value in delivery.items() if key != 'outbox'},
+        'imap_connections': dict(main.service_status['imap_connections']),
+        # Linux上ru_maxrss的单位是KB
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    main.imap_pool.close_all()
+    server.terminate()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+def print_report(report):
+    options = report['options']
+    mb = 1024 * 1024
+    print(f"场景: {options['scenario'] or '自定义'}  IMAP账号: {options['accounts']}  EWS账号: {options['ews_accounts']}  "
+          f"每个账号{options['mails']}封  附件: {options['attachment']}字节  "
+          f"下载方式: {os.getenv('FETCH_MODE', 'partial')}")
+    for i, sweep in enumerate(report['sweeps'], 1):
+        print(f"第{i}轮: 检查耗时 {sweep['sweep_seconds']}s  全部送达 {sweep['delivered_seconds']}s  "
+              f"失败账号 {sweep['failed_accounts']}")
+    print(f"送达邮件: {report['mails_delivered']}/{report['mails_expected']}  "
+          f"吞吐: {report['mails_per_second']} 封/秒")
+    print(f"IMAP: {report['imap_commands']} 条命令, 下载 {report['imap_bytes'] / mb:.2f} MB  "
+          f"EWS: {report['ews_requests']} 次请求")
+    print(f"Webhook: {report['webhook_requests']} 次请求, 上传 {report['webhook_bytes'] / mb:.2f} MB, "
+          f"注入错误 {report['webhook_errors']}")
+    print(f"投递统计: {report['delivery']}")
+    print(f"峰值内存: {report['peak_rss_mb']} MB")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="邮件转发离线性能测试")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), help="预置场景")
+    parser.add_argument('--accounts', type=int, help="IMAP账号数")
+    parser.add_argument('--ews-accounts', type=int, help="Outlook(EWS)账号数")
+    parser.add_argument('--mails', type=int, help="每个账号的新邮件数")
+    parser.add_argument('--body-size', type=int, help="正文字节数")
+    parser.add_argument('--attachment', type=int, help="每封邮件的附件字节数，0为无附件")
+    parser.add_argument('--html', action='store_true', default=None, help="正文附带HTML版本")
+    parser.add_argument('--imap-latency', type=float, help="IMAP每条命令的延迟（毫秒）")
+    parser.add_argument('--ews-latency', type=float, help="EWS每次请求的延迟（毫秒）")
+    parser.add_argument('--webhook-latency', type=float, help="Webhook每次请求的延迟（毫秒）")
+    parser.add_argument('--webhook-5xx', type=float, help="Webhook返回503的比例")
+    parser.add_argument('--webhook-429', type=float, help="Webhook返回429的比例")
+    parser.add_argument('--sweeps', type=int, help="检查轮数，第二轮起没有新邮件，用于测量空闲轮询的开销")
+    parser.add_argument('--concurrency', type=int, help="每个服务商同时检查的账号数")
+    parser.add_argument('--json', action='store_true', help="以JSON输出结果")
+    args = parser.parse_args(argv)
+
+    options = dict(DEFAULTS)
+    options.update(SCENARIOS.get(args.scenario, {}))
+    for key in DEFAULTS:
+        value = getattr(args, key)
+        if value is not None:
+            options[key] = value
+    options['scenario'] = args.scenario
+    return options, args.json
+
+if __name__ == '__main__':
+    options, as_json = parse_args()
+    report = run(options)
+    if as_json:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_report(report)
@@ -1,18 +1,57 @@
 import os
+import re
 import imaplib
 import email
+import base64
+import quopri
 import requests
+from requests.adapters import HTTPAdapter
+from collections import deque, OrderedDict
+from urllib.parse import urlparse, quote_plus
+import hmac
+import hashlib
+import heapq
+import socket
+from functools import partial, lru_cache
+import string
 from fastapi import FastAPI, HTTPException, Security, Depends, BackgroundTasks
 from fastapi.security.api_key import APIKeyHeader, APIKey
+from fastapi.responses import PlainTextResponse
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import logging
 from email.header import decode_header
 import time
+import random
+import select
+import signal
+import ssl
+import sqlite3
+import json
+from html import unescape
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-import pytz
-from exchangelib import Credentials, Account, DELEGATE, Configuration
+from zoneinfo import ZoneInfo
+try:
+    import tomllib
+except ImportError:  # Python 3.10及以下
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+try:
+    import yaml
+except ImportError:
+    yaml = None
+try:
+    import httpx
+except ImportError:
+    httpx = None
+from exchangelib import Credentials, Account, DELEGATE, Configuration, Message, HTMLBody
+from exchangelib.properties import NewMailEvent, CreatedEvent
 from exchangelib.protocol import BaseProtocol, NoVerifyHTTPAdapter
+from exchangelib.version import EXCHANGE_2013
 import urllib3
 
 # 禁用SSL警告
@@ -22,12 +61,134 @@ BaseProtocol.HTTP_ADAPTER_CLS = NoVerifyHTTPAdapter
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# httpx默认为每个请求打印一条INFO日志，投递结果已由发送协程记录
+logging.getLogger('httpx').setLevel(logging.WARNING)
 
 # 设置北京时区
-beijing_tz = pytz.timezone('Asia/Shanghai')
+beijing_tz = ZoneInfo('Asia/Shanghai')
+
+@lru_cache(maxsize=4096)
+def beijing_time(timestamp):
+    """把Unix时间（整秒）格式化成北京时间字符串，同一秒内收到的邮件直接复用结果"""
+    return datetime.fromtimestamp(timestamp, beijing_tz).strftime("%Y-%m-%d %H:%M:%S")
+
+def parse_mail_date(date_str, default):
+    """把邮件头Date解析成Unix时间戳，缺失或格式错误时返回default"""
+    parsed = email.utils.parsedate_tz(date_str) if date_str else None
+    if parsed is None:
+        return default
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return default
+
+# 配置检查间隔（环境变量单位为分钟，内部换算成秒）
+CHECK_INTERVAL = float(os.getenv('CHECK_INTERVAL', '5')) * 60  # 每个邮箱的基础检查间隔
+MIN_CHECK_INTERVAL = float(os.getenv('MIN_CHECK_INTERVAL', '1')) * 60  # 频繁收信的邮箱最短检查间隔
+MAX_CHECK_INTERVAL = float(os.getenv('MAX_CHECK_INTERVAL', '15')) * 60  # 空闲或连续失败的邮箱最长检查间隔
+# 内置调度：按邮箱分别安排检查时间，不再依赖外部定时访问/wake；关闭后/wake每次检查全部邮箱
+SCHEDULER = os.getenv('SCHEDULER', 'true').lower() == 'true'
+
+# I/O模式：thread为阻塞的imaplib/requests调用放到线程池执行；
+# async为IMAP和Webhook直接在事件循环上异步执行（Webhook需要安装httpx），线程池只用于Outlook(EWS)和检查中的阻塞调用
+IO_MODE = os.getenv('IO_MODE', 'thread').lower()
+
+# 并发检查配置
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '16'))  # 检查线程池大小，async模式下只用于Outlook
+ACCOUNT_TIMEOUT = int(os.getenv('ACCOUNT_TIMEOUT', '120'))  # 单个邮箱检查超时（秒）
+NETWORK_TIMEOUT = int(os.getenv('NETWORK_TIMEOUT', '30'))  # IMAP/EWS网络超时（秒）
+
+# 服务商和账号配置文件（TOML或YAML），可添加任意IMAP服务器；文件不存在时只使用内置服务商和环境变量
+PROVIDERS_CONFIG = os.getenv('PROVIDERS_CONFIG', 'providers.toml')
+# 配置只在启动时读取一次；收到SIGHUP或配置文件修改后重新加载，这里是检查文件是否修改的间隔（秒），0为只响应SIGHUP
+CONFIG_RELOAD_INTERVAL = float(os.getenv('CONFIG_RELOAD_INTERVAL', '10'))
 
-# 配置检查间隔（秒）
-CHECK_INTERVAL = 300  # 5分钟检查一次
+# IMAP长连接配置
+RECONNECT_BASE_DELAY = float(os.getenv('RECONNECT_BASE_DELAY', '2'))  # 重连退避初始值（秒）
+RECONNECT_MAX_DELAY = float(os.getenv('RECONNECT_MAX_DELAY', '300'))  # 重连退避上限（秒）
+IMAP_IDLE = os.getenv('IMAP_IDLE', 'false').lower() == 'true'  # 是否使用IDLE实时推送
+IDLE_REFRESH = int(os.getenv('IDLE_REFRESH', '1500'))  # IDLE续期间隔（秒），需小于服务器的29分钟超时
+
+# Outlook(EWS)新邮件通知：off为只靠定时检查，streaming为流式推送，pull为定期拉取事件
+EWS_NOTIFY = os.getenv('EWS_NOTIFY', 'off').lower()
+EWS_PULL_INTERVAL = float(os.getenv('EWS_PULL_INTERVAL', '15'))  # pull模式拉取事件的间隔（秒）
+EWS_EVENT_TYPES = ['NewMailEvent', 'CreatedEvent']
+# 只取转发需要的字段，正文用纯文本的text_body代替HTML的body（text_body从Exchange 2013开始支持，更早的版本取body）
+EWS_FIELDS = ['subject', 'sender', 'datetime_received', 'text_body', 'message_id']
+
+# 本地状态库（同步位置等），重启后继续增量同步
+STATE_DB = os.getenv('STATE_DB', 'mail_state.db')
+# 多进程/多机分片：各进程在STATE_DB中按租约分配邮箱，每个邮箱同一时间只由一个进程检查
+SHARDING = os.getenv('SHARDING', 'false').lower() == 'true'
+LEASE_TTL = float(os.getenv('LEASE_TTL', '60'))  # 租约和进程心跳的有效期（秒），每1/3有效期续约一次
+# 转发后是否把邮件标记为已读；增量同步不依赖已读标记，默认不修改用户的邮件状态
+MARK_AS_READ = os.getenv('MARK_AS_READ', 'false').lower() == 'true'
+
+# 跨邮箱去重：同一封邮件（抄送、邮件列表、转发到其他邮箱）只通知一次
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', '259200'))  # 去重记录保留时间（秒），0为不去重
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', '100000'))  # 内存中最多保留的记录数
+DEDUP_SPILL = os.getenv('DEDUP_SPILL', 'false').lower() == 'true'  # 超出内存上限的记录写入STATE_DB而不是丢弃
+
+# 邮件获取方式：partial只取邮件头、BODYSTRUCTURE和正文前几KB，full下载完整邮件
+FETCH_MODE = os.getenv('FETCH_MODE', 'partial').lower()
+PREVIEW_BYTES = int(os.getenv('PREVIEW_BYTES', '4096'))  # 正文预览最多下载的字节数
+HTML_PREVIEW_BYTES = int(os.getenv('HTML_PREVIEW_BYTES', '16384'))  # 只有HTML正文时最多下载和转换的字节数
+PREVIEW_CHARS = 500  # 通知中正文预览的字数
+HEADER_FIELDS = 'DATE FROM SUBJECT MESSAGE-ID'
+FETCH_BATCH_SIZE = int(os.getenv('FETCH_BATCH_SIZE', '50'))  # 每条FETCH/STORE命令包含的邮件数
+# 积压邮件分页处理：每次检查最多处理的邮件数，剩下的由紧接着的下一次检查继续，检查耗时和内存不随积压量增长
+BACKLOG_LIMIT = int(os.getenv('BACKLOG_LIMIT', '500'))
+FETCH_MAX_BYTES = int(os.getenv('FETCH_MAX_BYTES', str(8 * 1024 * 1024)))  # full模式每个邮箱同时下载的原始邮件总字节数
+EWS_PAGE_SIZE = int(os.getenv('EWS_PAGE_SIZE', '100'))  # Outlook每次请求返回的邮件数
+
+# Webhook投递配置
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))  # 发送线程数
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))  # 待发送队列上限
+WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', '10'))  # 单次请求超时（秒）
+WEBHOOK_RETRIES = int(os.getenv('WEBHOOK_RETRIES', '3'))  # 失败后的重试次数
+WEBHOOK_RETRY_DELAY = float(os.getenv('WEBHOOK_RETRY_DELAY', '1'))  # 重试退避初始值（秒）
+# 机器人返回的限流错误码（企业微信、钉钉、飞书），可以重试
+WEBHOOK_THROTTLE_CODES = {45009, 130101, 9499, 11232}
+# 限流与合并：超出频率配额时把排队中的通知合并成一条摘要发送
+WEBHOOK_DIGEST = os.getenv('WEBHOOK_DIGEST', 'true').lower() == 'true'
+WEBHOOK_RATE_LIMIT = os.getenv('WEBHOOK_RATE_LIMIT')  # 每分钟最多发送的消息数，默认按平台（企业微信/钉钉20，飞书100）
+WEBHOOK_BURST = os.getenv('WEBHOOK_BURST')  # 令牌桶容量（可连续发送的消息数），默认5，不超过每分钟配额的一半
+WEBHOOK_MAX_BYTES = os.getenv('WEBHOOK_MAX_BYTES')  # 单条消息内容最大字节数，默认按平台消息大小限制
+# 过滤规则中action为digest的邮件不单独通知，每隔DIGEST_INTERVAL秒合并成一条摘要发送
+DIGEST_INTERVAL = int(os.getenv('DIGEST_INTERVAL', '3600'))
+# 通知格式：text为纯文本，markdown为markdown消息（飞书为消息卡片）
+NOTIFY_FORMAT = os.getenv('NOTIFY_FORMAT', 'text').lower()
+
+# 持久化发件箱：通知先写入本地SQLite再发送，进程重启后继续投递
+OUTBOX_COMMIT_DELAY = float(os.getenv('OUTBOX_COMMIT_DELAY', '0.02'))  # 批量提交的等待时间（秒）
+OUTBOX_RETRY_DELAY = 1  # 写入发件箱失败后重试的等待时间（秒）
+OUTBOX_RETRY_INTERVAL = int(os.getenv('OUTBOX_RETRY_INTERVAL', '300'))  # 重新投递失败通知的间隔（秒）
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))  # 超过后放弃该通知
+
+# 内置服务商，配置文件中同名的服务商会覆盖这里的设置
+# window_minutes为首次同步处理的时间范围，concurrency为同时检查的邮箱数（各家对并发登录的限制不同）
+BUILTIN_PROVIDERS = {
+    'gmail': {'host': 'imap.gmail.com', 'label': 'Gmail', 'icon': '📧 Gmail',
+              'window_minutes': 30, 'concurrency': 4},
+    'qq': {'host': 'imap.qq.com', 'label': 'QQ', 'icon': '📨 QQ邮箱',
+           'window_minutes': 24 * 60, 'concurrency': 2},
+    'outlook': {'host': 'outlook.office365.com', 'protocol': 'ews', 'label': 'Outlook',
+                'icon': '📨 Outlook', 'window_minutes': 30, 'concurrency': 4},
+    '163': {'host': 'imap.163.com', 'label': '163', 'icon': '📮 163邮箱', 'env': 'MAIL163',
+            'window_minutes': 24 * 60, 'concurrency': 2, 'imap_id': True},
+    '126': {'host': 'imap.126.com', 'label': '126', 'icon': '📮 126邮箱', 'env': 'MAIL126',
+            'window_minutes': 24 * 60, 'concurrency': 2, 'imap_id': True},
+    'yahoo': {'host': 'imap.mail.yahoo.com', 'label': 'Yahoo', 'icon': '📧 Yahoo',
+              'window_minutes': 30, 'concurrency': 2}
+}
+
+# imaplib不认识ID命令（RFC 2971），注册后才能发送
+imaplib.Commands.setdefault('ID', ('NONAUTH', 'AUTH', 'SELECTED'))
+
+# 阻塞的imaplib/exchangelib调用放到线程池执行，避免卡住事件循环；async模式下IMAP检查中可能阻塞的调用
+# （写入发件箱、等待发送队列空位、读写SQLite）也在这里执行，不占用事件循环的默认线程池
+check_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='mail-check')
+BaseProtocol.TIMEOUT = NETWORK_TIMEOUT
 
 # 服务状态
 service_status = {
@@ -35,101 +196,2677 @@ service_status = {
     "last_check_status": "未开始",
     "error_count": 0,
     "consecutive_errors": 0,
-    "is_checking": False
+    "is_checking": False,
+    "accounts": {},  # 每个邮箱最近一次的检查结果
+    "in_flight": {"sweeps": 0, "checks": 0},  # 正在进行的全量检查和单邮箱检查数
+    "imap_connections": {"logins": 0, "reused": 0, "reconnects": 0},
+    "delivery": {
+        "queued": 0, "sent": 0, "failed": 0, "retries": 0, "deferred": 0,
+        "throttled": 0, "coalesced": 0, "replayed": 0, "duplicates": 0,
+        "filtered": 0, "digested": 0, "unrouted": 0, "undeliverable": 0
+    }
+}
+
+class Provider:
+    """邮箱服务商：协议、服务器地址、首次同步的搜索方式和时间窗口、通知图标和并发数"""
+    __slots__ = ('name', 'host', 'protocol', 'ssl', 'port', 'label', 'icon', 'window', 'search',
+                 'imap_id', 'env', 'concurrency', 'settings')
+
+    def __init__(self, name, host, protocol='imap', port=None, ssl=True, label=None, icon=None,
+                 window_minutes=30, search='UNSEEN', concurrency=4, imap_id=False, env=None):
+        self.name = name
+        self.host = host
+        self.protocol = protocol  # imap 或 ews
+        self.ssl = ssl
+        self.port = int(port) if port else (imaplib.IMAP4_SSL_PORT if ssl else imaplib.IMAP4_PORT)
+        self.label = label or name
+        self.icon = icon or f"📧 {self.label}"
+        self.window = timedelta(minutes=float(window_minutes))
+        self.search = search  # 首次同步的IMAP搜索条件，与SINCE组合使用
+        self.imap_id = imap_id  # 登录后发送ID命令，网易邮箱要求
+        # 环境变量前缀：<前缀>_EMAILS、<前缀>_PASSWORDS、<前缀>_CONCURRENCY
+        self.env = env or re.sub(r'\W', '_', name).upper()
+        self.concurrency = int(os.getenv(f'{self.env}_CONCURRENCY', concurrency))
+        # 重新加载配置时用来判断服务商设置是否变化
+        self.settings = (self.host, self.protocol, self.ssl, self.port, self.label, self.icon,
+                         self.window, self.search, self.imap_id, self.concurrency)
+
+class AccountConfig:
+    """一个邮箱账号，服务商设置已经解析好"""
+    __slots__ = ('provider', 'email', 'password', 'key', 'account_key')
+
+    def __init__(self, provider, email, password):
+        self.provider = provider
+        self.email = email
+        self.password = password
+        self.key = f"{provider.name}:{email}"  # 检查结果和调度使用的名称
+        self.account_key = f"{provider.host}/{email}"  # 同步位置、租约使用的名称
+
+    def same_as(self, other):
+        """密码和服务商设置都没有变化，连接和监听可以继续使用"""
+        return self.password == other.password and self.provider.settings == other.provider.settings
+
+def load_config_file(path=PROVIDERS_CONFIG):
+    """按扩展名以TOML或YAML解析配置文件，文件不存在时返回空配置"""
+    if not path or not os.path.exists(path):
+        return {}
+    if path.endswith(('.yaml', '.yml')):
+        if yaml is None:
+            raise RuntimeError("读取YAML配置文件需要安装PyYAML")
+        with open(path, encoding='utf-8') as f:
+            return yaml.safe_load(f) or {}
+    if tomllib is None:
+        raise RuntimeError("Python 3.10及以下读取TOML配置文件需要安装tomli")
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+def get_providers(config):
+    """合并内置服务商和配置文件中的[providers]，返回 {服务商名: Provider}"""
+    specs = {name: dict(spec) for name, spec in BUILTIN_PROVIDERS.items()}
+    for name, spec in (config.get('providers') or {}).items():
+        specs.setdefault(str(name), {}).update(spec)
+    providers = {}
+    for name, spec in specs.items():
+        try:
+            providers[name] = Provider(name, **spec)
+        except TypeError as e:
+            raise ValueError(f"服务商{name}配置有误: {str(e)}")
+    return providers
+
+# 邮箱配置
+def get_email_configs(providers, config):
+    """返回 {服务商名: [AccountConfig]}，账号来自 <前缀>_EMAILS/<前缀>_PASSWORDS 环境变量和配置文件的[[accounts]]"""
+    configs = {name: [] for name in providers}
+    seen = set()
+
+    def add(name, email, password):
+        email, password = (email or '').strip(), (password or '').strip()
+        if not email or not password or (name, email) in seen:
+            return
+        seen.add((name, email))
+        configs[name].append(AccountConfig(providers[name], email, password))
+
+    for name, provider in providers.items():
+        emails = os.getenv(f'{provider.env}_EMAILS', '').split(',')
+        passwords = os.getenv(f'{provider.env}_PASSWORDS', '').split(',')
+        for email, password in zip(emails, passwords):
+            add(name, email, password)
+
+    # 配置文件中的密码也可以用password_env指定从哪个环境变量读取
+    for account in config.get('accounts') or []:
+        name = str(account.get('provider', ''))
+        if name not in providers:
+            logger.error(f"邮箱 {account.get('email')} 的服务商 {name} 未配置，已跳过")
+            continue
+        password = account.get('password') or os.getenv(account.get('password_env', ''), '')
+        add(name, account.get('email'), password)
+
+    return configs
+
+# 邮件列表/群发邮件的标志
+LIST_HEADERS = ('list-id', 'list-unsubscribe', 'precedence')
+RULE_ACTIONS = ('route', 'drop', 'digest')
+
+class Rule:
+    """一条过滤规则，条件之间为“且”；action为route（只发到targets）、drop（丢弃）或digest（合并成定时摘要）"""
+    def __init__(self, spec):
+        self.name = spec.get('name', '')
+        self.action = spec.get('action', 'route')
+        if self.action not in RULE_ACTIONS:
+            raise ValueError(f"规则{self.name}的action {self.action} 不受支持")
+        self.targets = set(spec.get('targets') or [])  # 平台名（wecom/dingtalk/feishu/pushme）或Webhook地址
+        if self.action == 'route' and not self.targets:
+            raise ValueError(f"规则{self.name}没有指定targets")
+        # 发件人：含@的按完整地址匹配，否则按域名（包括子域名）匹配
+        senders = [str(sender).strip().lower().lstrip('@') for sender in spec.get('from') or []]
+        self.addresses = [sender for sender in senders if '@' in sender]
+        self.domains = [sender for sender in senders if '@' not in sender]
+        self.accounts = {str(account).strip().lower() for account in spec.get('account') or []}
+        self.subject_pattern = spec.get('subject')
+        self.subject = re.compile(self.subject_pattern, re.I) if self.subject_pattern else None
+        self.list_id = re.compile(spec['list_id'], re.I) if spec.get('list_id') else None
+        self.list_only = spec.get('list')  # True只匹配群发邮件，False只匹配非群发邮件
+        self.min_size = spec.get('min_size')
+        self.max_size = spec.get('max_size')
+
+    def matches(self, account, subject, headers, size):
+        """发件人已由RuleSet用哈希表筛选过，这里判断其余条件"""
+        if self.accounts and account.lower() not in self.accounts:
+            return False
+        if self.subject and not self.subject.search(subject or ''):
+            return False
+        if self.list_only is not None:
+            is_list = any(headers.get(name) for name in LIST_HEADERS[:2]) or \
+                str(headers.get('precedence') or '').strip().lower() in ('bulk', 'list', 'junk')
+            if is_list != bool(self.list_only):
+                return False
+        if self.list_id and not self.list_id.search(str(headers.get('list-id') or '')):
+            return False
+        if self.min_size is not None and (size is None or size < self.min_size):
+            return False
+        if self.max_size is not None and (size is None or size > self.max_size):
+            return False
+        return True
+
+# 合并正则时会改变含义的写法：反向引用（组号会偏移）和内联标志（只能出现在整个正则开头）
+UNCOMBINABLE_PATTERN = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)')
+
+def combine_patterns(patterns):
+    """把多个正则合并成一个用于预筛选，不能等价合并或没有正则时返回None"""
+    if not patterns or any(UNCOMBINABLE_PATTERN.search(pattern) for pattern in patterns):
+        return None
+    try:
+        return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns), re.I)
+    except re.error:
+        # 例如不同规则用了同名的命名组
+        return None
+
+class RuleSet:
+    """配置文件[[rules]]编译成的匹配器，只看邮件头，在下载正文之前决定邮件的去向
+
+    规则按顺序匹配，第一条命中的生效，都不命中时发到所有渠道；发件人条件编译成地址和域名的哈希表，
+    所有主题正则合并成一个正则，大多数邮件一次search就能排除全部主题规则。
+    正则带内联标志（如(?i)）或反向引用时合并后含义会变，这时不合并，逐条规则search
+    """
+    def __init__(self, specs=()):
+        self.rules = [Rule(spec) for spec in specs]
+        self.addresses = {}  # {发件人地址: [规则序号]}
+        self.domains = {}  # {域名: [规则序号]}
+        self.generic = []  # 没有发件人条件的规则序号
+        for index, rule in enumerate(self.rules):
+            for address in rule.addresses:
+                self.addresses.setdefault(address, []).append(index)
+            for domain in rule.domains:
+                self.domains.setdefault(domain, []).append(index)
+            if not rule.addresses and not rule.domains:
+                self.generic.append(index)
+        patterns = [rule.subject_pattern for rule in self.rules if rule.subject]
+        self.subject_filter = combine_patterns(patterns)
+        # 规则用到的额外邮件头和大小，没有相应规则时不多下载
+        self.header_fields = ' LIST-ID LIST-UNSUBSCRIBE PRECEDENCE' if any(
+            rule.list_only is not None or rule.list_id for rule in self.rules
+        ) else ''
+        self.needs_size = any(rule.min_size is not None or rule.max_size is not None for rule in self.rules)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def match(self, sender, account, subject, headers, size=None):
+        """返回第一条命中的规则，没有时返回None；sender为From邮件头"""
+        if not self.rules:
+            return None
+        address = email.utils.parseaddr(sender or '')[1].lower()
+        candidates = list(self.generic)
+        candidates.extend(self.addresses.get(address, ()))
+        domain = address.rpartition('@')[2]
+        while domain:
+            candidates.extend(self.domains.get(domain, ()))
+            domain = domain.partition('.')[2]
+        subject_hit = None
+        for index in sorted(set(candidates)):
+            rule = self.rules[index]
+            if rule.subject and self.subject_filter is not None:
+                if subject_hit is None:
+                    subject_hit = bool(self.subject_filter.search(subject or ''))
+                if not subject_hit:
+                    continue
+            if rule.matches(account, subject, headers, size):
+                return rule
+        return None
+
+class ConfigSnapshot:
+    """某一时刻的服务商、账号和过滤规则，创建后不再修改，重新加载时整体替换"""
+    __slots__ = ('providers', 'configs', 'accounts', 'rules', 'webhooks', 'mtime', 'version')
+
+    def __init__(self, providers, accounts, rules, webhooks, mtime, version):
+        self.providers = providers  # {服务商名: Provider}
+        self.accounts = accounts  # {服务商:邮箱: AccountConfig}
+        self.configs = {name: [] for name in providers}  # {服务商名: [AccountConfig]}
+        for account in accounts.values():
+            self.configs[account.provider.name].append(account)
+        self.rules = rules
+        self.webhooks = webhooks  # {平台名或Webhook地址: 发送频率和消息大小设置}
+        self.mtime = mtime
+        self.version = version
+
+class ConfigManager:
+    """读取一次环境变量和配置文件，得到配置快照；每个邮箱的监控对象常驻，检查时直接使用
+
+    收到SIGHUP或配置文件修改后重新加载，按账号对比：没有变化的邮箱保留原来的记录、监控对象和连接，
+    只有新增、删除或修改了密码/服务商设置的邮箱需要建立或关闭连接。配置有误时继续使用之前的配置
+    """
+    def __init__(self, path=PROVIDERS_CONFIG):
+        self.path = path
+        self.snapshot = None
+        self.monitors = {}  # {服务商:邮箱: 监控对象}
+        self.locks = {}  # {服务商:邮箱: 已移除的监控对象的锁}，新的监控对象沿用，等旧的检查结束后再检查
+        self.failed_mtime = None  # 加载失败的配置文件版本，文件再次修改前不重复报错
+        self.lock = threading.Lock()
+
+    def file_mtime(self):
+        try:
+            return os.path.getmtime(self.path)
+        except (OSError, TypeError):
+            return None
+
+    def build(self, mtime, version, config=None):
+        if config is None:
+            config = load_config_file(self.path)
+        providers = get_providers(config)
+        accounts = {}
+        for name, account_configs in get_email_configs(providers, config).items():
+            if account_configs and providers[name].protocol not in MONITOR_TYPES:
+                logger.error(f"服务商{name}的协议 {providers[name].protocol} 不受支持")
+                continue
+            for account in account_configs:
+                accounts[account.key] = account
+        rules = RuleSet(config.get('rules') or [])
+        webhooks = get_webhook_settings(config)
+        self.check_targets(rules, webhooks)
+        return ConfigSnapshot(providers, accounts, rules, webhooks, mtime, version)
+
+    @staticmethod
+    def check_targets(rules, webhooks):
+        """规则指定的渠道写错或该平台没有配置Webhook时在加载配置时报错，而不是等邮件命中时才发现"""
+        notifiers = create_notifiers(webhooks)
+        known = {notifier.platform for notifier in notifiers} | {notifier.url for notifier in notifiers}
+        for rule in rules.rules:
+            unknown = rule.targets - known
+            if unknown:
+                logger.error(
+                    f"规则{rule.name}指定的通知渠道未配置: {', '.join(sorted(unknown))}"
+                    + ("，命中的邮件将改发到所有渠道" if unknown == rule.targets else "")
+                )
+
+    def current(self):
+        """返回当前配置快照，第一次调用时加载"""
+        if self.snapshot is None:
+            with self.lock:
+                if self.snapshot is None:
+                    mtime = self.file_mtime()
+                    try:
+                        self.snapshot = self.build(mtime, 1)
+                    except Exception as e:
+                        # 配置文件有误时先只用环境变量中的邮箱运行，文件修改后由reload重新加载
+                        self.failed_mtime = mtime
+                        logger.error(f"加载配置失败，暂时只使用环境变量中的邮箱: {str(e)}")
+                        self.snapshot = self.build(mtime, 1, config={})
+                    logger.info(
+                        f"已加载{len(self.snapshot.accounts)}个邮箱"
+                        + (f"、{len(self.snapshot.rules.rules)}条过滤规则" if self.snapshot.rules else "")
+                    )
+        return self.snapshot
+
+    def reload(self, force=False):
+        """重新加载配置，返回 (新增的账号, 移除的账号)，修改过的账号同时出现在两边；
+        配置文件没有修改（force为False时）或加载失败时返回None
+        """
+        with self.lock:
+            old = self.snapshot
+            mtime = self.file_mtime()
+            if old is not None and not force and mtime in (old.mtime, self.failed_mtime):
+                return None
+            try:
+                snapshot = self.build(mtime, old.version + 1 if old else 1)
+            except Exception as e:
+                self.failed_mtime = mtime
+                logger.error(f"重新加载配置失败，继续使用之前的配置: {str(e)}")
+                return None
+            self.failed_mtime = None
+
+            previous = old.accounts if old else {}
+            added, removed, accounts = [], [], {}
+            for key, account in snapshot.accounts.items():
+                kept = previous.get(key)
+                if kept is not None and kept.same_as(account):
+                    accounts[key] = kept
+                    continue
+                if kept is not None:
+                    removed.append(kept)
+                added.append(account)
+                accounts[key] = account
+            removed.extend(account for key, account in previous.items() if key not in snapshot.accounts)
+            for account in removed:
+                monitor = self.monitors.pop(account.key, None)
+                # 修改过的邮箱可能还有检查在进行或排队，新的监控对象必须和它们共用一把锁
+                if monitor is not None and (account.key in accounts or monitor.lock.locked()):
+                    self.locks[account.key] = monitor.lock
+            self.snapshot = ConfigSnapshot(
+                snapshot.providers, accounts, snapshot.rules, snapshot.webhooks, mtime, snapshot.version
+            )
+        logger.info(
+            f"配置已重新加载：{len(accounts)}个邮箱，新增或修改{len(added)}个，移除或修改{len(removed)}个，"
+            f"{len(snapshot.rules.rules)}条过滤规则"
+        )
+        return added, removed
+
+    def monitor(self, account):
+        """返回账号常驻的监控对象"""
+        monitor = self.monitors.get(account.key)
+        if monitor is None:
+            monitor = MONITOR_TYPES[account.provider.protocol](account.email, account.password, account.provider)
+            lock = self.locks.pop(account.key, None)
+            if lock is not None:
+                monitor.lock = lock
+            monitor = self.monitors.setdefault(account.key, monitor)
+        return monitor
+
+config_manager = ConfigManager()
+
+def load_rules():
+    """当前配置中的过滤规则，随配置一起重新加载"""
+    return config_manager.current().rules
+
+app = FastAPI()
+
+# API密钥验证
+API_KEY_NAME = "X-API-Key"
+api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
+
+async def get_api_key(api_key_header: str = Security(api_key_header)):
+    if api_key_header == os.getenv("API_KEY"):
+        return api_key_header
+    raise HTTPException(
+        status_code=403,
+        detail="无效的API密钥"
+    )
+
+def update_service_status(success: bool, error_message: str = None):
+    """更新服务状态"""
+    service_status["last_check_time"] = datetime.now(beijing_tz).strftime("%Y-%m-%d %H:%M:%S")
+    
+    if success:
+        service_status["last_check_status"] = "成功"
+        service_status["consecutive_errors"] = 0
+    else:
+        service_status["last_check_status"] = f"失败: {error_message}"
+        service_status["error_count"] += 1
+        service_status["consecutive_errors"] += 1
+
+# 监控指标（/metrics，Prometheus文本格式）
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # 秒
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+DELAY_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)  # 秒
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """按标签组合累计的计数器"""
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+class Histogram:
+    """按标签组合分别统计各分桶计数、总和与次数的直方图"""
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}  # {标签: [各分桶计数（不累加）, 总和, 次数]}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def timer(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self.series.items()]
+        for labels, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+# 各阶段：connect登录/取连接，search搜索新邮件，fetch下载，parse解析，check单邮箱检查总耗时，deliver入队到送达
+stage_seconds = Histogram('mail_stage_seconds', '邮箱检查各阶段耗时（秒）', LATENCY_BUCKETS)
+fetch_bytes = Histogram('mail_fetch_bytes', '每条FETCH命令下载的字节数', BYTES_BUCKETS)
+delivery_delay = Histogram('mail_delivery_delay_seconds', '从邮件Date到通知送达的延迟（秒）', DELAY_BUCKETS)
+webhook_seconds = Histogram('mail_webhook_request_seconds', '单次Webhook请求耗时（秒）', LATENCY_BUCKETS)
+sweep_seconds = Histogram('mail_sweep_seconds', '一次全量检查的耗时（秒）', LATENCY_BUCKETS)
+checks_total = Counter('mail_checks_total', '邮箱检查次数')
+
+def truncate_utf8(text, max_bytes):
+    """按UTF-8字节数截断文本，不截断半个字符"""
+    data = text.encode('utf-8')
+    if len(data) <= max_bytes:
+        return text
+    return data[:max_bytes].decode('utf-8', errors='ignore')
+
+class TextTemplate:
+    """编译好的通知模板：固定字段（服务商、收件邮箱）在编译时填入，渲染时只拼接每封邮件变化的字段"""
+    __slots__ = ('pieces', 'fields')
+
+    def __init__(self, pattern, **fixed):
+        self.pieces = []
+        self.fields = []
+        literal = ''
+        for text, field, _, _ in string.Formatter().parse(pattern):
+            literal += text
+            if field is None:
+                continue
+            if field in fixed:
+                literal += str(fixed[field])
+            else:
+                self.pieces.append(literal)
+                self.fields.append(field)
+                literal = ''
+        self.pieces.append(literal)
+
+    def render(self, values):
+        parts = [self.pieces[0]]
+        for field, piece in zip(self.fields, self.pieces[1:]):
+            parts.append(str(values[field]))
+            parts.append(piece)
+        return ''.join(parts)
+
+# JSON模板中的占位字段，序列化后是"\u0000名称\u0000"
+JSON_FIELD = re.compile(r'"\\u0000(\w+)\\u0000"')
+JSON_HEADERS = {'Content-Type': 'application/json; charset=utf-8'}
+
+def json_field(name):
+    return f"\x00{name}\x00"
+
+class JSONTemplate:
+    """预先编码的JSON请求体：固定部分只序列化一次，发送时只编码用json_field标出的字段"""
+    __slots__ = ('pieces', 'fields')
+
+    def __init__(self, payload):
+        parts = JSON_FIELD.split(json.dumps(payload, ensure_ascii=False, separators=(',', ':')))
+        self.pieces = [part.encode('utf-8') for part in parts[0::2]]
+        self.fields = parts[1::2]
+
+    def render(self, **values):
+        parts = [self.pieces[0]]
+        for field, piece in zip(self.fields, self.pieces[1:]):
+            parts.append(json.dumps(values[field], ensure_ascii=False).encode('utf-8'))
+            parts.append(piece)
+        return b''.join(parts)
+
+class Notifier:
+    """通知渠道基类：负责消息格式、签名、大小限制和响应判断，默认发送{"title", "content"}格式的JSON；
+    各平台继承后重写request_template，需要签名等每次都不同的请求再重写build_request
+    """
+    platform = 'webhook'
+    rate_limit = 20  # 每分钟最多发送的消息数
+    burst = 5  # 可连续发送的消息数
+    max_bytes = 4096  # 单条消息内容最大字节数
+    text_pattern = (
+        "{source}邮件通知\n\n"
+        "📬 收件邮箱: {account}\n"
+        "⏰ 接收时间: {time} (北京时间)\n"
+        "👤 发件人: {sender}\n"
+        "📑 主题: {subject}\n\n"
+        "📝 内容预览:\n{content}"
+    )
+    markdown_pattern = (
+        "### {source}邮件通知\n"
+        "**📑 主题:** {subject}\n\n"
+        "> 📬 收件邮箱: {account}\n"
+        "> ⏰ 接收时间: {time} (北京时间)\n"
+        "> 👤 发件人: {sender}\n\n"
+        "📝 内容预览:\n\n{content}"
+    )
+    # 编译好的模板按 (格式, 服务商, 收件邮箱) 缓存，格式相同的渠道共用，submit据此对每封邮件只渲染一次
+    templates = {}
+
+    def __init__(self, url, secret=None, settings=None):
+        """settings为配置文件中这个渠道的设置（rate_limit、burst、max_bytes），优先于WEBHOOK_*环境变量"""
+        settings = settings or {}
+        self.url = url
+        self.secret = secret
+        self.markdown = NOTIFY_FORMAT == 'markdown'
+        self.rate_limit = int(settings.get('rate_limit') or WEBHOOK_RATE_LIMIT or self.rate_limit)
+        # 令牌桶开始时可以连发burst条，之后每分钟补充rate_limit - burst条，任意一分钟内都不超过平台配额
+        burst = int(settings.get('burst') or WEBHOOK_BURST or self.burst)
+        self.burst = max(1, min(burst, self.rate_limit // 2))
+        self.max_bytes = int(settings.get('max_bytes') or WEBHOOK_MAX_BYTES or self.default_max_bytes())
+        self.payload = JSONTemplate(self.request_template())
+
+    def default_max_bytes(self):
+        """平台的单条消息大小限制"""
+        return self.max_bytes
+
+    def template(self, message):
+        """返回这封邮件所属服务商和邮箱的通知模板，首次使用时编译"""
+        pattern = self.markdown_pattern if self.markdown else self.text_pattern
+        key = (pattern, message['source'], message['account'])
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates.setdefault(
+                key, TextTemplate(pattern, source=message['source'], account=message['account'])
+            )
+        return template
+
+    @classmethod
+    def forget_templates(cls, accounts):
+        """移除已从配置中删除或修改的邮箱的模板，缓存不随邮箱增删一直增长"""
+        removed = {(account.provider.icon, account.email) for account in accounts}
+        for key in list(cls.templates):
+            if key[1:] in removed:
+                cls.templates.pop(key, None)
+
+    def render(self, message):
+        """把一封邮件的通知渲染成文本或markdown"""
+        return self.template(message).render(message)
+
+    def title(self, message):
+        """markdown消息和推送的标题"""
+        return f"{message['source']}: {message['subject']}"
+
+    def render_brief(self, message):
+        """定时摘要中的一行"""
+        return f"{message['time']} {message['sender']}: {message['subject']}"
+
+    def digest_separator(self):
+        return "\n\n---\n\n" if self.markdown else "\n\n━━━━━━━━━━\n\n"
+
+    def digest_header(self, count, reason):
+        return f"📬 共{count}封新邮件（{reason}）\n\n"
+
+    def render_digest(self, texts, reason="超出发送频率，合并发送"):
+        """把多条通知合并成一条摘要"""
+        return self.digest_header(len(texts), reason) + self.digest_separator().join(texts)
+
+    def request_template(self):
+        """返回请求体模板，消息内容和标题处用json_field('body')、json_field('title')占位"""
+        return {"title": json_field('title'), "content": json_field('body')}
+
+    def build_request(self, body, title):
+        """返回 (请求地址, 编码好的JSON请求体)"""
+        return self.url, self.payload.render(body=body, title=title)
+
+    def check_response(self, response):
+        """判断响应，返回 (是否成功, 是否可重试, 错误信息)"""
+        if response.status_code == 429 or response.status_code >= 500:
+            return False, True, f"HTTP {response.status_code}: {response.text[:200]}"
+        if response.status_code != 200:
+            return False, False, f"HTTP {response.status_code}: {response.text[:200]}"
+        try:
+            result = response.json()
+        except ValueError:
+            return True, False, None
+        if not isinstance(result, dict):
+            return True, False, None
+        # 机器人接口出错时HTTP状态码仍为200，错误码放在errcode/code里
+        code = result.get('errcode', result.get('code', result.get('StatusCode', 0)))
+        if code:
+            return False, code in WEBHOOK_THROTTLE_CODES, response.text[:200]
+        return True, False, None
+
+class WeComNotifier(Notifier):
+    """企业微信群机器人"""
+    platform = 'wecom'
+    max_bytes = 2048  # text消息上限，markdown为4096
+
+    def default_max_bytes(self):
+        return 4096 if self.markdown else self.max_bytes
+
+    def request_template(self):
+        if self.markdown:
+            return {"msgtype": "markdown", "markdown": {"content": json_field('body')}}
+        return {
+            "msgtype": "text",
+            "text": {
+                "content": json_field('body'),
+                "mentioned_list": ["@all"]
+            }
+        }
+
+class DingTalkNotifier(Notifier):
+    """钉钉群机器人，配置了加签密钥时在地址上附加timestamp和sign"""
+    platform = 'dingtalk'
+    max_bytes = 20000
+
+    def request_template(self):
+        if self.markdown:
+            payload = {"msgtype": "markdown", "markdown": {"title": json_field('title'), "text": json_field('body')}}
+        else:
+            payload = {"msgtype": "text", "text": {"content": json_field('body')}}
+        payload["at"] = {"isAtAll": True}
+        return payload
+
+    def build_request(self, body, title):
+        url = self.url
+        if self.secret:
+            timestamp = str(round(time.time() * 1000))
+            digest = hmac.new(
+                self.secret.encode('utf-8'),
+                f"{timestamp}\n{self.secret}".encode('utf-8'),
+                hashlib.sha256
+            ).digest()
+            sign = quote_plus(base64.b64encode(digest))
+            url = f"{url}{'&' if '?' in url else '?'}timestamp={timestamp}&sign={sign}"
+        return url, self.payload.render(body=body, title=title)
+
+class FeishuNotifier(Notifier):
+    """飞书群机器人，markdown格式使用消息卡片，配置了签名校验时在请求体中附加timestamp和sign"""
+    platform = 'feishu'
+    rate_limit = 100
+    max_bytes = 20000
+
+    def request_template(self):
+        if self.markdown:
+            payload = {
+                "msg_type": "interactive",
+                "card": {
+                    "header": {"title": {"tag": "plain_text", "content": json_field('title')}},
+                    "elements": [{"tag": "markdown", "content": json_field('body')}]
+                }
+            }
+        else:
+            payload = {"msg_type": "text", "content": {"text": json_field('body')}}
+        if self.secret:
+            payload["timestamp"] = json_field('timestamp')
+            payload["sign"] = json_field('sign')
+        return payload
+
+    def build_request(self, body, title):
+        if not self.secret:
+            return self.url, self.payload.render(body=body, title=title)
+        timestamp = str(int(time.time()))
+        digest = hmac.new(f"{timestamp}\n{self.secret}".encode('utf-8'), digestmod=hashlib.sha256).digest()
+        sign = base64.b64encode(digest).decode('utf-8')
+        return self.url, self.payload.render(body=body, title=title, timestamp=timestamp, sign=sign)
+
+class PushMeNotifier(Notifier):
+    """PushMe推送，push_key放在地址参数中"""
+    platform = 'pushme'
+
+    def request_template(self):
+        return {
+            "title": json_field('title'),
+            "content": json_field('body'),
+            "type": "markdown" if self.markdown else "text"
+        }
+
+NOTIFIER_TYPES = {
+    'wecom': WeComNotifier,
+    'dingtalk': DingTalkNotifier,
+    'feishu': FeishuNotifier,
+    'pushme': PushMeNotifier
+}
+
+# 按Webhook域名识别平台，用于WEIXIN_WEBHOOK
+NOTIFIER_HOSTS = {
+    'qyapi.weixin.qq.com': 'wecom',
+    'oapi.dingtalk.com': 'dingtalk',
+    'open.feishu.cn': 'feishu',
+    'open.larksuite.com': 'feishu',
+    'push.i-i.me': 'pushme'
+}
+
+def get_notifier_configs():
+    """读取通知渠道配置，返回 [(平台, 地址, 密钥)]"""
+    targets = []
+
+    # 兼容原来的单个Webhook，按域名识别平台
+    webhook_url = os.getenv('WEIXIN_WEBHOOK', '').strip()
+    if webhook_url:
+        platform = NOTIFIER_HOSTS.get(urlparse(webhook_url).hostname, 'wecom')
+        targets.append((platform, webhook_url, os.getenv('WEIXIN_WEBHOOK_SECRET', '').strip() or None))
+
+    # 各平台的多个Webhook (多个地址用逗号分隔，密钥顺序与地址一一对应)
+    for platform in ('wecom', 'dingtalk', 'feishu'):
+        urls = os.getenv(f'{platform.upper()}_WEBHOOKS', '').split(',')
+        secrets = os.getenv(f'{platform.upper()}_SECRETS', '').split(',')
+        for i, url in enumerate(urls):
+            secret = secrets[i].strip() if i < len(secrets) else ''
+            if url.strip():
+                targets.append((platform, url.strip(), secret or None))
+
+    # PushMe只需要push_key
+    for push_key in os.getenv('PUSHME_KEYS', '').split(','):
+        if push_key.strip():
+            targets.append(('pushme', f"https://push.i-i.me/?push_key={push_key.strip()}", None))
+
+    return targets
+
+WEBHOOK_SETTINGS = ('rate_limit', 'burst', 'max_bytes')
+
+def get_webhook_settings(config):
+    """配置文件中的[webhooks.<平台名或Webhook地址>]，返回 {平台名或地址: {设置名: 值}}"""
+    webhooks = {}
+    for target, spec in (config.get('webhooks') or {}).items():
+        unknown = set(spec) - set(WEBHOOK_SETTINGS)
+        if unknown:
+            raise ValueError(f"Webhook {target} 的设置 {', '.join(sorted(unknown))} 不受支持")
+        try:
+            settings = {name: int(value) for name, value in spec.items()}
+        except (TypeError, ValueError):
+            raise ValueError(f"Webhook {target} 的设置必须是整数")
+        if any(value <= 0 for value in settings.values()):
+            raise ValueError(f"Webhook {target} 的设置必须大于0")
+        webhooks[str(target)] = settings
+    return webhooks
+
+def create_notifiers(webhooks=None):
+    """根据配置创建通知渠道，地址重复的只保留一个；webhooks为按平台名或地址的设置，地址的设置优先"""
+    webhooks = webhooks or {}
+    notifiers = {}
+    for platform, url, secret in get_notifier_configs():
+        if url not in notifiers:
+            settings = dict(webhooks.get(platform) or {})
+            settings.update(webhooks.get(url) or {})
+            notifiers[url] = NOTIFIER_TYPES[platform](url, secret, settings)
+    return list(notifiers.values())
+
+class LeaseManager:
+    """多进程分片：每个邮箱在共享的SQLite中有一条租约，只有持有未过期租约的进程才检查该邮箱
+
+    各进程定期写心跳，按最高随机权重哈希（rendezvous hashing）在存活进程间分配邮箱，
+    进程增减时只有少数邮箱换主；进程退出或心跳超时后租约过期，由其他进程接管
+    """
+    def __init__(self, path, ttl, enabled):
+        self.path = path
+        self.ttl = ttl
+        self.enabled = enabled
+        self.db = None
+        self.lock = threading.Lock()
+        self.owned = {}  # {邮箱: 租约到期时间}
+        self.checking = {}  # {邮箱: 排队或正在进行的检查数}，检查结束前不释放租约，避免交接时两个进程同时检查
+        self.workers = []
+        self.pid = None
+        self._worker_id = None
+
+    @property
+    def worker_id(self):
+        # 按进程号生成，fork出的子进程各自得到不同的编号
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._worker_id = f"{socket.gethostname()}:{self.pid}:{random.getrandbits(32):08x}"
+        return self._worker_id
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=LEASE_TTL / 3)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS leases (account TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, heartbeat REAL NOT NULL)"
+            )
+            self.db.commit()
+        return self.db
+
+    @staticmethod
+    def preferred(account, workers):
+        """该邮箱应当由哪个进程负责：所有进程对同一邮箱算出的结果一致"""
+        return max(workers, key=lambda worker: hashlib.md5(f"{worker}|{account}".encode()).digest())
+
+    def begin_check(self, account):
+        """同一邮箱可能同时有调度、IDLE和手动触发的检查在排队，按次数计数，最后一次结束后才算检查完"""
+        self.checking[account] = self.checking.get(account, 0) + 1
+
+    def end_check(self, account):
+        count = self.checking.get(account, 0) - 1
+        if count > 0:
+            self.checking[account] = count
+        else:
+            self.checking.pop(account, None)
+
+    def owns(self, account):
+        """本进程是否负责该邮箱（account为host/邮箱），未开启分片时总是True"""
+        if not self.enabled:
+            return True
+        expires_at = self.owned.get(account)
+        return expires_at is not None and expires_at > time.time()
+
+    def heartbeat(self, accounts):
+        """续约：写心跳，释放应由其他进程负责的邮箱，申请或续期分配给本进程的邮箱，返回持有的邮箱数"""
+        worker_id = self.worker_id
+        with self.lock:
+            db = self.connect()
+            now = time.time()
+            expires_at = now + self.ttl
+            try:
+                db.execute("INSERT OR REPLACE INTO workers (worker, heartbeat) VALUES (?, ?)", (worker_id, now))
+                db.execute("DELETE FROM workers WHERE heartbeat < ?", (now - self.ttl,))
+                workers = [row[0] for row in db.execute("SELECT worker FROM workers")]
+                mine = {account for account in accounts if self.preferred(account, workers) == worker_id}
+                mine.update(account for account in list(self.checking) if account in self.owned)
+                held = [row[0] for row in db.execute("SELECT account FROM leases WHERE owner = ?", (worker_id,))]
+                db.executemany(
+                    "DELETE FROM leases WHERE account = ? AND owner = ?",
+                    [(account, worker_id) for account in held if account not in mine]
+                )
+                owned = {}
+                for account in mine:
+                    # 租约空闲、已过期或本来就属于本进程时才能拿到
+                    cursor = db.execute(
+                        "INSERT INTO leases (account, owner, expires_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT (account) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                        "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                        (account, worker_id, expires_at, now)
+                    )
+                    if cursor.rowcount:
+                        owned[account] = expires_at
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        if len(owned) != len(self.owned) or len(workers) != len(self.workers):
+            logger.info(f"分片进程数: {len(workers)}，本进程负责{len(owned)}/{len(accounts)}个邮箱")
+        self.owned = owned
+        self.workers = workers
+        return len(owned)
+
+    def release(self):
+        """退出时释放所有租约，其他进程下次续约时即可接管"""
+        if not self.enabled:
+            return
+        with self.lock:
+            db = self.connect()
+            db.execute("DELETE FROM leases WHERE owner = ?", (self.worker_id,))
+            db.execute("DELETE FROM workers WHERE worker = ?", (self.worker_id,))
+            db.commit()
+        self.owned = {}
+
+lease_manager = LeaseManager(STATE_DB, LEASE_TTL, SHARDING)
+
+class Notification:
+    """发往某个通知渠道的一条通知"""
+    __slots__ = ('entry_id', 'group_id', 'message', 'text', 'account', 'ack', 'description', 'queued_at')
+
+    def __init__(self, entry_id, group_id, message, text, account=None, ack=None, description=""):
+        self.entry_id = entry_id
+        self.group_id = group_id
+        self.message = message
+        self.text = text
+        self.account = account
+        self.ack = ack
+        self.description = description
+        self.queued_at = None
+
+class Outbox:
+    """持久化的待发送通知（SQLite WAL），写入和删除由后台线程合并成一个事务提交
+
+    同一封邮件发往多个渠道时每个渠道一条记录，共用group_id；整组都送达后才记入已投递列表
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY, group_id INTEGER NOT NULL, url TEXT NOT NULL, "
+            "message TEXT NOT NULL, account TEXT, ack TEXT, description TEXT, "
+            "attempts INTEGER DEFAULT 0, created_at REAL, worker TEXT)"
+        )
+        if 'worker' not in [row[1] for row in self.db.execute("PRAGMA table_info(outbox)")]:
+            self.db.execute("ALTER TABLE outbox ADD COLUMN worker TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS outbox_group ON outbox (group_id)")
+        # 编号从共享序列中按段分配，多个进程共用同一个STATE_DB时不会冲突
+        self.db.execute("CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.db.execute(
+            "INSERT OR IGNORE INTO sequences (name, value) "
+            "SELECT 'outbox', COALESCE(MAX(id), 0) + 1 FROM outbox"
+        )
+        self.db.commit()
+        self.db_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.next_id = 0
+        self.end_id = 0  # 当前编号段的结束位置（不含）
+        self.operations = []
+        self.submitted = 0  # 已提交给写线程的操作序号
+        self.committed = 0  # 已落盘的操作序号
+        self.settling = set()  # 已投递或已失败、删除/计数还没落盘的编号，pending不返回它们
+        self.writer = None
+
+    def start(self):
+        with self.condition:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run, name="outbox-writer", daemon=True)
+                self.writer.start()
+
+    def _queue(self, operation):
+        with self.condition:
+            self.operations.append(operation)
+            self.submitted += 1
+            self.condition.notify_all()
+
+    def add(self, urls, message, account=None, ack=None, description=""):
+        """为每个渠道写入一条通知，返回 (group_id, 编号列表)；调用flush后才保证已落盘"""
+        with self.condition:
+            if self.next_id + len(urls) > self.end_id:
+                self.reserve_ids(len(urls))
+            entry_ids = list(range(self.next_id, self.next_id + len(urls)))
+            self.next_id += len(urls)
+        group_id = entry_ids[0]
+        data = json.dumps(message, ensure_ascii=False)
+        worker_id = lease_manager.worker_id
+        for entry_id, url in zip(entry_ids, urls):
+            self._queue(('add', (
+                entry_id, group_id, url, data, account, json.dumps(ack), description, time.time(), worker_id
+            )))
+        return group_id, entry_ids
+
+    def reserve_ids(self, count):
+        """持有condition时调用：从共享序列中取下一段编号"""
+        size = max(count, 1000)
+        with self.db_lock:
+            self.db.execute("UPDATE sequences SET value = value + ? WHERE name = 'outbox'", (size,))
+            end_id = self.db.execute("SELECT value FROM sequences WHERE name = 'outbox'").fetchone()[0]
+            self.db.commit()
+        self.next_id, self.end_id = end_id - size, end_id
+
+    def remove(self, notification):
+        with self.condition:
+            self.settling.add(notification.entry_id)
+        self._queue(('remove', notification))
+
+    def fail(self, notification):
+        with self.condition:
+            self.settling.add(notification.entry_id)
+        self._queue(('fail', notification))
+
+    def flush(self, timeout=ACCOUNT_TIMEOUT):
+        """等待之前的写入全部落盘，返回是否成功"""
+        self.start()
+        with self.condition:
+            target = self.submitted
+            return self.condition.wait_for(lambda: self.committed >= target, timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.operations)
+            # 稍等片刻，把同时到达的写入合并成一次提交（一次fsync）
+            time.sleep(OUTBOX_COMMIT_DELAY)
+            with self.condition:
+                operations, self.operations = self.operations, []
+                target = self.submitted
+            try:
+                completed = self.apply(operations)
+            except Exception as e:
+                # 写入失败时不推进committed，flush超时返回False，邮箱检查不会保存同步位置；
+                # 这批写入放回队首，稍后重试
+                logger.error(f"写入发件箱失败，稍后重试: {str(e)}")
+                with self.condition:
+                    self.operations[:0] = operations
+                time.sleep(OUTBOX_RETRY_DELAY)
+                continue
+            for notification in completed:
+                ack_delivered(notification.account, notification.ack)
+            with self.condition:
+                self.settling.difference_update(
+                    value.entry_id for kind, value in operations if kind != 'add'
+                )
+                self.committed = target
+                self.condition.notify_all()
+
+    def apply(self, operations):
+        """执行一批写入，返回整组都已送达、需要记入已投递列表的通知"""
+        completed = []
+        with self.db_lock:
+            try:
+                self.apply_operations(operations, completed)
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+        return completed
+
+    def apply_operations(self, operations, completed):
+        """持有db_lock时调用，在同一个事务中执行写入"""
+        for kind, value in operations:
+            if kind == 'add':
+                self.db.execute(
+                    "INSERT OR REPLACE INTO outbox "
+                    "(id, group_id, url, message, account, ack, description, created_at, worker) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    value
+                )
+            elif kind == 'remove':
+                self.delete_entry(value, completed)
+            else:
+                self.db.execute("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", (value.entry_id,))
+                row = self.db.execute(
+                    "SELECT attempts FROM outbox WHERE id = ?", (value.entry_id,)
+                ).fetchone()
+                if row and row[0] >= OUTBOX_MAX_ATTEMPTS:
+                    # 放弃的渠道和送达的一样算作处理完，整组处理完后照常标记已读
+                    logger.error(f"通知已失败{row[0]}次，放弃投递: {value.description}")
+                    self.delete_entry(value, completed)
+
+    def delete_entry(self, notification, completed):
+        """删除一条通知，同组没有剩余记录时把它加入completed"""
+        self.db.execute("DELETE FROM outbox WHERE id = ?", (notification.entry_id,))
+        remaining = self.db.execute(
+            "SELECT 1 FROM outbox WHERE group_id = ? LIMIT 1", (notification.group_id,)
+        ).fetchone()
+        if remaining is None and notification.ack is not None:
+            completed.append(notification)
+
+    def pending(self, exclude):
+        """返回未投递的通知，exclude为正在内存队列中的编号；投递结果还没落盘的通知也不返回
+
+        调用方要先取exclude再调用pending：通知离开内存队列前已记入settling，直到删除落盘后才移出
+
+        开启分片时只返回本进程写入的通知，已退出进程（心跳超时）留下的通知由第一个发现的进程接管
+        """
+        with self.condition:
+            exclude = set(exclude) | self.settling
+        with self.db_lock:
+            if lease_manager.enabled:
+                lease_manager.connect()
+                worker_id = lease_manager.worker_id
+                self.db.execute(
+                    "UPDATE outbox SET worker = ? WHERE worker IS NULL OR worker NOT IN "
+                    "(SELECT worker FROM workers WHERE heartbeat >= ?)",
+                    (worker_id, time.time() - LEASE_TTL)
+                )
+                self.db.commit()
+                rows = self.db.execute(
+                    "SELECT id, group_id, url, message, account, ack, description FROM outbox "
+                    "WHERE worker = ? ORDER BY id",
+                    (worker_id,)
+                ).fetchall()
+            else:
+                rows = self.db.execute(
+                    "SELECT id, group_id, url, message, account, ack, description FROM outbox ORDER BY id"
+                ).fetchall()
+        return [
+            (entry_id, group_id, url, json.loads(message), account, json.loads(ack) if ack else None, description)
+            for entry_id, group_id, url, message, account, ack, description in rows
+            if entry_id not in exclude
+        ]
+
+    def count(self):
+        with self.db_lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+outbox = Outbox(STATE_DB)
+
+class WebhookChannel:
+    """单个通知渠道的待发送队列和令牌桶"""
+    def __init__(self, notifier):
+        self.configure(notifier)
+        self.digest = WEBHOOK_DIGEST
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.pending = deque()
+
+    def configure(self, notifier):
+        """使用渠道的频率配额和消息大小；重新加载配置时换成新设置，排队中的通知保留"""
+        self.notifier = notifier
+        # 桶容量burst，每秒补充 (配额 - burst) / 60 个令牌，任意60秒内最多发送配额条
+        self.rate = max(notifier.rate_limit - notifier.burst, 1) / 60
+        self.capacity = notifier.burst
+        self.max_bytes = notifier.max_bytes
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """距离下一个令牌可用的秒数"""
+        self.refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take_batch(self):
+        """取出下一条要发送的内容：未超出配额时逐条发送，排队数超过当前可用令牌时合并成摘要
+
+        返回 (通知列表, 消息内容, 标题)
+        """
+        self.tokens -= 1
+        if self.pending[0].message.get('digest'):
+            return self.take_digest()
+        if not self.digest or len(self.pending) <= self.tokens + 1:
+            notification = self.pending.popleft()
+            return [notification], truncate_utf8(notification.text, self.max_bytes), self.notifier.title(notification.message)
+
+        batch, texts = self.take_texts(lambda notification: notification.text, "超出发送频率，合并发送")
+        if len(batch) == 1:
+            return batch, truncate_utf8(batch[0].text, self.max_bytes), self.notifier.title(batch[0].message)
+        return batch, truncate_utf8(self.notifier.render_digest(texts), self.max_bytes), f"共{len(batch)}封新邮件"
+
+    def take_texts(self, render, reason, digest_only=False):
+        """从队首取出能放进一条摘要的通知，返回 (通知列表, 各自的文本)
+
+        按已取文本的字节数累加判断是否超出大小限制，不必每加一条都重新拼接整条摘要
+        """
+        notifier = self.notifier
+        separator = len(notifier.digest_separator().encode('utf-8'))
+        batch, texts, size = [], [], 0
+        # 定时摘要通知和普通通知不混在一起合并
+        while self.pending and bool(self.pending[0].message.get('digest')) == digest_only:
+            text = truncate_utf8(render(self.pending[0]), self.max_bytes // 2)
+            text_size = len(text.encode('utf-8'))
+            if texts:
+                header = len(notifier.digest_header(len(texts) + 1, reason).encode('utf-8'))
+                if header + size + separator + text_size > self.max_bytes:
+                    break
+                size += separator
+            batch.append(self.pending.popleft())
+            texts.append(text)
+            size += text_size
+        return batch, texts
+
+    def take_digest(self):
+        """过滤规则要求合并的通知：每封一行，按消息大小限制尽量多地合并成一条定时摘要"""
+        reason = "定时摘要"
+        batch, lines = self.take_texts(
+            lambda notification: self.notifier.render_brief(notification.message), reason, digest_only=True
+        )
+        return batch, truncate_utf8(self.notifier.render_digest(lines, reason), self.max_bytes), f"共{len(batch)}封新邮件（摘要）"
+
+class WebhookSender:
+    """共享的通知投递：所有渠道复用同一个HTTP连接池，邮箱检查线程只负责入队，
+    由发送线程（async模式下为事件循环上的发送协程）按各渠道的频率配额并行、带重试地投递
+    """
+    def __init__(self, workers, queue_size, outbox):
+        self.outbox = outbox
+        self.in_flight = set()  # 已在内存队列中的发件箱编号
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.slots = threading.Semaphore(queue_size)  # 限制排队中的通知总数
+        self.queue_size = queue_size
+        lock = threading.RLock()
+        self.condition = threading.Condition(lock)  # 有新通知时唤醒发送线程
+        self.room = threading.Condition(lock)  # 有通知发送完时唤醒等待空位的邮箱检查
+        self.channels = None  # {渠道地址: WebhookChannel}，首次使用时按配置创建
+        self.unfinished = 0
+        self.worker_count = workers
+        self.workers = []
+        self.stats = service_status["delivery"]
+        self.digest_at = time.monotonic() + DIGEST_INTERVAL  # 下次发送定时摘要的时间
+        self.async_mode = IO_MODE == 'async' and httpx is not None
+        if IO_MODE == 'async' and httpx is None:
+            logger.error("IO_MODE=async 需要安装httpx，通知改用发送线程投递")
+        self.loop = None  # async模式下发送协程所在的事件循环
+        self.wakeup = None
+        self.client = None
+
+    def start(self):
+        self.outbox.start()
+        with self.condition:
+            if self.channels is None:
+                self.channels = {
+                    notifier.url: WebhookChannel(notifier)
+                    for notifier in create_notifiers(config_manager.current().webhooks)
+                }
+            # async模式的发送协程由start_async在事件循环上启动
+            if self.workers or self.async_mode:
+                return
+            for i in range(self.worker_count):
+                worker = threading.Thread(target=self.run, name=f"webhook-{i}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def start_async(self):
+        """在事件循环上启动发送协程，共用一个httpx连接池；只能在事件循环中调用，重复调用无效"""
+        self.start()
+        if not self.async_mode or self.loop is not None:
+            return
+        limits = httpx.Limits(max_connections=self.worker_count, max_keepalive_connections=self.worker_count)
+        self.client = httpx.AsyncClient(limits=limits, timeout=WEBHOOK_TIMEOUT)
+        self.wakeup = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        for _ in range(self.worker_count):
+            self.workers.append(self.loop.create_task(self.run_async()))
+
+    def configure(self, webhooks):
+        """重新加载配置后按新的Webhook设置更新各渠道的频率配额和消息大小（渠道地址仍来自环境变量）"""
+        with self.condition:
+            if self.channels is None:
+                return
+            for notifier in create_notifiers(webhooks):
+                channel = self.channels.get(notifier.url)
+                if channel is not None:
+                    channel.configure(notifier)
+
+    def notifiers(self):
+        self.start()
+        return [channel.notifier for channel in self.channels.values()]
+
+    def submit(self, message, account=None, ack=None, description="", targets=None):
+        """写入发件箱并放入所有渠道的发送队列，返回是否已记录（写入发件箱）；没有任何通知渠道时返回None，
+        重试也不会成功，由调用方跳过这封邮件
+
+        队列满时最多等待ACCOUNT_TIMEOUT秒，仍然没有空位的渠道不放入内存队列，通知留在发件箱中由replay稍后投递。
+
+        邮件只解析一次，每个渠道各自渲染；所有渠道都送达后ack记入account的已投递列表，由邮箱检查时统一标记已读。
+        targets为过滤规则指定的平台名或地址，只发到这些渠道；message中带digest的通知只写入发件箱，
+        由replay每隔DIGEST_INTERVAL秒取出合并成摘要
+        """
+        self.start()
+        channels = list(self.channels.values())
+        if not channels:
+            logger.error(f"未配置通知渠道，无法转发: {description}")
+            self.stats["undeliverable"] += 1
+            return None
+        if targets:
+            routed = [
+                channel for channel in channels
+                if channel.notifier.platform in targets or channel.notifier.url in targets
+            ]
+            if routed:
+                channels = routed
+            else:
+                # 规则指定的渠道都没有配置（写错或已删除）时发到所有渠道，不让邮件卡住
+                logger.error(f"规则指定的通知渠道未配置（{', '.join(sorted(targets))}），改发到所有渠道: {description}")
+                self.stats["unrouted"] += 1
+        if message.get('digest'):
+            self.outbox.add([channel.notifier.url for channel in channels], message, account, ack, description)
+            self.stats["digested"] += 1
+            return True
+
+        # 先写入发件箱再等待队列空位；等待期间先记为在途，replay不会把它们重复放入队列
+        group_id, entry_ids = self.outbox.add(
+            [channel.notifier.url for channel in channels], message, account, ack, description
+        )
+        with self.condition:
+            self.in_flight.update(entry_ids)
+        # 格式相同的渠道共用同一个模板，每封邮件只渲染一次
+        texts = {}
+        timeout = ACCOUNT_TIMEOUT
+        for entry_id, channel in zip(entry_ids, channels):
+            # 等过一次仍没有空位就不再等待，剩下的渠道都留给replay
+            if not self.slots.acquire(timeout=timeout):
+                timeout = 0
+                with self.condition:
+                    self.in_flight.discard(entry_id)
+                self.stats["deferred"] += 1
+                logger.warning(f"发送队列已满，通知留在发件箱稍后投递: {description}")
+                continue
+            template = channel.notifier.template(message)
+            text = texts.get(template)
+            if text is None:
+                text = texts[template] = template.render(message)
+            self.enqueue(channel, Notification(entry_id, group_id, message, text, account, ack, description))
+        return True
+
+    def enqueue(self, channel, notification):
+        notification.queued_at = time.monotonic()
+        with self.condition:
+            channel.pending.append(notification)
+            self.in_flight.add(notification.entry_id)
+            self.unfinished += 1
+            self.stats["queued"] += 1
+            self.condition.notify()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def replay(self):
+        """把发件箱中未投递的通知（上次进程退出时未发完或投递失败的）重新放入队列"""
+        self.start()
+        with self.condition:
+            in_flight = set(self.in_flight)
+        replayed = 0
+        # 到时间时把积攒的摘要通知一起放入队列，take_batch会把相邻的摘要通知合并成一条
+        digest_due = time.monotonic() >= self.digest_at
+        if digest_due:
+            self.digest_at = time.monotonic() + DIGEST_INTERVAL
+        for entry_id, group_id, url, message, account, ack, description in self.outbox.pending(in_flight):
+            if message.get('digest') and not digest_due:
+                continue
+            channel = self.channels.get(url)
+            if channel is None:
+                logger.error(f"通知渠道已不在配置中，放弃投递: {description}")
+                self.outbox.remove(Notification(entry_id, group_id, message, "", account, None, description))
+                continue
+            if not self.slots.acquire(blocking=False):
+                break
+            # 定时摘要只用到每封一行的简要文本，不需要渲染完整通知
+            text = "" if message.get('digest') else channel.notifier.render(message)
+            self.enqueue(channel, Notification(entry_id, group_id, message, text, account, ack, description))
+            replayed += 1
+        if replayed:
+            self.stats["replayed"] += replayed
+            logger.info(f"重新投递发件箱中的{replayed}条通知")
+        return replayed
+
+    def post(self, notifier, body, title):
+        """发送一次，返回 (是否成功, 是否可重试, 错误信息)"""
+        url, data = notifier.build_request(body, title)
+        try:
+            with webhook_seconds.timer(platform=notifier.platform):
+                response = self.session.post(url, data=data, headers=JSON_HEADERS, timeout=WEBHOOK_TIMEOUT)
+        except requests.RequestException as e:
+            return False, True, str(e)
+        return notifier.check_response(response)
+
+    async def post_async(self, notifier, body, title):
+        """post的async版本，用httpx发送"""
+        url, data = notifier.build_request(body, title)
+        try:
+            with webhook_seconds.timer(platform=notifier.platform):
+                response = await self.client.post(url, content=data, headers=JSON_HEADERS)
+        except httpx.HTTPError as e:
+            return False, True, str(e)
+        return notifier.check_response(response)
+
+    def wait_token(self, channel):
+        """阻塞等待该渠道的下一个令牌"""
+        while True:
+            with self.condition:
+                wait = channel.wait_time()
+                if wait <= 0:
+                    channel.tokens -= 1
+                    return
+            self.stats["throttled"] += 1
+            time.sleep(wait)
+
+    async def wait_token_async(self, channel):
+        while True:
+            with self.condition:
+                wait = channel.wait_time()
+                if wait <= 0:
+                    channel.tokens -= 1
+                    return
+            self.stats["throttled"] += 1
+            await asyncio.sleep(wait)
+
+    def deliver(self, channel, body, title, token_taken=False):
+        """同步投递，可重试的错误按指数退避加随机抖动重试，返回 (是否成功, 错误信息)"""
+        error = None
+        for attempt in range(WEBHOOK_RETRIES + 1):
+            if attempt:
+                self.stats["retries"] += 1
+                delay = WEBHOOK_RETRY_DELAY * 2 ** (attempt - 1)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+            if attempt or not token_taken:
+                self.wait_token(channel)
+            # 签名带时间戳，每次重试都重新生成请求
+            success, retryable, error = self.post(channel.notifier, body, title)
+            if success:
+                return True, None
+            if not retryable:
+                break
+        return False, error
+
+    async def deliver_async(self, channel, body, title, token_taken=False):
+        """deliver的async版本，等待令牌和重试间隔时不占用线程"""
+        error = None
+        for attempt in range(WEBHOOK_RETRIES + 1):
+            if attempt:
+                self.stats["retries"] += 1
+                delay = WEBHOOK_RETRY_DELAY * 2 ** (attempt - 1)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            if attempt or not token_taken:
+                await self.wait_token_async(channel)
+            success, retryable, error = await self.post_async(channel.notifier, body, title)
+            if success:
+                return True, None
+            if not retryable:
+                break
+        return False, error
+
+    def send_now(self, text):
+        """不经过队列直接发送到所有渠道（用于测试消息），返回 [(平台, 是否成功, 错误信息)]"""
+        results = []
+        for notifier in self.notifiers():
+            success, error = self.deliver(self.channels[notifier.url], text, "测试消息")
+            results.append((notifier.platform, success, error))
+        return results
+
+    def next_batch(self):
+        """在持有锁时调用，返回 (渠道, 通知列表, 内容, 标题, 等待秒数)；都在限流中时只返回等待秒数"""
+        wait = None
+        for channel in self.channels.values():
+            if not channel.pending:
+                continue
+            channel_wait = channel.wait_time()
+            if channel_wait <= 0:
+                batch, body, title = channel.take_batch()
+                return channel, batch, body, title, 0
+            wait = channel_wait if wait is None else min(wait, channel_wait)
+        return None, None, None, None, wait
+
+    def run(self):
+        while True:
+            with self.condition:
+                channel, batch, body, title, wait = self.next_batch()
+                while channel is None:
+                    if wait is not None:
+                        self.stats["throttled"] += 1
+                    self.condition.wait(wait)
+                    channel, batch, body, title, wait = self.next_batch()
+
+            if len(batch) > 1:
+                self.stats["coalesced"] += len(batch)
+            try:
+                success, error = self.deliver(channel, body, title, token_taken=True)
+            except Exception as e:
+                success, error = False, str(e)
+            self.finish(channel, batch, success, error)
+
+    async def run_async(self):
+        while True:
+            # 先清除再取队列，取完之后入队的通知会重新唤醒
+            self.wakeup.clear()
+            with self.condition:
+                channel, batch, body, title, wait = self.next_batch()
+            if channel is None:
+                if wait is not None:
+                    self.stats["throttled"] += 1
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if len(batch) > 1:
+                self.stats["coalesced"] += len(batch)
+            try:
+                success, error = await self.deliver_async(channel, body, title, token_taken=True)
+            except Exception as e:
+                success, error = False, str(e)
+            # finish只把删除/计数交给发件箱的写线程、释放队列空位，不会阻塞，直接在事件循环上执行；
+            # 放到线程池时，线程池可能被等待队列空位的检查占满，而空位只有finish才能释放
+            self.finish(channel, batch, success, error)
+
+    def finish(self, channel, batch, success, error):
+        """记录一批通知的投递结果，成功的从发件箱删除，失败的留待重新投递"""
+        platform = channel.notifier.platform
+        description = batch[0].description if len(batch) == 1 else f"{len(batch)}封邮件的摘要"
+        if success:
+            self.stats["sent"] += len(batch)
+            self.record_delivered(batch)
+            logger.info(f"{description}发送到{platform}成功")
+        else:
+            self.stats["failed"] += len(batch)
+            logger.error(f"{description}发送到{platform}失败: {error}")
+        for notification in batch:
+            if success:
+                self.outbox.remove(notification)
+            else:
+                # 失败的通知留在发件箱，之后由replay重新投递
+                self.outbox.fail(notification)
+        with self.condition:
+            self.unfinished -= len(batch)
+            self.in_flight.difference_update(n.entry_id for n in batch)
+            self.room.notify_all()
+        for _ in batch:
+            self.slots.release()
+
+    def wait_for_room(self, count, timeout):
+        """等待发送队列能再容纳count封邮件的通知（每个渠道一条），最多等待timeout秒，返回是否有空位
+
+        邮箱检查在下载下一页邮件前调用，积压时先暂停下载，而不是把邮件都读进内存后在submit里排队
+        """
+        self.start()
+        needed = min(count * max(len(self.channels), 1), self.queue_size // 2)
+        with self.room:
+            return self.room.wait_for(lambda: self.unfinished + needed <= self.queue_size, timeout)
+
+    @staticmethod
+    def record_delivered(batch):
+        """记录入队到送达的耗时，以及从邮件Date到送达的端到端延迟"""
+        now = time.monotonic()
+        wall_now = time.time()
+        for notification in batch:
+            labels = {
+                'provider': notification.message.get('provider', ''),
+                'account': notification.message.get('account', '')
+            }
+            if notification.queued_at is not None:
+                stage_seconds.observe(now - notification.queued_at, stage='deliver', **labels)
+            received_at = notification.message.get('received_at')
+            if received_at:
+                delivery_delay.observe(max(0, wall_now - received_at), **labels)
+
+    def drain(self, timeout):
+        """等待队列中的通知发送完，最多等待timeout秒"""
+        deadline = time.monotonic() + timeout
+        while self.unfinished and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+webhook_sender = WebhookSender(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, outbox)
+
+# 已成功投递、等待下次检查时批量标记已读的邮件，按邮箱分组
+delivered_items = {}
+delivered_lock = threading.Lock()
+
+def ack_delivered(account_key, item):
+    with delivered_lock:
+        delivered_items.setdefault(account_key, []).append(item)
+
+def pop_delivered(account_key):
+    with delivered_lock:
+        return delivered_items.pop(account_key, [])
+
+def queue_notification(monitor, subject, sender, content, received_at, ack=None, rule=None):
+    """生成一封邮件的通知放入发送队列（两种邮箱共用），投递成功后ack记入本邮箱的已投递列表
+
+    返回True表示已入队；False表示暂时失败（如写入发件箱出错），下次检查重试；None表示没有通知渠道，重试也没有用
+
+    received_at为邮件接收时间的Unix时间戳；rule为命中的过滤规则：route只发到规则指定的渠道，digest合并进定时摘要。
+    这里只记录字段，通知正文由各渠道的模板在入队时渲染
+    """
+    description = f"{monitor.email_type}邮件"
+    try:
+        message = {
+            "source": monitor.provider.icon,
+            "account": monitor.email_addr,
+            "time": beijing_time(int(received_at)),
+            "sender": sender,
+            "subject": subject,
+            "content": content,
+            "provider": monitor.provider.name,
+            "received_at": received_at
+        }
+        if rule is not None and rule.action == 'digest':
+            message["digest"] = True
+        return webhook_sender.submit(
+            message,
+            monitor.account_key,
+            ack,
+            description,
+            rule.targets if rule is not None else None
+        )
+    except Exception as e:
+        logger.error(f"{description}加入发送队列时出错: {str(e)}")
+        return False
+
+def send_test_message():
+    try:
+        results = webhook_sender.send_now("这是一条测试消息，来自邮件转发机器人")
+        if not results:
+            return {"status": "error", "message": "未配置通知渠道"}
+        errors = [f"{platform}: {error}" for platform, success, error in results if not success]
+        if not errors:
+            return {"status": "success", "message": f"测试消息发送成功（{len(results)}个渠道）"}
+        else:
+            return {"status": "error", "message": f"发送失败: {'; '.join(errors)}"}
+    except Exception as e:
+        return {"status": "error", "message": f"发送出错: {str(e)}"}
+
+def chunked(items, size):
+    """按固定大小切分列表"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def chunked_by_size(sizes, limit):
+    """按累计大小切分 [(键, 大小)]，每组总大小不超过limit（单个超过limit的自成一组），返回键的列表"""
+    group, total = [], 0
+    for key, size in sizes:
+        if group and total + size > limit:
+            yield group
+            group, total = [], 0
+        group.append(key)
+        total += size
+    if group:
+        yield group
+
+def uid_set(uids):
+    """把UID列表压缩成IMAP序列集，例如 [1, 2, 3, 7] -> 1:3,7"""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+def response_size(data):
+    """imaplib响应数据的字节数（包括字面量）"""
+    size = 0
+    for item in data:
+        for part in item if isinstance(item, tuple) else (item,):
+            if isinstance(part, bytes):
+                size += len(part)
+    return size
+
+# FETCH响应词法：括号、带引号字符串、行尾的字面量长度标记、原子（含BODY[...]<n>段名）
+FETCH_TOKEN = re.compile(
+    rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|(\{\d+\})\s*$|([^\s()"\[\]]+(?:\[[^\]]*\](?:<\d+>)?)?))'
+)
+
+def fetch_tokens(data):
+    """把imaplib返回的FETCH数据（字节串和(行, 字面量)元组混合）转成词法单元"""
+    for item in data:
+        if item is None:
+            continue
+        line, literal = item if isinstance(item, tuple) else (item, None)
+        pos = 0
+        while pos < len(line):
+            match = FETCH_TOKEN.match(line, pos)
+            if match is None or match.end() == pos:
+                break
+            pos = match.end()
+            if match.group(1):
+                yield '(', None
+            elif match.group(2):
+                yield ')', None
+            elif match.group(3) is not None:
+                yield 'value', re.sub(rb'\\(.)', rb'\1', match.group(3)).decode('utf-8', errors='replace')
+            elif match.group(5):
+                atom = match.group(5).decode('utf-8', errors='replace')
+                yield 'value', None if atom.upper() == 'NIL' else atom
+        if literal is not None:
+            yield 'value', literal
+
+def parse_fetch_response(data):
+    """解析FETCH响应，返回 {UID: {数据项名: 值}}，列表解析为list，字面量保持bytes
+
+    用显式栈逐个处理词法单元，不先把所有词法单元放进列表，也不用递归闭包
+    （闭包引用自身形成循环引用，字面量要等垃圾回收才释放，积压的大邮件会让内存一直上涨）
+    """
+    results = {}
+
+    def finish(items):
+        fields = {
+            str(items[i]).upper(): items[i + 1]
+            for i in range(0, len(items) - 1, 2)
+        }
+        if fields.get('UID'):
+            results[int(fields['UID'])] = fields
+
+    stack = []  # 外层未结束的列表
+    items = None  # 当前列表，None表示在顶层（邮件序号）
+    for kind, value in fetch_tokens(data):
+        if kind == '(':
+            stack.append(items)
+            items = []
+        elif kind == ')':
+            if items is None:
+                continue
+            closed, items = items, stack.pop()
+            if items is None:
+                finish(closed)
+            else:
+                items.append(closed)
+        elif items is not None:
+            items.append(value)
+    # 响应被截断时按已读到的内容处理
+    while items is not None:
+        closed, items = items, stack.pop()
+        if items is None:
+            finish(closed)
+        else:
+            items.append(closed)
+    return results
+
+def fetch_item(fields, prefix):
+    """按名称前缀取FETCH数据项，服务器返回的段名格式可能和请求时不完全一致"""
+    for name, value in fields.items():
+        if name.startswith(prefix):
+            return value
+    return None
+
+def text_part_candidates(structure, section=''):
+    """按顺序列出BODYSTRUCTURE中非附件的text部分，每项为 (段号, 子类型, 传输编码, 字符集)"""
+    if not isinstance(structure, list) or not structure:
+        return
+    if isinstance(structure[0], list):
+        # multipart：子部分在前，之后是子类型和扩展数据
+        index = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            index += 1
+            yield from text_part_candidates(child, f"{section}.{index}" if section else str(index))
+        return
+
+    if str(structure[0]).lower() != 'text':
+        return
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and str(disposition[0]).lower() == 'attachment':
+        return
+    params = structure[2] if isinstance(structure[2], list) else []
+    charset = None
+    for i in range(0, len(params) - 1, 2):
+        if str(params[i]).lower() == 'charset':
+            charset = params[i + 1]
+            charset = charset.decode(errors='replace') if isinstance(charset, bytes) else charset
+    # 单部分邮件的正文段号为1
+    yield section or '1', str(structure[1]).lower(), structure[5], charset
+
+def find_text_part(structure):
+    """在BODYSTRUCTURE中找正文：优先第一个text/plain，没有时取第一个text/html
+
+    返回 (段号, 子类型, 传输编码, 字符集)，找不到时返回None
+    """
+    html_part = None
+    for part in text_part_candidates(structure):
+        if part[1] == 'plain':
+            return part
+        if part[1] == 'html' and html_part is None:
+            html_part = part
+    return html_part
+
+# GB2312/GBK声明的邮件里常有超出其范围的字符，统一按超集GB18030解码
+CHARSET_ALIASES = {
+    'gb2312': 'gb18030',
+    'gbk': 'gb18030',
+    'x-gbk': 'gb18030',
+    'cp936': 'gb18030',
+    'ks_c_5601-1987': 'cp949'
 }
 
-# 邮箱配置
-def get_email_configs():
-    configs = {
-        'gmail': [],
-        'qq': [],
-        'outlook': []
-    }
-    
-    # Gmail配置
-    gmail_emails = os.getenv('GMAIL_EMAILS', '').split(',')
-    gmail_passwords = os.getenv('GMAIL_PASSWORDS', '').split(',')
-    for email, password in zip(gmail_emails, gmail_passwords):
-        if email and password:
-            configs['gmail'].append({
-                'email': email.strip(),
-                'password': password.strip()
-            })
-    
-    # QQ邮箱配置
-    qq_emails = os.getenv('QQ_EMAILS', '').split(',')
-    qq_passwords = os.getenv('QQ_PASSWORDS', '').split(',')
-    for email, password in zip(qq_emails, qq_passwords):
-        if email and password:
-            configs['qq'].append({
-                'email': email.strip(),
-                'password': password.strip()
-            })
-    
-    # Outlook配置
-    outlook_emails = os.getenv('OUTLOOK_EMAILS', '').split(',')
-    outlook_passwords = os.getenv('OUTLOOK_PASSWORDS', '').split(',')
-    for email, password in zip(outlook_emails, outlook_passwords):
-        if email and password:
-            configs['outlook'].append({
-                'email': email.strip(),
-                'password': password.strip()
-            })
-    
-    return configs
+def decode_part(raw, encoding, charset):
+    """按传输编码和字符集解码（可能被截断的）正文片段"""
+    encoding = (encoding or '7bit').lower()
+    if encoding == 'base64':
+        data = b''.join(raw.split())
+        raw = base64.b64decode(data[:len(data) // 4 * 4])
+    elif encoding == 'quoted-printable':
+        raw = quopri.decodestring(raw)
+
+    charset = (charset or '').strip().strip('"').lower()
+    charset = CHARSET_ALIASES.get(charset, charset)
+    if charset in ('', 'us-ascii', 'ascii'):
+        # 未声明（或声明成ASCII）时先按UTF-8解码，明显不是UTF-8时按GB18030
+        try:
+            return raw.decode('utf-8')
+        except UnicodeDecodeError as e:
+            if e.start >= len(raw) - 3:
+                # 截断在多字节字符中间
+                return raw[:e.start].decode('utf-8')
+            return raw.decode('gb18030', errors='replace')
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+# HTML转纯文本：去掉脚本、样式、注释，块级标签换行，其余标签删除；截断处未闭合的标签也一并去掉
+HTML_HIDDEN = re.compile(r'<(script|style|head|title)\b.*?(?:</\1\s*>|$)|<!--.*?(?:-->|$)', re.I | re.S)
+HTML_BREAK = re.compile(r'<\s*(?:br|hr|/p|/div|/tr|/li|/h[1-6]|/table|/blockquote)\b[^>]*>', re.I)
+HTML_TAG = re.compile(r'<[^>]*(?:>|$)')
+HTML_SPACES = re.compile(r'[ \t\r\f\v\xa0\u200b]+')
+
+def html_to_text(html):
+    """把HTML粗略转换成纯文本，只处理前HTML_PREVIEW_BYTES个字符，耗时与邮件大小无关"""
+    html = html[:HTML_PREVIEW_BYTES]
+    html = HTML_HIDDEN.sub('', html)
+    html = HTML_BREAK.sub('\n', html)
+    text = unescape(HTML_TAG.sub('', html))
+    lines = (HTML_SPACES.sub(' ', line).strip() for line in text.split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+def preview_text(raw, subtype, encoding, charset):
+    """把（可能被截断的）正文原文解码成通知中的预览"""
+    text = decode_part(raw, encoding, charset)
+    if subtype == 'html':
+        text = html_to_text(text)
+    # 截断处不完整的字符会被解码成替换字符
+    return text.strip().rstrip('\ufffd')[:PREVIEW_CHARS]
+
+def preview_bytes(subtype):
+    """正文预览最多下载/解码的字节数，HTML标签多，预算更大"""
+    return HTML_PREVIEW_BYTES if subtype == 'html' else PREVIEW_BYTES
+
+def preview_source(email_message):
+    """从完整邮件中取生成预览需要的正文开头：优先text/plain，没有时取text/html
+
+    返回 (正文原文的开头, 子类型, 传输编码, 字符集)，交给preview_text解码；没有正文时返回None。
+    只遍历MIME结构，不解码附件，正文也只截取预览需要的前几KB
+    """
+    html_part = None
+    for part in email_message.walk():
+        if part.is_multipart() or part.get_content_maintype() != 'text':
+            continue
+        if part.get_content_disposition() == 'attachment':
+            continue
+        if part.get_content_subtype() == 'plain':
+            break
+        if part.get_content_subtype() == 'html' and html_part is None:
+            html_part = part
+    else:
+        part = html_part
+    if part is None:
+        return None
+    subtype = part.get_content_subtype()
+    budget = preview_bytes(subtype)
+    encoding = (part.get('Content-Transfer-Encoding') or '7bit').strip().lower()
+    if encoding in ('base64', 'quoted-printable'):
+        # 只截取编码后原文的开头部分解码，不解码整个正文
+        raw = part.get_payload(decode=False)
+        if not isinstance(raw, str):
+            return None
+        raw = raw.encode('ascii', errors='ignore')
+        if encoding == 'base64':
+            budget = budget * 4 // 3 + 4
+    else:
+        # 7bit/8bit正文原样返回字节
+        raw = part.get_payload(decode=True) or b''
+    return raw[:budget], subtype, encoding, part.get_content_charset()
+
+class CheckpointStore:
+    """保存每个邮箱文件夹的同步位置：IMAP为UIDVALIDITY和最后处理的UID，EWS为同步状态"""
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "account TEXT NOT NULL, folder TEXT NOT NULL, "
+            "uidvalidity INTEGER, last_uid INTEGER, sync_state TEXT, updated_at REAL, "
+            "PRIMARY KEY (account, folder))"
+        )
+        self.db.commit()
+
+    def get(self, account, folder='INBOX'):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT uidvalidity, last_uid, sync_state FROM checkpoints "
+                "WHERE account = ? AND folder = ?",
+                (account, folder)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"uidvalidity": row[0], "last_uid": row[1], "sync_state": row[2]}
+
+    def save_uid(self, account, uidvalidity, last_uid, folder='INBOX'):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO checkpoints "
+                "(account, folder, uidvalidity, last_uid, sync_state, updated_at) "
+                "VALUES (?, ?, ?, ?, NULL, ?)",
+                (account, folder, uidvalidity, last_uid, time.time())
+            )
+            self.db.commit()
+
+    def save_sync_state(self, account, sync_state, folder='INBOX'):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO checkpoints "
+                "(account, folder, uidvalidity, last_uid, sync_state, updated_at) "
+                "VALUES (?, ?, NULL, NULL, ?, ?)",
+                (account, folder, sync_state, time.time())
+            )
+            self.db.commit()
+
+checkpoint_store = CheckpointStore(STATE_DB)
+
+def dedup_key(message_id, sender, subject, date):
+    """去重键：优先用Message-ID，没有时用发件人、主题和Date的哈希（此时还没有下载正文）"""
+    message_id = (message_id or '').strip().strip('<>').strip()
+    if message_id:
+        return f"id:{message_id}"
+    digest = hashlib.sha1(f"{sender}\n{subject}\n{date}".encode('utf-8', errors='replace')).hexdigest()
+    return f"hash:{digest}"
+
+class DedupIndex:
+    """所有邮箱共用的已通知邮件索引，按TTL过期，内存中按LRU淘汰，可选把淘汰的记录写入SQLite
+
+    shared为True（多进程分片）时每条新记录都直接写入SQLite，由数据库保证多个进程中只有一个能认领同一封邮件
+    """
+    def __init__(self, ttl, max_entries, spill_path=None, shared=False):
+        self.ttl = ttl
+        self.shared = shared
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {去重键: 过期时间}
+        self.lock = threading.Lock()
+        self.db = None
+        self.purged_at = 0
+        if spill_path:
+            self.db = sqlite3.connect(spill_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+            )
+            self.db.commit()
+
+    def claim(self, key):
+        """第一次见到该邮件时记录并返回True，重复的返回False
+
+        同一个邮箱重新处理时（检查出错后从上次的同步位置继续）也返回False，已经入队的邮件不会再发一次；
+        没能入队的邮件由调用方forget撤销记录，下次检查照常处理
+        """
+        if self.ttl <= 0:
+            return True
+        now = time.time()
+        with self.lock:
+            expires_at = self.entries.get(key)
+            if expires_at is not None and expires_at > now:
+                self.entries.move_to_end(key)
+                return False
+            if self.shared:
+                cursor = self.db.execute(
+                    "INSERT INTO dedup (key, expires_at) VALUES (?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET expires_at = excluded.expires_at "
+                    "WHERE dedup.expires_at <= ?",
+                    (key, now + self.ttl, now)
+                )
+                self.db.commit()
+                if not cursor.rowcount:
+                    self.entries[key] = now + self.ttl
+                    return False
+            elif expires_at is None and self.db is not None:
+                row = self.db.execute("SELECT expires_at FROM dedup WHERE key = ?", (key,)).fetchone()
+                if row and row[0] > now:
+                    return False
+            self.entries[key] = now + self.ttl
+            self.entries.move_to_end(key)
+            self.evict(now)
+        return True
+
+    def forget(self, *keys):
+        """通知没能入队时撤销记录，本邮箱下次检查或其他邮箱里的同一封邮件仍可转发"""
+        if not keys:
+            return
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+            if self.db is not None:
+                self.db.executemany("DELETE FROM dedup WHERE key = ?", [(key,) for key in keys])
+                self.db.commit()
+
+    def evict(self, now):
+        """持有锁时调用：超出上限时淘汰最久未用的记录，开启落盘时写入SQLite"""
+        spilled = []
+        while len(self.entries) > self.max_entries:
+            key, expires_at = self.entries.popitem(last=False)
+            if expires_at > now:
+                spilled.append((key, expires_at))
+        if self.db is None:
+            return
+        if spilled:
+            self.db.executemany("INSERT OR REPLACE INTO dedup (key, expires_at) VALUES (?, ?)", spilled)
+        # 每小时清理一次过期记录
+        if now - self.purged_at > 3600:
+            self.db.execute("DELETE FROM dedup WHERE expires_at <= ?", (now,))
+            self.purged_at = now
+        elif not spilled:
+            return
+        self.db.commit()
+
+dedup_index = DedupIndex(
+    DEDUP_TTL, DEDUP_MAX_ENTRIES, STATE_DB if DEDUP_SPILL or SHARDING else None, SHARDING
+)
+
+def reconnect_delay(failures):
+    """指数退避加随机抖动的重连等待时间"""
+    delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** max(failures - 1, 0))
+    return delay * random.uniform(0.5, 1.0)
+
+def open_imap(provider, email_addr, password):
+    """建立IMAP连接、登录并选中收件箱"""
+    imap_class = imaplib.IMAP4_SSL if provider.ssl else imaplib.IMAP4
+    imap = imap_class(provider.host, provider.port, timeout=NETWORK_TIMEOUT)
+    try:
+        imap.login(email_addr, password)
+        if provider.imap_id:
+            # 网易邮箱要求登录后先发送ID表明客户端身份，否则SELECT会返回Unsafe Login
+            imap._simple_command('ID', '("name" "mail-forwarder" "version" "1.0.0")')
+        imap.select('INBOX')
+        _, data = imap.response('UIDVALIDITY')
+        imap.uidvalidity = int(data[0]) if data and data[0] else 0
+    except Exception:
+        try:
+            imap.shutdown()
+        except:
+            pass
+        raise
+    service_status["imap_connections"]["logins"] += 1
+    return imap
+
+class IMAPSession:
+    """单个邮箱的长连接，断线后按退避时间重连"""
+    def __init__(self, provider, email_addr, password):
+        self.provider = provider
+        self.email_addr = email_addr
+        self.password = password
+        self.lock = threading.Lock()
+        self.imap = None
+        self.failures = 0
+        self.next_retry = 0
+        self.stale = False  # 邮箱配置已修改，下次获取时重建
+
+    def ensure(self):
+        """返回可用的连接，已有连接先用NOOP确认仍然有效"""
+        if self.imap is not None:
+            try:
+                self.imap.noop()
+                # 长连接上NOOP返回的EXISTS/RECENT等未读取的响应会一直累积，这里清掉
+                self.imap.untagged_responses.clear()
+                service_status["imap_connections"]["reused"] += 1
+                return self.imap
+            except Exception as e:
+                logger.info(f"IMAP连接已断开，准备重连 {self.email_addr}: {str(e)}")
+                self.close()
+                service_status["imap_connections"]["reconnects"] += 1
+
+        if time.monotonic() < self.next_retry:
+            raise ConnectionError(f"重连退避中，{self.next_retry - time.monotonic():.0f}秒后重试")
+        try:
+            self.imap = open_imap(self.provider, self.email_addr, self.password)
+            self.failures = 0
+            return self.imap
+        except Exception:
+            self.failures += 1
+            self.next_retry = time.monotonic() + reconnect_delay(self.failures)
+            raise
+
+    def close(self):
+        if self.imap is None:
+            return
+        try:
+            self.imap.logout()
+        except:
+            pass
+        self.imap = None
+
+class IMAPConnectionPool:
+    """按 (服务器, 邮箱) 保存已登录的IMAP会话，避免每次检查都重新握手登录"""
+    session_class = IMAPSession
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def _session(self, provider, email_addr, password):
+        key = (provider.host, email_addr)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or session.stale or session.password != password:
+                if session is not None:
+                    session.close()
+                session = self.session_class(provider, email_addr, password)
+                self.sessions[key] = session
+            return session
+
+    def acquire(self, provider, email_addr, password):
+        """独占获取邮箱连接，用完必须调用release"""
+        session = self._session(provider, email_addr, password)
+        if not session.lock.acquire(timeout=ACCOUNT_TIMEOUT):
+            raise TimeoutError("等待IMAP连接超时")
+        try:
+            return session.ensure()
+        except Exception:
+            session.lock.release()
+            raise
+
+    def release(self, imap_server, email_addr):
+        session = self.sessions.get((imap_server, email_addr))
+        if session is not None and session.lock.locked():
+            session.lock.release()
+
+    def discard(self, host, email_addr):
+        """邮箱从配置中删除或修改后关闭它的连接；正在检查中的连接标记为过期，下次获取时重建"""
+        with self.lock:
+            session = self.sessions.get((host, email_addr))
+            if session is None:
+                return
+            if session.lock.locked():
+                session.stale = True
+                return
+            del self.sessions[(host, email_addr)]
+        session.close()
+
+    def close_all(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+imap_pool = IMAPConnectionPool()
+
+class IdleWatcher(threading.Thread):
+    """用IMAP IDLE监听新邮件，收到EXISTS推送后立即触发该邮箱的检查"""
+    def __init__(self, provider, email_addr, password, on_new_mail):
+        super().__init__(name=f"idle-{email_addr}", daemon=True)
+        self.provider = provider
+        self.email_addr = email_addr
+        self.password = password
+        self.on_new_mail = on_new_mail
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        failures = 0
+        while not self.stop_event.is_set():
+            imap = None
+            try:
+                imap = open_imap(self.provider, self.email_addr, self.password)
+                if 'IDLE' not in imap.capabilities:
+                    logger.info(f"{self.email_addr} 的服务器不支持IDLE，使用轮询")
+                    return
+                failures = 0
+                logger.info(f"开始IDLE监听: {self.email_addr}")
+                while not self.stop_event.is_set():
+                    if self.idle_once(imap):
+                        self.on_new_mail()
+            except Exception as e:
+                failures += 1
+                delay = reconnect_delay(failures)
+                logger.error(f"IDLE监听 {self.email_addr} 出错，{delay:.0f}秒后重连: {str(e)}")
+                self.stop_event.wait(delay)
+            finally:
+                if imap is not None:
+                    try:
+                        imap.logout()
+                    except:
+                        pass
+
+    def idle_once(self, imap):
+        """进入一次IDLE，直到收到新邮件或到达续期时间，返回是否有新邮件"""
+        tag = imap._new_tag()
+        imap.tagged_commands.pop(tag, None)
+        imap.send(tag + b' IDLE\r\n')
+        response = imap.readline()
+        if not response.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE失败: {response!r}")
+
+        has_new_mail = False
+        deadline = time.monotonic() + IDLE_REFRESH
+        while not has_new_mail and not self.stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # 每隔几秒检查一次停止标志；imaplib读缓冲和SSL层已缓存的数据select看不到，需要先检查
+            if not imap_buffered(imap):
+                readable, _, _ = select.select([imap.sock], [], [], min(remaining, 5))
+                if not readable:
+                    continue
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("IDLE连接被服务器关闭")
+            if line.startswith(b'*') and line.rstrip().endswith(b'EXISTS'):
+                has_new_mail = True
+
+        imap.send(b'DONE\r\n')
+        while True:
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("IDLE连接被服务器关闭")
+            if line.startswith(tag):
+                break
+        return has_new_mail
+
+def imap_buffered(imap):
+    """imaplib的读缓冲或SSL层中是否已有数据：和+ idling一起到达的EXISTS会留在缓冲里，select看不到"""
+    if getattr(imap.sock, 'pending', lambda: 0)():
+        return True
+    # 临时改成非阻塞，缓冲为空时peek也不会等待网络
+    timeout = imap.sock.gettimeout()
+    imap.sock.settimeout(0)
+    try:
+        return bool(imap.file.peek(1))
+    except (ssl.SSLWantReadError, BlockingIOError):
+        return False
+    finally:
+        imap.sock.settimeout(timeout)
+
+IMAP_LITERAL = re.compile(rb'\{(\d+)\}$')
+
+class AsyncIMAP:
+    """基于asyncio流的IMAP客户端，只实现检查邮件和IDLE监听用到的命令，每个连接只占用一个socket和少量缓冲
+
+    uid()的返回值与imaplib相同（带字面量的数据为 (行, 字面量) 元组），可以直接交给parse_fetch_response解析
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.tag_prefix = ''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4))
+        self.tag_number = 0
+        self.capabilities = ()
+        self.uidvalidity = 0
+
+    @classmethod
+    async def open(cls, provider, email_addr, password):
+        """建立连接、登录并选中收件箱"""
+        # 与imaplib.IMAP4_SSL一样不校验服务器证书；单行最长8MB（UID很多时SEARCH结果在一行中返回）
+        ssl_context = ssl._create_stdlib_context() if provider.ssl else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(provider.host, provider.port, ssl=ssl_context, limit=2 ** 23),
+            NETWORK_TIMEOUT
+        )
+        imap = cls(reader, writer)
+        try:
+            greeting = await imap.readline()
+            if not greeting.startswith((b'* OK', b'* PREAUTH')):
+                raise imaplib.IMAP4.error(f"IMAP服务器拒绝连接: {greeting!r}")
+            await imap.command('LOGIN', imap.quote(email_addr), imap.quote(password))
+            untagged = await imap.command('CAPABILITY')
+            imap.capabilities = tuple(
+                (untagged.get('CAPABILITY') or [b''])[0].decode('ascii', errors='replace').upper().split()
+            )
+            if provider.imap_id:
+                # 网易邮箱要求登录后先发送ID表明客户端身份，否则SELECT会返回Unsafe Login
+                await imap.command('ID', '("name" "mail-forwarder" "version" "1.0.0")')
+            untagged = await imap.command('SELECT', 'INBOX')
+            for line in untagged.get('OK', []):
+                match = re.search(rb'\[UIDVALIDITY (\d+)\]', line if isinstance(line, bytes) else line[0])
+                if match:
+                    imap.uidvalidity = int(match.group(1))
+        except BaseException:
+            imap.close()
+            raise
+        service_status["imap_connections"]["logins"] += 1
+        return imap
+
+    @staticmethod
+    def quote(text):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    def next_tag(self):
+        self.tag_number += 1
+        return f"{self.tag_prefix}{self.tag_number}".encode()
+
+    async def send(self, data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), NETWORK_TIMEOUT)
+
+    async def readline(self):
+        line = await asyncio.wait_for(self.reader.readline(), NETWORK_TIMEOUT)
+        if not line:
+            raise imaplib.IMAP4.abort("IMAP连接被服务器关闭")
+        return line
+
+    async def read_response(self):
+        """读取一条完整的响应，返回数据项列表：普通行为bytes，带字面量的行为 (行, 字面量)"""
+        items = []
+        while True:
+            line = (await self.readline()).rstrip(b'\r\n')
+            match = IMAP_LITERAL.search(line)
+            if match is None:
+                items.append(line)
+                return items
+            literal = await asyncio.wait_for(self.reader.readexactly(int(match.group(1))), NETWORK_TIMEOUT)
+            items.append((line, literal))
+
+    @staticmethod
+    def untagged(line):
+        """把“类型 数据”或“序号 类型 数据”拆成 (类型, 数据)，数据格式与imaplib一致（序号放在最前面）"""
+        first, _, rest = line.partition(b' ')
+        if first.isdigit():
+            kind, _, data = rest.partition(b' ')
+            return kind.decode('ascii', errors='replace').upper(), first + b' ' + data if data else first
+        return first.decode('ascii', errors='replace').upper(), rest
+
+    async def command(self, name, *args):
+        """发送命令并读到它的结束响应，返回 {类型: [数据]}，结果不是OK时抛出异常"""
+        tag = self.next_tag()
+        words = [name] + [arg for arg in args if arg is not None]
+        await self.send(tag + b' ' + ' '.join(words).encode('utf-8') + b'\r\n')
+        untagged = {}
+        while True:
+            items = await self.read_response()
+            head = items[0][0] if isinstance(items[0], tuple) else items[0]
+            if head.startswith(tag + b' '):
+                status, _, text = head[len(tag) + 1:].partition(b' ')
+                if status.upper() != b'OK':
+                    raise imaplib.IMAP4.error(f"{name}失败: {text.decode('utf-8', errors='replace')}")
+                return untagged
+            if not head.startswith(b'* '):
+                continue  # 之前被中断的命令留下的响应
+            kind, data = self.untagged(head[2:])
+            if kind == 'BYE':
+                raise imaplib.IMAP4.abort(f"IMAP服务器断开连接: {data.decode('utf-8', errors='replace')}")
+            items[0] = (data, items[0][1]) if isinstance(items[0], tuple) else data
+            untagged.setdefault(kind, []).extend(items)
+
+    async def uid(self, command, *args):
+        """与imaplib的uid()相同，返回 (结果, 数据列表)"""
+        untagged = await self.command('UID', command, *args)
+        kind = 'FETCH' if command.upper() in ('FETCH', 'STORE') else command.upper()
+        return 'OK', untagged.get(kind) or [None]
+
+    async def noop(self):
+        await self.command('NOOP')
+
+    async def idle(self, timeout):
+        """进入一次IDLE，直到收到新邮件或经过timeout秒，返回是否有新邮件"""
+        tag = self.next_tag()
+        await self.send(tag + b' IDLE\r\n')
+        response = await self.readline()
+        if not response.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE失败: {response!r}")
+
+        has_new_mail = False
+        deadline = time.monotonic() + timeout
+        while not has_new_mail:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not line:
+                raise imaplib.IMAP4.abort("IDLE连接被服务器关闭")
+            if line.startswith(b'*') and line.rstrip().endswith(b'EXISTS'):
+                has_new_mail = True
+
+        await self.send(b'DONE\r\n')
+        while not (await self.readline()).startswith(tag + b' '):
+            pass
+        return has_new_mail
+
+    def close(self):
+        """发送LOGOUT后直接关闭连接，不等待服务器响应"""
+        if self.writer.is_closing():
+            return
+        try:
+            self.writer.write(self.next_tag() + b' LOGOUT\r\n')
+        except Exception:
+            pass
+        self.writer.close()
+
+class AsyncIMAPSession(IMAPSession):
+    """async模式下单个邮箱的长连接，断线后按退避时间重连"""
+    def __init__(self, provider, email_addr, password):
+        super().__init__(provider, email_addr, password)
+        self.lock = asyncio.Lock()
+
+    async def ensure(self):
+        """返回可用的连接，已有连接先用NOOP确认仍然有效"""
+        if self.imap is not None:
+            try:
+                await self.imap.noop()
+                service_status["imap_connections"]["reused"] += 1
+                return self.imap
+            except Exception as e:
+                logger.info(f"IMAP连接已断开，准备重连 {self.email_addr}: {str(e)}")
+                self.close()
+                service_status["imap_connections"]["reconnects"] += 1
+
+        if time.monotonic() < self.next_retry:
+            raise ConnectionError(f"重连退避中，{self.next_retry - time.monotonic():.0f}秒后重试")
+        try:
+            self.imap = await AsyncIMAP.open(self.provider, self.email_addr, self.password)
+            self.failures = 0
+            return self.imap
+        except Exception:
+            self.failures += 1
+            self.next_retry = time.monotonic() + reconnect_delay(self.failures)
+            raise
+
+    def close(self):
+        if self.imap is None:
+            return
+        self.imap.close()
+        self.imap = None
+
+class AsyncIMAPConnectionPool(IMAPConnectionPool):
+    """async模式的IMAP连接池，等待连接时不占用线程"""
+    session_class = AsyncIMAPSession
+
+    async def acquire(self, provider, email_addr, password):
+        """独占获取邮箱连接，用完必须调用release"""
+        session = self._session(provider, email_addr, password)
+        try:
+            await asyncio.wait_for(session.lock.acquire(), ACCOUNT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise TimeoutError("等待IMAP连接超时")
+        try:
+            return await session.ensure()
+        except BaseException:
+            session.lock.release()
+            raise
+
+    def release(self, imap_server, email_addr, discard=False):
+        session = self.sessions.get((imap_server, email_addr))
+        if session is None or not session.lock.locked():
+            return
+        if discard:
+            session.close()
+        session.lock.release()
+
+async_imap_pool = AsyncIMAPConnectionPool()
+
+class AsyncIdleWatcher:
+    """async模式下的IDLE监听，运行在事件循环上，不占用线程；接口与IdleWatcher相同"""
+    def __init__(self, provider, email_addr, password, on_new_mail):
+        self.provider = provider
+        self.email_addr = email_addr
+        self.password = password
+        self.on_new_mail = on_new_mail
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def is_alive(self):
+        return self.task is not None and not self.task.done()
+
+    async def run(self):
+        failures = 0
+        while True:
+            imap = None
+            try:
+                imap = await AsyncIMAP.open(self.provider, self.email_addr, self.password)
+                if 'IDLE' not in imap.capabilities:
+                    logger.info(f"{self.email_addr} 的服务器不支持IDLE，使用轮询")
+                    return
+                failures = 0
+                logger.info(f"开始IDLE监听: {self.email_addr}")
+                while True:
+                    if await imap.idle(IDLE_REFRESH):
+                        self.on_new_mail()
+            except Exception as e:
+                failures += 1
+                delay = reconnect_delay(failures)
+                logger.error(f"IDLE监听 {self.email_addr} 出错，{delay:.0f}秒后重连: {str(e)}")
+                await asyncio.sleep(delay)
+            finally:
+                if imap is not None:
+                    imap.close()
+
+class EWSSession:
+    """单个Outlook邮箱的exchangelib Account，复用其中的HTTP连接和已查询到的收件箱"""
+    def __init__(self, provider, email_addr, password):
+        self.provider = provider
+        self.email_addr = email_addr
+        self.password = password
+        self.lock = threading.Lock()  # 检查期间独占
+        self.create_lock = threading.Lock()  # 只在建立Account时持有，通知监听线程不用等检查结束
+        self.account = None
+        self.stale = False  # 邮箱配置已修改，下次获取时重建
+
+    def ensure(self):
+        account = self.account
+        if account is not None:
+            return account
+        with self.create_lock:
+            if self.account is None:
+                credentials = Credentials(self.email_addr, self.password)
+                # 两个连接：一个给检查，一个给流式通知的长连接
+                config = Configuration(credentials=credentials, server=self.provider.host, max_connections=2)
+                self.account = Account(
+                    primary_smtp_address=self.email_addr,
+                    config=config,
+                    access_type=DELEGATE
+                )
+            return self.account
+
+    def close(self):
+        """关闭HTTP连接；同一邮箱的Account共用exchangelib缓存的Protocol，所以只在退出时调用"""
+        if self.account is None:
+            return
+        try:
+            self.account.protocol.close()
+        except:
+            pass
+        self.account = None
+
+class EWSAccountPool:
+    """按 (服务器, 邮箱) 缓存Account，避免每次检查都重新建立EWS会话"""
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def _session(self, provider, email_addr, password):
+        key = (provider.host, email_addr)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or session.stale or session.password != password:
+                session = EWSSession(provider, email_addr, password)
+                self.sessions[key] = session
+            return session
+
+    def get(self, provider, email_addr, password):
+        """不等待检查占用的会话锁获取Account，供通知监听线程使用；Account的连接池本身可以多线程共用"""
+        return self._session(provider, email_addr, password).ensure()
+
+    def acquire(self, provider, email_addr, password):
+        """独占获取邮箱的Account，同一邮箱不会被并发检查，用完必须调用release"""
+        session = self._session(provider, email_addr, password)
+        if not session.lock.acquire(timeout=ACCOUNT_TIMEOUT):
+            raise TimeoutError("等待Outlook会话超时")
+        try:
+            return session.ensure()
+        except Exception:
+            session.lock.release()
+            raise
+
+    def release(self, provider, email_addr, discard=False):
+        """释放邮箱会话，discard为True时丢弃Account，下次检查重新建立"""
+        session = self.sessions.get((provider.host, email_addr))
+        if session is None or not session.lock.locked():
+            return
+        if discard:
+            session.account = None
+        session.lock.release()
+
+    def discard(self, host, email_addr):
+        """邮箱从配置中删除或修改后关闭它的会话；正在检查中的会话标记为过期，下次获取时重建"""
+        with self.lock:
+            session = self.sessions.get((host, email_addr))
+            if session is None:
+                return
+            if session.lock.locked():
+                session.stale = True
+                return
+            del self.sessions[(host, email_addr)]
+        session.close()
+
+    def close_all(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+ews_pool = EWSAccountPool()
+
+class EWSWatcher(threading.Thread):
+    """用EWS流式或拉取通知监听收件箱，收到新邮件事件后立即触发该邮箱的检查"""
+    def __init__(self, provider, email_addr, password, on_new_mail, mode):
+        super().__init__(name=f"ews-{email_addr}", daemon=True)
+        self.provider = provider
+        self.email_addr = email_addr
+        self.password = password
+        self.on_new_mail = on_new_mail
+        self.mode = mode  # streaming 或 pull
+        self.stop_event = threading.Event()
 
-app = FastAPI()
+    def stop(self):
+        self.stop_event.set()
 
-# API密钥验证
-API_KEY_NAME = "X-API-Key"
-api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
+    def run(self):
+        failures = 0
+        while not self.stop_event.is_set():
+            inbox = subscription_id = None
+            try:
+                inbox = ews_pool.get(self.provider, self.email_addr, self.password).inbox
+                if self.mode == 'pull':
+                    # 订阅在超时时间内没有GetEvents请求会被服务器删除
+                    timeout = max(10, int(EWS_PULL_INTERVAL / 60) * 2 + 1)
+                    subscription_id, watermark = inbox.subscribe_to_pull(
+                        event_types=EWS_EVENT_TYPES, timeout=timeout
+                    )
+                else:
+                    subscription_id = inbox.subscribe_to_streaming(event_types=EWS_EVENT_TYPES)
+                failures = 0
+                logger.info(f"开始EWS {self.mode}通知监听: {self.email_addr}")
+                if self.mode == 'pull':
+                    self.pull(inbox, subscription_id, watermark)
+                else:
+                    self.stream(inbox, subscription_id)
+            except Exception as e:
+                failures += 1
+                delay = reconnect_delay(failures)
+                logger.error(f"EWS通知监听 {self.email_addr} 出错，{delay:.0f}秒后重连: {str(e)}")
+                self.stop_event.wait(delay)
+            finally:
+                if subscription_id is not None:
+                    try:
+                        inbox.unsubscribe(subscription_id)
+                    except:
+                        pass
 
-async def get_api_key(api_key_header: str = Security(api_key_header)):
-    if api_key_header == os.getenv("API_KEY"):
-        return api_key_header
-    raise HTTPException(
-        status_code=403,
-        detail="无效的API密钥"
-    )
+    @staticmethod
+    def has_new_mail(notification):
+        return any(isinstance(event, (NewMailEvent, CreatedEvent)) for event in notification.events)
 
-def update_service_status(success: bool, error_message: str = None):
-    """更新服务状态"""
-    service_status["last_check_time"] = datetime.now(beijing_tz).strftime("%Y-%m-%d %H:%M:%S")
-    
-    if success:
-        service_status["last_check_status"] = "成功"
-        service_status["consecutive_errors"] = 0
-    else:
-        service_status["last_check_status"] = f"失败: {error_message}"
-        service_status["error_count"] += 1
-        service_status["consecutive_errors"] += 1
+    def stream(self, inbox, subscription_id):
+        # 每条流式连接最长保持connection_timeout分钟，之后重新发起GetStreamingEvents
+        minutes = max(1, min(30, IDLE_REFRESH // 60))
+        while not self.stop_event.is_set():
+            for notification in inbox.get_streaming_events(subscription_id, connection_timeout=minutes):
+                if self.has_new_mail(notification):
+                    self.on_new_mail()
+                if self.stop_event.is_set():
+                    break
 
-def send_test_message():
-    webhook_url = os.getenv('WEIXIN_WEBHOOK')
-    try:
-        message = {
-            "msgtype": "text",
-            "text": {
-                "content": "这是一条测试消息，来自邮件转发机器人",
-                "mentioned_list": ["@all"]
-            }
-        }
-        response = requests.post(webhook_url, json=message)
-        if response.status_code == 200:
-            return {"status": "success", "message": "测试消息发送成功"}
-        else:
-            return {"status": "error", "message": f"发送失败: {response.text}"}
-    except Exception as e:
-        return {"status": "error", "message": f"发送出错: {str(e)}"}
+    def pull(self, inbox, subscription_id, watermark):
+        while not self.stop_event.wait(EWS_PULL_INTERVAL):
+            new_mail = False
+            for notification in inbox.get_events(subscription_id, watermark):
+                new_mail = new_mail or self.has_new_mail(notification)
+                for event in notification.events:
+                    watermark = event.watermark or watermark
+            if new_mail:
+                self.on_new_mail()
 
 class EmailMonitor:
-    def __init__(self, email_addr, password, imap_server, email_type):
+    def __init__(self, email_addr, password, provider):
         self.email_addr = email_addr
         self.password = password
-        self.imap_server = imap_server
-        self.email_type = email_type  # 'Gmail' 或 'QQ'
-        self.weixin_webhook = os.getenv('WEIXIN_WEBHOOK')
+        self.provider = provider
+        self.imap_server = provider.host
+        self.email_type = provider.label  # 日志中显示的服务商名称，如 'Gmail'、'QQ'
         self.last_check_time = datetime.now(beijing_tz)
+        self.last_error = None
+        self.backlog = False  # 本次检查是否还有积压的邮件留给下一次检查
+        self.lock = asyncio.Lock()  # 监控对象常驻，定时检查和新邮件推送触发的检查依次进行
 
     def decode_subject(self, subject):
         if subject is None:
@@ -145,221 +2882,634 @@ class EmailMonitor:
                 decoded_parts.append(str(part))
         return ' '.join(decoded_parts)
 
+    def timer(self, stage):
+        return stage_seconds.timer(stage=stage, provider=self.provider.name, account=self.email_addr)
+
+    # 检查流程写成生成器：yield (IMAP UID命令, 参数...)或(阻塞函数, 参数...)，由run_steps（线程模式）
+    # 或run_steps_async（async模式）执行后把结果送回，两种模式共用同一套检查逻辑
+    def fetch(self, message_set, items):
+        """执行UID FETCH并记录耗时和下载字节数"""
+        with self.timer('fetch'):
+            _, data = yield ('FETCH', message_set, items)
+        fetch_bytes.observe(response_size(data), provider=self.provider.name, account=self.email_addr)
+        return data
+
     def connect(self):
         try:
-            self.imap = imaplib.IMAP4_SSL(self.imap_server)
-            self.imap.login(self.email_addr, self.password)
+            with self.timer('connect'):
+                self.imap = imap_pool.acquire(self.provider, self.email_addr, self.password)
             return True
         except Exception as e:
             logger.error(f"连接邮箱失败: {str(e)}")
+            self.last_error = f"连接邮箱失败: {str(e)}"
             return False
 
-    def send_to_weixin(self, subject, sender, content, received_time):
-        try:
-            # 转换为北京时间
-            if received_time.tzinfo is None:
-                received_time = pytz.utc.localize(received_time)
-            beijing_time = received_time.astimezone(beijing_tz)
-            
-            # 格式化北京时间
-            time_str = beijing_time.strftime("%Y-%m-%d %H:%M:%S")
-            
-            # 根据邮箱类型设置不同的图标
-            icon = "📧 Gmail" if self.email_type == "Gmail" else "📨 QQ邮箱"
-            
-            message = {
-                "msgtype": "text",
-                "text": {
-                    "content": f"{icon}邮件通知\n\n📬 收件邮箱: {self.email_addr}\n⏰ 接收时间: {time_str} (北京时间)\n👤 发件人: {sender}\n📑 主题: {subject}\n\n📝 内容预览:\n{content}",
-                    "mentioned_list": ["@all"]
-                }
-            }
-            response = requests.post(
-                self.weixin_webhook,
-                json=message
+    @property
+    def account_key(self):
+        return f"{self.imap_server}/{self.email_addr}"
+
+    def search_window(self):
+        # 首次同步处理的时间范围由服务商配置，如QQ邮箱最近24小时、Gmail最近30分钟
+        return self.provider.window
+
+    def search_new_uids(self):
+        """返回 (待处理的UID列表, 当前同步位置, 是否首次同步)"""
+        checkpoint = yield (checkpoint_store.get, self.account_key)
+        if checkpoint and checkpoint['uidvalidity'] == self.imap.uidvalidity:
+            last_uid = checkpoint['last_uid']
+            _, data = yield ('SEARCH', None, f'UID {last_uid + 1}:*')
+            # "n:*"在没有更大UID时会返回最后一封邮件，需要再过滤一次
+            uids = sorted(uid for uid in map(int, data[0].split()) if uid > last_uid)
+            return uids, last_uid, False
+
+        # 首次同步或UIDVALIDITY变化：以当前最大UID为基线，只处理时间窗口内的未读邮件
+        if checkpoint:
+            logger.info(f"{self.email_addr} 的UIDVALIDITY已变化，重新建立同步基线")
+        _, data = yield ('SEARCH', None, 'UID *')
+        last_uid = max(map(int, data[0].split()), default=0)
+        date = (datetime.now(beijing_tz) - self.search_window()).strftime("%d-%b-%Y")
+        _, data = yield ('SEARCH', None, f'({self.provider.search} SINCE "{date}")')
+        uids = sorted(map(int, data[0].split()))
+        return uids, last_uid, True
+
+    def fetch_headers(self, uids, rules):
+        """批量获取邮件头和正文部分信息，返回 {UID: (邮件头, 正文部分, 邮件大小)}
+
+        过滤规则用到群发邮件头或大小时才额外获取，邮件大小不需要时为None
+        """
+        # BODY.PEEK不会隐式设置已读标记
+        if FETCH_MODE == 'full':
+            # 先取大小，再按FETCH_MAX_BYTES分组下载，内存中同时只有一组原始邮件；
+            # 解析后只留下正文开头就丢掉正文和附件，返回的正文部分位置换成它，
+            # 预览在fetch_contents中只为没被规则丢弃、不重复的邮件生成
+            data = yield from self.fetch(uid_set(uids), '(RFC822.SIZE)')
+            sizes = sorted(
+                (uid, int(fields.get('RFC822.SIZE') or 0)) for uid, fields in parse_fetch_response(data).items()
             )
-            if response.status_code == 200:
-                logger.info(f"{self.email_type}邮件发送到微信成功")
-            else:
-                logger.error(f"{self.email_type}邮件发送到微信失败: {response.text}")
-        except Exception as e:
-            logger.error(f"{self.email_type}发送到微信时出错: {str(e)}")
+            messages = {}
+            for group in chunked_by_size(sizes, FETCH_MAX_BYTES):
+                data = yield from self.fetch(uid_set(group), '(BODY.PEEK[])')
+                with self.timer('parse'):
+                    for uid, fields in parse_fetch_response(data).items():
+                        raw = fetch_item(fields, 'BODY[]') or b''
+                        email_message = email.message_from_bytes(raw)
+                        source = preview_source(email_message)
+                        email_message.set_payload(None)
+                        messages[uid] = (email_message, source, len(raw))
+                data = raw = None
+            return messages
 
-    def get_email_content(self, email_message):
-        content = ""
-        if email_message.is_multipart():
-            for part in email_message.walk():
-                if part.get_content_type() == "text/plain":
-                    try:
-                        content = part.get_payload(decode=True).decode(errors='replace')
-                        break
-                    except:
+        size_item = ' RFC822.SIZE' if rules.needs_size else ''
+        data = yield from self.fetch(
+            uid_set(uids),
+            f'(BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS}{rules.header_fields})] BODYSTRUCTURE{size_item})'
+        )
+        with self.timer('parse'):
+            return {
+                uid: (
+                    email.message_from_bytes(fetch_item(fields, 'BODY[HEADER') or b''),
+                    find_text_part(fields.get('BODYSTRUCTURE')),
+                    int(fields['RFC822.SIZE']) if fields.get('RFC822.SIZE') else None
+                )
+                for uid, fields in parse_fetch_response(data).items()
+            }
+
+    def fetch_contents(self, text_parts):
+        """批量获取正文预览，partial模式只下载正文部分的前PREVIEW_BYTES（HTML为HTML_PREVIEW_BYTES）字节，返回 {UID: 预览}"""
+        if FETCH_MODE == 'full':
+            # full模式在fetch_headers中已经截取了正文开头，这里只解码
+            with self.timer('parse'):
+                return {
+                    uid: preview_text(*source) if source is not None else ""
+                    for uid, source in text_parts.items()
+                }
+
+        # 正文段号和下载长度相同的邮件合并成一条FETCH命令
+        sections = {}
+        for uid, text_part in text_parts.items():
+            if text_part is not None:
+                sections.setdefault((text_part[0], preview_bytes(text_part[1])), []).append(uid)
+
+        contents = {uid: "" for uid in text_parts}
+        for (section, size), uids in sections.items():
+            data = yield from self.fetch(uid_set(uids), f'(BODY.PEEK[{section}]<0.{size}>)')
+            with self.timer('parse'):
+                for uid, fields in parse_fetch_response(data).items():
+                    if uid not in contents:
                         continue
-        else:
-            try:
-                content = email_message.get_payload(decode=True).decode(errors='replace')
-            except:
-                content = "无法解析邮件内容"
-        return content[:500]  # 限制内容长度
+                    raw = fetch_item(fields, f'BODY[{section}]') or b''
+                    if isinstance(raw, str):
+                        raw = raw.encode()
+                    _, subtype, encoding, charset = text_parts[uid]
+                    contents[uid] = preview_text(raw, subtype, encoding, charset)
+        return contents
+
+    def mark_seen(self, uids):
+        """把已投递的邮件批量标记为已读"""
+        for batch in chunked(uids, FETCH_BATCH_SIZE):
+            yield ('STORE', uid_set(batch), '+FLAGS.SILENT', '(\\Seen)')
 
     def check_emails(self):
+        """检查新邮件并转发，返回转发的邮件数（线程模式，在线程池中执行）"""
         logger.info(f"开始检查{self.email_type}邮箱: {self.email_addr}")
-        
+        self.last_error = None
+
         if not self.connect():
-            return
+            return 0
+        try:
+            return self.run_steps(self.check_steps())
+        finally:
+            # 连接保持登录并留在连接池中，供下次检查复用
+            imap_pool.release(self.imap_server, self.email_addr)
+
+    async def check_emails_async(self):
+        """检查新邮件并转发，返回转发的邮件数（async模式，IMAP命令在事件循环上执行）"""
+        logger.info(f"开始检查{self.email_type}邮箱: {self.email_addr}")
+        self.last_error = None
 
         try:
-            self.imap.select('INBOX')
-            
-            # QQ邮箱和Gmail使用不同的搜索条件
-            if self.email_type == 'QQ':
-                # QQ邮箱搜索最近天的未读邮件
-                date = (datetime.now(beijing_tz) - timedelta(days=1)).strftime("%d-%b-%Y")
-                _, messages = self.imap.search(None, f'(UNSEEN SINCE "{date}")')
+            with self.timer('connect'):
+                self.imap = await async_imap_pool.acquire(self.provider, self.email_addr, self.password)
+        except Exception as e:
+            logger.error(f"连接邮箱失败: {str(e)}")
+            self.last_error = f"连接邮箱失败: {str(e)}"
+            return 0
+        discard = True
+        try:
+            sent_count = await self.run_steps_async(self.check_steps())
+            # 出错或被取消（超时）时连接上可能还有没读完的响应，关闭后下次重新登录
+            discard = self.last_error is not None
+            return sent_count
+        finally:
+            async_imap_pool.release(self.imap_server, self.email_addr, discard=discard)
+
+    def run_steps(self, steps):
+        """线程模式：直接执行检查流程产生的IMAP命令和阻塞调用"""
+        value, error = None, None
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            value, error = None, None
+            try:
+                value = step[0](*step[1:]) if callable(step[0]) else self.imap.uid(*step)
+            except Exception as e:
+                error = e
+
+    async def run_steps_async(self, steps):
+        """async模式：IMAP命令在事件循环上执行，可能阻塞的调用（写入发件箱、等待队列、SQLite）放到check_executor"""
+        loop = asyncio.get_running_loop()
+        value, error = None, None
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            value, error = None, None
+            try:
+                if callable(step[0]):
+                    value = await loop.run_in_executor(check_executor, partial(*step))
+                else:
+                    value = await self.imap.uid(*step)
+            except Exception as e:
+                error = e
+
+    def send_pending(self, pending, contents):
+        """把一批邮件的通知放入发送队列，返回 (入队成功的邮件数, 第一封暂时没能入队的UID或None, 跳过的邮件数)
+
+        没有通知渠道时重试也没有用，跳过这封邮件；写入发件箱出错等暂时的失败留给下次检查重试
+        """
+        sent_count = 0
+        failed_uid = None
+        skipped = 0
+        for uid, headers, subject, _, received_at, key, rule in pending:
+            logger.info(f"发送{self.email_type}邮件到微信: {subject}")
+            queued = queue_notification(self, subject, headers['from'], contents[uid], received_at, uid, rule)
+            if queued:
+                sent_count += 1
+            elif queued is None:
+                skipped += 1
             else:
-                # Gmail使用时间过滤，使用北京时间
-                date = (datetime.now(beijing_tz) - timedelta(minutes=30)).strftime("%d-%b-%Y")
-                _, messages = self.imap.search(None, f'(UNSEEN SINCE "{date}")')
-            
-            message_count = len(messages[0].split())
-            logger.info(f"发现 {message_count} 封新{self.email_type}邮件")
-            
-            for num in messages[0].split():
-                try:
-                    _, msg = self.imap.fetch(num, '(RFC822)')
-                    email_body = msg[0][1]
-                    email_message = email.message_from_bytes(email_body)
-                    
-                    # 获取邮件接收时间
-                    date_str = email_message['date']
-                    if date_str:
-                        try:
-                            # 解析邮件时间并转换为UTC时间
-                            received_time = datetime.fromtimestamp(
-                                email.utils.mktime_tz(
-                                    email.utils.parsedate_tz(date_str)
-                                ),
-                                pytz.utc
-                            )
-                        except:
-                            received_time = datetime.now(pytz.utc)
-                    else:
-                        received_time = datetime.now(pytz.utc)
-                    
-                    # 转换为北京时间进行比较
-                    beijing_received_time = received_time.astimezone(beijing_tz)
-                    time_diff = datetime.now(beijing_tz) - beijing_received_time
-                    
-                    # QQ邮箱处理最近24小时的邮件，Gmail处理最近30分钟的邮件
-                    if (self.email_type == 'QQ' and time_diff > timedelta(days=1)) or \
-                       (self.email_type == 'Gmail' and time_diff > timedelta(minutes=30)):
-                        # 将超时的邮件标记为已读
-                        self.imap.store(num, '+FLAGS', '\\Seen')
-                        continue
+                dedup_index.forget(key)
+                if failed_uid is None:
+                    failed_uid = uid
+        return sent_count, failed_uid, skipped
 
-                    subject = self.decode_subject(email_message['subject'])
-                    sender = email_message['from']
-                    content = self.get_email_content(email_message)
+    def check_steps(self):
+        """检查流程，返回转发的邮件数"""
+        sent_count = 0
+        self.backlog = False
+        first_sync, done_uid = False, None
+        checkpoint_uid = None  # 要保存的同步位置
+        retry_first_sync = False
+        try:
+            with self.timer('search'):
+                uids, last_uid, first_sync = yield from self.search_new_uids()
+            logger.info(f"发现 {len(uids)} 封新{self.email_type}邮件")
+            if len(uids) > BACKLOG_LIMIT:
+                if first_sync:
+                    # 首次同步以当前最大UID为基线，没有可以续接的位置，只处理最新的BACKLOG_LIMIT封
+                    logger.warning(f"{self.email_addr} 首次同步跳过较早的{len(uids) - BACKLOG_LIMIT}封未读邮件")
+                    uids = uids[-BACKLOG_LIMIT:]
+                else:
+                    logger.info(f"{self.email_addr} 积压{len(uids)}封邮件，本次处理{BACKLOG_LIMIT}封")
+                    uids = uids[:BACKLOG_LIMIT]
+                    self.backlog = True
+            rules = load_rules()
+            done_uid = last_uid
+            # 本次检查内所有邮件共用同一个当前时间
+            now = time.time()
+            window = self.search_window().total_seconds()
 
-                    logger.info(f"发送{self.email_type}邮件到微信: {subject}")
-                    self.send_to_weixin(subject, sender, content, received_time)
-                    
-                    # 发送成功后将邮件标记为已读
-                    self.imap.store(num, '+FLAGS', '\\Seen')
-                    
-                except Exception as e:
-                    logger.error(f"处理{self.email_type}邮件时出错: {str(e)}")
-                    continue
-                
+            for batch in chunked(uids, FETCH_BATCH_SIZE):
+                # 发送队列积压时先等待再下载下一页；一直没有空位就停在这里，剩下的邮件由下一次检查继续
+                if not (yield (webhook_sender.wait_for_room, len(batch), NETWORK_TIMEOUT)) and not first_sync:
+                    logger.info(f"{self.email_addr} 发送队列已满，剩余邮件留到下次检查")
+                    self.backlog = True
+                    break
+                # 每批邮件一次取邮件头，一次（按正文段号）取正文
+                pending = []
+                messages = yield from self.fetch_headers(batch, rules)
+                for uid, (headers, text_part, size) in sorted(messages.items()):
+                    try:
+                        # 获取邮件接收时间，没有或无法解析Date时按当前时间
+                        date_str = headers['date']
+                        received_at = parse_mail_date(date_str, now)
+
+                        # 首次同步只处理时间窗口内的邮件，之后按UID增量处理，迟到的邮件也不会丢
+                        if first_sync and now - received_at > window:
+                            continue
+
+                        # 按邮件头匹配过滤规则，丢弃的邮件不下载正文
+                        subject = self.decode_subject(headers['subject'])
+                        rule = rules.match(headers['from'], self.email_addr, subject, headers, size)
+                        if rule is not None and rule.action == 'drop':
+                            service_status["delivery"]["filtered"] += 1
+                            continue
+
+                        # 其他邮箱已经转发过的同一封邮件直接跳过，也不再下载正文
+                        key = dedup_key(headers['message-id'], headers['from'], headers['subject'], date_str)
+                        if not (yield (dedup_index.claim, key)):
+                            service_status["delivery"]["duplicates"] += 1
+                            continue
+
+                        pending.append((uid, headers, subject, text_part, received_at, key, rule))
+                    except Exception as e:
+                        logger.error(f"处理{self.email_type}邮件时出错: {str(e)}")
+
+                try:
+                    contents = yield from self.fetch_contents(
+                        {uid: text_part for uid, _, _, text_part, _, _, _ in pending}
+                    )
+                except Exception:
+                    # 正文下载失败：撤销本批的认领，其他邮箱里的同一封邮件仍可转发
+                    yield (dedup_index.forget, *[item[5] for item in pending])
+                    raise
+                except BaseException:
+                    # 检查被取消时生成器正在关闭，不能再yield，直接撤销
+                    dedup_index.forget(*[item[5] for item in pending])
+                    raise
+                if pending:
+                    sent, failed_uid, skipped = yield (self.send_pending, pending, contents)
+                    sent_count += sent
+                    if skipped:
+                        self.last_error = f"{skipped}封邮件无法转发，已跳过"
+                        logger.error(f"{self.email_addr} {self.last_error}")
+                    if failed_uid is not None:
+                        self.last_error = "有邮件没能加入发送队列，下次检查重试"
+                        logger.error(f"{self.email_addr} {self.last_error}")
+                        if first_sync:
+                            # 首次同步继续处理其余邮件，但不保存基线，下次重新同步时已入队的邮件由去重跳过
+                            retry_first_sync = True
+                        else:
+                            # 同步位置停在第一封没能入队的邮件之前，下次检查从它开始重新处理
+                            done_uid = max(done_uid, failed_uid - 1)
+                            break
+                done_uid = batch[-1]
+
+            # 投递成功的邮件（包括之前检查中入队、已发送完成的）批量标记已读
+            delivered_uids = pop_delivered(self.account_key)
+            if MARK_AS_READ and delivered_uids:
+                yield from self.mark_seen(delivered_uids)
+            # 增量同步推进到已处理的位置；首次同步的基线已经是当前最大UID
+            if not retry_first_sync:
+                checkpoint_uid = max(last_uid, done_uid)
         except Exception as e:
             logger.error(f"检查{self.email_type}邮件时出错: {str(e)}")
-        finally:
+            self.last_error = str(e)
+            # 增量同步出错时也保存已处理完的位置，已经入队的邮件下次不会再发一次；
+            # 首次同步出错时不保存，下次重新同步，已经入队的邮件由去重跳过
+            if not first_sync:
+                checkpoint_uid = done_uid
+
+        if checkpoint_uid is not None:
             try:
-                self.imap.close()
-                self.imap.logout()
-            except:
-                pass
+                # 通知落盘后才推进同步位置，进程崩溃也不会丢通知
+                if not (yield (outbox.flush,)):
+                    raise TimeoutError("写入发件箱超时")
+                yield (checkpoint_store.save_uid, self.account_key, self.imap.uidvalidity, checkpoint_uid)
+            except Exception as e:
+                logger.error(f"保存{self.email_type}同步位置时出错: {str(e)}")
+                self.last_error = str(e)
+        return sent_count
 
 class OutlookMonitor:
-    def __init__(self, email_addr, password):
+    def __init__(self, email_addr, password, provider):
         self.email_addr = email_addr
         self.password = password
-        self.weixin_webhook = os.getenv('WEIXIN_WEBHOOK')
+        self.provider = provider
+        self.email_type = provider.label
         self.last_check_time = datetime.now(beijing_tz)
+        self.last_error = None
+        self.backlog = False  # EWS同步状态只能在处理完所有变化后推进，积压邮件在一次检查中分页处理完
+        self.lock = asyncio.Lock()
+
+    def timer(self, stage):
+        return stage_seconds.timer(stage=stage, provider=self.provider.name, account=self.email_addr)
 
     def connect(self):
         try:
-            credentials = Credentials(self.email_addr, self.password)
-            config = Configuration(credentials=credentials, server='outlook.office365.com')
-            self.account = Account(
-                primary_smtp_address=self.email_addr,
-                config=config,
-                access_type=DELEGATE
-            )
+            with self.timer('connect'):
+                self.account = ews_pool.acquire(self.provider, self.email_addr, self.password)
             return True
         except Exception as e:
             logger.error(f"连接Outlook邮箱失败: {str(e)}")
+            self.last_error = f"连接Outlook邮箱失败: {str(e)}"
             return False
 
-    def send_to_weixin(self, subject, sender, content, received_time):
-        try:
-            # 转换为北京时间
-            if received_time.tzinfo is None:
-                received_time = pytz.utc.localize(received_time)
-            beijing_time = received_time.astimezone(beijing_tz)
-            
-            # 格式化北京时间
-            time_str = beijing_time.strftime("%Y-%m-%d %H:%M:%S")
-            
-            message = {
-                "msgtype": "text",
-                "text": {
-                    "content": f"📨 Outlook邮件通知\n\n📬 收件邮箱: {self.email_addr}\n⏰ 接收时间: {time_str} (北京时间)\n👤 发件人: {sender}\n📑 主题: {subject}\n\n📝 内容预览:\n{content}",
-                    "mentioned_list": ["@all"]
-                }
-            }
-            response = requests.post(
-                self.weixin_webhook,
-                json=message
-            )
-            if response.status_code == 200:
-                logger.info("Outlook邮件发送到微信成功")
-            else:
-                logger.error(f"Outlook邮件发送到微信失败: {response.text}")
-        except Exception as e:
-            logger.error(f"发送到微信时出错: {str(e)}")
+    @property
+    def account_key(self):
+        return f"{self.provider.host}/{self.email_addr}"
 
     def check_emails(self):
+        """检查新邮件并转发，返回转发的邮件数"""
         logger.info(f"开始检查Outlook邮箱: {self.email_addr}")
+        self.last_error = None
+        sent_count = 0
         
         if not self.connect():
-            return
+            return sent_count
 
+        failed = False
+        not_queued = 0
+        skipped = 0
         try:
-            # 获取最近30分钟的未读邮件
-            filter_date = datetime.now(beijing_tz) - timedelta(minutes=30)
-            unread_messages = self.account.inbox.filter(
-                is_read=False,
-                datetime_received__gt=filter_date
-            )
+            inbox = self.account.inbox
+            checkpoint = checkpoint_store.get(self.account_key)
+            rules = load_rules()
+            fields = list(EWS_FIELDS)
+            if self.account.version.build < EXCHANGE_2013:
+                fields[fields.index('text_body')] = 'body'
+            if rules.header_fields:
+                fields.append('headers')
+            if rules.needs_size:
+                fields.append('size')
+            # 邮件按EWS_PAGE_SIZE分页边下载边处理，内存中只有当前一页；发送队列满时submit会阻塞，下载随之暂停
+            if checkpoint and checkpoint['sync_state']:
+                # 增量同步：只取上次同步之后新建的邮件，全部处理完后inbox.item_sync_state才是新的同步位置
+                new_messages = (
+                    item for change_type, item in inbox.sync_items(
+                        sync_state=checkpoint['sync_state'],
+                        only_fields=fields,
+                        max_changes_returned=EWS_PAGE_SIZE
+                    )
+                    if change_type == 'create'
+                )
+            else:
+                # 首次同步：先建立同步基线，再处理时间窗口内（默认最近30分钟）的未读邮件；
+                # 两者之间到达的邮件会在下次增量同步中再出现一次，由去重索引跳过
+                with self.timer('fetch'):
+                    for _ in inbox.sync_items(only_fields=['datetime_received'], max_changes_returned=EWS_PAGE_SIZE):
+                        pass
+                filter_date = datetime.now(beijing_tz) - self.provider.window
+                new_messages = inbox.filter(
+                    is_read=False,
+                    datetime_received__gt=filter_date
+                ).only(*fields)
+                new_messages.page_size = EWS_PAGE_SIZE
 
-            for message in unread_messages:
-                try:
-                    content = message.body[:500]  # 限制内容长度
-                    self.send_to_weixin(
-                        message.subject,
-                        str(message.sender),
-                        content,
-                        message.datetime_received
+            for message in self.timed_pages(new_messages):
+                # EWS的正文和邮件头在同一请求中返回，命中丢弃规则的邮件省去生成预览和发送
+                rule = None
+                if rules:
+                    headers = {
+                        header.name.lower(): header.value
+                        for header in getattr(message, 'headers', None) or []
+                    }
+                    rule = rules.match(
+                        getattr(message.sender, 'email_address', None) or '', self.email_addr,
+                        message.subject, headers, getattr(message, 'size', None)
                     )
-                    message.is_read = True
-                    message.save()
+                    if rule is not None and rule.action == 'drop':
+                        service_status["delivery"]["filtered"] += 1
+                        continue
+                key = dedup_key(
+                    getattr(message, 'message_id', None), str(message.sender),
+                    message.subject, message.datetime_received
+                )
+                if not dedup_index.claim(key):
+                    service_status["delivery"]["duplicates"] += 1
+                    continue
+                try:
+                    content = self.message_preview(message)
+                    received_at = message.datetime_received.timestamp()
                 except Exception as e:
-                    logger.error(f"处理Outlook邮件时出错: {str(e)}")
+                    # 邮件本身有问题，重试也一样，跳过
+                    logger.error(f"处理Outlook邮件时出错，已跳过: {str(e)}")
+                    skipped += 1
                     continue
+                queued = queue_notification(
+                    self,
+                    message.subject,
+                    str(message.sender),
+                    content,
+                    received_at,
+                    [message.id, message.changekey],
+                    rule
+                )
+                if queued:
+                    sent_count += 1
+                elif queued is None:
+                    skipped += 1
+                else:
+                    dedup_index.forget(key)
+                    not_queued += 1
+
+            # 通知落盘后才推进同步位置，进程崩溃也不会丢通知
+            if not outbox.flush():
+                raise TimeoutError("写入发件箱超时")
+            if skipped:
+                self.last_error = f"{skipped}封邮件无法转发，已跳过"
+                logger.error(f"{self.email_addr} {self.last_error}")
+            if not_queued:
+                # EWS同步位置只能整体推进：有邮件暂时没能入队时保留原位置，下次检查重新处理这些变化，
+                # 其中已经入队的邮件由去重索引跳过
+                self.last_error = f"{not_queued}封邮件没能加入发送队列，下次检查重试"
+                logger.error(f"{self.email_addr} {self.last_error}")
+            else:
+                checkpoint_store.save_sync_state(self.account_key, inbox.item_sync_state)
+
+            # 投递成功的邮件（包括之前检查中入队、已发送完成的）批量标记已读
+            delivered_items = pop_delivered(self.account_key)
+            if MARK_AS_READ and delivered_items:
+                self.mark_read(delivered_items)
 
         except Exception as e:
             logger.error(f"检查Outlook邮件时出错: {str(e)}")
+            self.last_error = str(e)
+            failed = True
+        finally:
+            # Account留在缓存中供下次检查复用，出错时丢弃以便重新建立会话
+            ews_pool.release(self.provider, self.email_addr, discard=failed)
+        return sent_count
+
+    def timed_pages(self, items):
+        """逐个取出分页查询的邮件，把等待EWS响应的时间合计记为fetch（EWS的搜索和下载在同一请求中完成）"""
+        iterator = iter(items)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            stage_seconds.observe(elapsed, stage='fetch', provider=self.provider.name, account=self.email_addr)
+
+    @staticmethod
+    def message_preview(message):
+        """text_body是服务器转换好的纯文本；Exchange 2013之前的版本没有text_body，改取body，按HTML或纯文本生成预览"""
+        text = getattr(message, 'text_body', None)
+        if text:
+            return text.strip()[:PREVIEW_CHARS]
+        body = getattr(message, 'body', None)
+        if not body:
+            return ""
+        if isinstance(body, HTMLBody):
+            return html_to_text(body)[:PREVIEW_CHARS]
+        return body.strip()[:PREVIEW_CHARS]
+
+    def mark_read(self, items):
+        """用UpdateItem批量把已投递的邮件标记为已读，每批FETCH_BATCH_SIZE封"""
+        updates = [
+            (Message(account=self.account, id=item_id, changekey=changekey, is_read=True), ['is_read'])
+            for item_id, changekey in items
+        ]
+        for result in self.account.bulk_update(updates, chunk_size=FETCH_BATCH_SIZE):
+            if isinstance(result, Exception):
+                logger.error(f"标记Outlook邮件已读失败: {str(result)}")
+
+# 每种协议对应一个监控类，所有服务商共用
+MONITOR_TYPES = {
+    'imap': EmailMonitor,
+    'ews': OutlookMonitor
+}
+
+# 各服务商的并发信号量，定时检查和IDLE触发的检查共用
+provider_semaphores = {}
+
+def provider_semaphore(provider):
+    # 按并发数区分，重新加载配置修改了并发数后使用新的信号量
+    key = (provider.name, provider.concurrency)
+    semaphore = provider_semaphores.get(key)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(provider.concurrency)
+        provider_semaphores[key] = semaphore
+    return semaphore
+
+async def check_account(monitor):
+    """检查单个邮箱（线程模式在线程池中，async模式IMAP直接在事件循环上），受服务商并发数和单邮箱超时限制，
+    等待期间邮箱交给了其他进程时返回None"""
+    loop = asyncio.get_running_loop()
+    provider = monitor.provider.name
+    # 从排队等待开始就算作检查中，期间本进程不会把该邮箱交给其他进程
+    lease_manager.begin_check(monitor.account_key)
+    running = None
+    try:
+        # 监控对象常驻，同一邮箱的检查依次进行
+        await monitor.lock.acquire()
+        try:
+            if not lease_manager.owns(monitor.account_key):
+                # 等锁期间租约已经过期或交给了其他进程，不能再检查
+                logger.info(f"{provider}邮箱 {monitor.email_addr} 已由其他进程负责，跳过本次检查")
+                return None
+            async with provider_semaphore(monitor.provider):
+                start_time = time.monotonic()
+                sent_count = 0
+                service_status["in_flight"]["checks"] += 1
+                try:
+                    if IO_MODE == 'async' and hasattr(monitor, 'check_emails_async'):
+                        # 超时会直接取消协程，连接随之关闭
+                        webhook_sender.start_async()
+                        check = monitor.check_emails_async()
+                    else:
+                        # 超时后线程仍会在NETWORK_TIMEOUT内自行结束，这里只是不再等待它
+                        running = loop.run_in_executor(check_executor, monitor.check_emails)
+                        check = asyncio.shield(running)
+                    sent_count = await asyncio.wait_for(check, timeout=ACCOUNT_TIMEOUT)
+                    error = monitor.last_error
+                except asyncio.TimeoutError:
+                    error = f"检查超时（{ACCOUNT_TIMEOUT}秒）"
+                except Exception as e:
+                    error = str(e)
+                finally:
+                    service_status["in_flight"]["checks"] -= 1
+        finally:
+            if running is not None and not running.done():
+                # 超时的线程结束后才允许下一次检查使用这个监控对象
+                running.add_done_callback(lambda _: monitor.lock.release())
+            else:
+                monitor.lock.release()
+    finally:
+        if running is not None and not running.done():
+            # 超时的线程仍在检查，结束前继续持有租约
+            running.add_done_callback(lambda _: lease_manager.end_check(monitor.account_key))
+        else:
+            lease_manager.end_check(monitor.account_key)
+    duration = time.monotonic() - start_time
+
+    stage_seconds.observe(duration, stage='check', provider=provider, account=monitor.email_addr)
+    checks_total.inc(provider=provider, account=monitor.email_addr, result='error' if error else 'success')
+    if error:
+        logger.error(f"{provider}邮箱 {monitor.email_addr} 检查失败: {error}")
+    result = {
+        "provider": provider,
+        "email": monitor.email_addr,
+        "status": f"失败: {error}" if error else "成功",
+        "sent_count": sent_count or 0,
+        "backlog": monitor.backlog,
+        "duration": round(duration, 2),
+        "check_time": datetime.now(beijing_tz).strftime("%Y-%m-%d %H:%M:%S")
+    }
+    service_status["accounts"][f"{provider}:{monitor.email_addr}"] = result
+    return result
+
+async def run_sweep():
+    """并发检查所有邮箱，总耗时取决于最慢的邮箱而不是所有邮箱之和"""
+    start_time = time.monotonic()
+    snapshot = config_manager.current()
+    service_status["in_flight"]["sweeps"] += 1
+    try:
+        results = await asyncio.gather(*[
+            check_account(config_manager.monitor(account))
+            for account in snapshot.accounts.values()
+            if lease_manager.owns(account.account_key)
+        ])
+        results = [result for result in results if result is not None]
+    finally:
+        service_status["in_flight"]["sweeps"] -= 1
+    sweep_seconds.observe(time.monotonic() - start_time)
+    failed = sum(1 for result in results if result["status"] != "成功")
+    logger.info(
+        f"所有邮箱检查完成，共{len(results)}个邮箱，失败{failed}个，"
+        f"耗时{time.monotonic() - start_time:.2f}秒"
+    )
+    return results
 
 async def check_all_emails(background_tasks: BackgroundTasks):
     """检查所有配置的邮箱"""
@@ -368,42 +3518,11 @@ async def check_all_emails(background_tasks: BackgroundTasks):
         return {"message": "邮件检查正在进行中"}
     
     service_status["is_checking"] = True
-    configs = get_email_configs()
     
     try:
-        # 检查Gmail邮箱
-        for gmail_config in configs['gmail']:
-            logger.info(f"开始检查Gmail邮箱: {gmail_config['email']}")
-            monitor = EmailMonitor(
-                gmail_config['email'],
-                gmail_config['password'],
-                'imap.gmail.com',
-                'Gmail'
-            )
-            monitor.check_emails()
-        
-        # 检查QQ邮箱
-        for qq_config in configs['qq']:
-            logger.info(f"开始检查QQ邮箱: {qq_config['email']}")
-            monitor = EmailMonitor(
-                qq_config['email'],
-                qq_config['password'],
-                'imap.qq.com',
-                'QQ'
-            )
-            monitor.check_emails()
-        
-        # 检查Outlook邮箱
-        for outlook_config in configs['outlook']:
-            logger.info(f"开始检查Outlook邮箱: {outlook_config['email']}")
-            monitor = OutlookMonitor(
-                outlook_config['email'],
-                outlook_config['password']
-            )
-            monitor.check_emails()
-        
-        logger.info("所有邮箱检查完成")
+        results = await run_sweep()
         update_service_status(True)
+        return {"message": "邮件检查完成", "accounts": results}
     except Exception as e:
         error_message = f"检查邮件时出错: {str(e)}"
         logger.error(error_message)
@@ -411,11 +3530,212 @@ async def check_all_emails(background_tasks: BackgroundTasks):
     finally:
         service_status["is_checking"] = False
 
+class AccountSchedule:
+    """单个邮箱的检查计划"""
+    __slots__ = ('account', 'interval', 'failures', 'next_run', 'running')
+
+    def __init__(self, account, next_run):
+        self.account = account
+        self.interval = CHECK_INTERVAL
+        self.failures = 0
+        self.next_run = next_run
+        self.running = False
+
+    def reschedule(self, result):
+        """根据检查结果调整间隔：收到新邮件时缩短，没有新邮件时逐步延长，失败时指数退避"""
+        if result["status"] != "成功":
+            self.failures += 1
+            self.interval = min(MAX_CHECK_INTERVAL, CHECK_INTERVAL * 2 ** self.failures)
+        else:
+            if self.failures:
+                self.failures = 0
+                self.interval = CHECK_INTERVAL
+            if result["sent_count"]:
+                self.interval = max(MIN_CHECK_INTERVAL, self.interval / 2)
+            else:
+                self.interval = min(MAX_CHECK_INTERVAL, self.interval * 1.25)
+        if result["status"] == "成功" and result["backlog"]:
+            # 还有积压的邮件，马上接着检查
+            self.next_run = time.monotonic()
+            return
+        # 加随机抖动，避免邮箱的检查时间逐渐对齐到一起
+        self.next_run = time.monotonic() + self.interval * random.uniform(0.8, 1.2)
+
+class PollScheduler:
+    """按邮箱安排检查时间的调度器，首次检查随机分散在一个检查间隔内，避免所有邮箱同时登录"""
+
+    def __init__(self):
+        self.schedules = {}  # {服务商:邮箱: AccountSchedule}
+        self.heap = []  # (下次检查时间, 服务商:邮箱)，调整计划后旧记录留在堆中，弹出时按next_run校验
+        self.tasks = set()
+        self.wakeup = None
+        self.task = None
+        self.version = None  # 已同步的配置快照版本
+
+    def sync(self):
+        """按当前配置快照更新调度，新增的邮箱加入调度，删除的邮箱移出，已有邮箱保留原来的计划"""
+        now = time.monotonic()
+        snapshot = config_manager.current()
+        self.version = snapshot.version
+        schedules = {}
+        for key, account in snapshot.accounts.items():
+            schedule = self.schedules.get(key)
+            if schedule is None:
+                schedule = AccountSchedule(account, now + random.uniform(0, CHECK_INTERVAL))
+                heapq.heappush(self.heap, (schedule.next_run, key))
+            else:
+                schedule.account = account
+            schedules[key] = schedule
+        added = len(schedules.keys() - self.schedules.keys())
+        removed = len(self.schedules.keys() - schedules.keys())
+        if added or removed:
+            logger.info(f"调度邮箱数: {len(schedules)}，新增{added}个，移除{removed}个")
+        self.schedules = schedules
+
+    async def check(self, key, schedule):
+        result = {"status": "失败: 检查未完成", "sent_count": 0, "backlog": False}
+        try:
+            result = await check_account(config_manager.monitor(schedule.account))
+        except Exception as e:
+            logger.error(f"调度检查邮箱 {schedule.account.email} 出错: {str(e)}")
+            result["status"] = f"失败: {str(e)}"
+        finally:
+            # 出错或被取消时也重新入堆，否则这个邮箱不会再被调度
+            lease_manager.end_check(schedule.account.account_key)
+            schedule.running = False
+            if result is None:
+                # 等待期间邮箱交给了其他进程，稍后再看是否分配回本进程
+                schedule.next_run = time.monotonic() + min(schedule.interval, LEASE_TTL)
+            else:
+                schedule.reschedule(result)
+            heapq.heappush(self.heap, (schedule.next_run, key))
+        if result is None:
+            self.wakeup.set()
+            return
+        result["interval"] = round(schedule.interval)
+        result["next_check"] = (
+            datetime.now(beijing_tz) + timedelta(seconds=schedule.next_run - time.monotonic())
+        ).strftime("%Y-%m-%d %H:%M:%S")
+        if result["status"] == "成功":
+            update_service_status(True)
+        else:
+            update_service_status(False, f"{schedule.account.email}: {result['status'].removeprefix('失败: ')}")
+        self.wakeup.set()
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        logger.info(f"内置调度已启动，基础检查间隔{CHECK_INTERVAL:.0f}秒")
+        while True:
+            delay = CHECK_INTERVAL
+            try:
+                now = time.monotonic()
+                if self.version != config_manager.current().version:
+                    self.sync()
+                # 弹出所有到期的邮箱，正在检查的邮箱检查完后会重新入堆
+                while self.heap and self.heap[0][0] <= now:
+                    next_run, key = heapq.heappop(self.heap)
+                    schedule = self.schedules.get(key)
+                    if schedule is None or schedule.running or schedule.next_run != next_run:
+                        continue
+                    if not lease_manager.owns(schedule.account.account_key):
+                        # 该邮箱由其他进程负责，稍后再看是否分配给了本进程
+                        schedule.next_run = now + min(schedule.interval, LEASE_TTL)
+                        heapq.heappush(self.heap, (schedule.next_run, key))
+                        continue
+                    schedule.running = True
+                    lease_manager.begin_check(schedule.account.account_key)
+                    task = asyncio.create_task(self.check(key, schedule))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                if self.heap:
+                    delay = min(delay, self.heap[0][0] - now)
+            except Exception as e:
+                logger.error(f"调度邮件检查失败: {str(e)}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=max(delay, 0.05))
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def nudge(self):
+        """/wake或配置重新加载后调用：处理已到期的邮箱，不会让所有邮箱同时检查"""
+        self.start()
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+poll_scheduler = PollScheduler()
+
+# 新邮件监听线程（IMAP IDLE、EWS通知），{服务商:邮箱: 监听}
+idle_watchers = {}
+
+def start_watcher(account, loop):
+    """为邮箱启动新邮件监听（IMAP用IDLE，Outlook用EWS通知），新邮件到达后立即检查该邮箱"""
+    provider = account.provider
+    if provider.protocol == 'imap' and not IMAP_IDLE:
+        return
+    if provider.protocol == 'ews' and EWS_NOTIFY not in ('streaming', 'pull'):
+        return
+
+    def on_new_mail():
+        # 邮箱已从配置中删除或修改时不再检查
+        if config_manager.current().accounts.get(account.key) is not account:
+            return
+        if lease_manager.owns(account.account_key):
+            asyncio.run_coroutine_threadsafe(check_account(config_manager.monitor(account)), loop)
+
+    if provider.protocol == 'ews':
+        watcher = EWSWatcher(provider, account.email, account.password, on_new_mail, EWS_NOTIFY)
+    else:
+        watcher_class = AsyncIdleWatcher if IO_MODE == 'async' else IdleWatcher
+        watcher = watcher_class(provider, account.email, account.password, on_new_mail)
+    watcher.start()
+    idle_watchers[account.key] = watcher
+
+def start_idle_watchers(loop):
+    for account in config_manager.current().accounts.values():
+        start_watcher(account, loop)
+    logger.info(f"已启动{len(idle_watchers)}个新邮件监听")
+
+def close_account_sessions(accounts):
+    """关闭已删除或修改的邮箱的IMAP连接和Outlook会话（会发送LOGOUT，在线程中执行）"""
+    for account in accounts:
+        imap_pool.discard(account.provider.host, account.email)
+        ews_pool.discard(account.provider.host, account.email)
+
+async def reload_config(force=False):
+    """重新加载配置，只为新增、删除或修改的邮箱建立或关闭连接和监听"""
+    changes = config_manager.reload(force)
+    if changes is None:
+        return
+    added, removed = changes
+    webhook_sender.configure(config_manager.current().webhooks)
+    Notifier.forget_templates(removed)
+    loop = asyncio.get_running_loop()
+    for account in removed:
+        watcher = idle_watchers.pop(account.key, None)
+        if watcher is not None:
+            watcher.stop()
+        async_imap_pool.discard(account.provider.host, account.email)
+    if removed:
+        await loop.run_in_executor(None, close_account_sessions, removed)
+    for account in added:
+        start_watcher(account, loop)
+    if SCHEDULER:
+        poll_scheduler.nudge()
+
 @app.get("/wake")
 async def wake_service(background_tasks: BackgroundTasks):
     """唤醒服务并检查邮件（快速响应）"""
-    # 立即返回响应
-    background_tasks.add_task(process_wake_request)
+    # 配置文件修改过时先重新加载；内置调度开启时只唤醒调度器，否则在后台检查全部邮箱；都立即返回响应
+    await reload_config()
+    if SCHEDULER:
+        poll_scheduler.nudge()
+    else:
+        background_tasks.add_task(process_wake_request)
     return {
         "message": "服务正常运行",
         "timestamp": datetime.now(beijing_tz).strftime("%Y-%m-%d %H:%M:%S"),
@@ -432,61 +3752,20 @@ async def process_wake_request():
     service_status["is_checking"] = True
     
     try:
-        # 检查环境变量
-        configs = get_email_configs()
-        logger.info(f"Gmail配置数量: {len(configs['gmail'])}")
-        logger.info(f"QQ邮箱配置数量: {len(configs['qq'])}")
-        logger.info(f"Outlook配置数量: {len(configs['outlook'])}")
+        snapshot = config_manager.current()
+        for name, accounts in snapshot.configs.items():
+            if accounts:
+                logger.info(f"{snapshot.providers[name].label}邮箱配置数量: {len(accounts)}")
         
-        if not any([configs['gmail'], configs['qq'], configs['outlook']]):
+        if not snapshot.accounts:
             logger.error("没有找到有效的邮箱配置")
             return
         
-        if not os.getenv('WEIXIN_WEBHOOK'):
-            logger.error("未配置微信Webhook")
+        if not webhook_sender.notifiers():
+            logger.error("未配置通知渠道Webhook")
             return
         
-        # 检查Gmail邮箱
-        for gmail_config in configs['gmail']:
-            try:
-                logger.info(f"检查Gmail邮箱: {gmail_config['email']}")
-                monitor = EmailMonitor(
-                    gmail_config['email'],
-                    gmail_config['password'],
-                    'imap.gmail.com',
-                    'Gmail'
-                )
-                monitor.check_emails()
-            except Exception as e:
-                logger.error(f"Gmail邮箱检查失败: {str(e)}")
-        
-        # 检查QQ邮箱
-        for qq_config in configs['qq']:
-            try:
-                logger.info(f"检查QQ邮箱: {qq_config['email']}")
-                monitor = EmailMonitor(
-                    qq_config['email'],
-                    qq_config['password'],
-                    'imap.qq.com',
-                    'QQ'
-                )
-                monitor.check_emails()
-            except Exception as e:
-                logger.error(f"QQ邮箱检查失败: {str(e)}")
-        
-        # 检查Outlook邮箱
-        for outlook_config in configs['outlook']:
-            try:
-                logger.info(f"检查Outlook邮箱: {outlook_config['email']}")
-                monitor = OutlookMonitor(
-                    outlook_config['email'],
-                    outlook_config['password']
-                )
-                monitor.check_emails()
-            except Exception as e:
-                logger.error(f"Outlook邮箱检查失败: {str(e)}")
-        
-        logger.info("所有邮箱检查完成")
+        await run_sweep()
         update_service_status(True)
     except Exception as e:
         error_message = f"邮件检查过程出错: {str(e)}"
@@ -503,28 +3782,141 @@ async def check_emails_endpoint(background_tasks: BackgroundTasks):
 @app.get("/status")
 async def get_status():
     """获取服务状态"""
+    service_status["delivery"]["outbox"] = outbox.count()
+    if lease_manager.enabled:
+        service_status["sharding"] = {
+            "worker": lease_manager.worker_id,
+            "workers": len(lease_manager.workers),
+            "accounts": len(lease_manager.owned)
+        }
     return service_status
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus格式的监控指标"""
+    lines = []
+    for metric in (stage_seconds, fetch_bytes, delivery_delay, webhook_seconds, sweep_seconds, checks_total):
+        lines.extend(metric.render())
+
+    def export(name, help_text, metric_type, values, label):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for key, value in values.items():
+            lines.append(f"{name}{format_labels(((label, key),))} {value}")
+
+    delivery = {key: value for key, value in service_status["delivery"].items() if key != "outbox"}
+    export('mail_delivery_total', '通知投递事件数', 'counter', delivery, 'event')
+    export('mail_imap_connections_total', 'IMAP连接事件数', 'counter', service_status["imap_connections"], 'event')
+    export('mail_in_flight', '正在进行的检查数', 'gauge', service_status["in_flight"], 'kind')
+
+    queue_depth = {}
+    if webhook_sender.channels:
+        for channel in list(webhook_sender.channels.values()):
+            platform = channel.notifier.platform
+            queue_depth[platform] = queue_depth.get(platform, 0) + len(channel.pending)
+    export('mail_webhook_queue_depth', '各平台待发送的通知数', 'gauge', queue_depth, 'platform')
+    lines.append("# HELP mail_outbox_pending 发件箱中未送达的通知数")
+    lines.append("# TYPE mail_outbox_pending gauge")
+    lines.append(f"mail_outbox_pending {outbox.count()}")
+    lines.append("# HELP mail_watchers 新邮件监听线程数")
+    lines.append("# TYPE mail_watchers gauge")
+    lines.append(f"mail_watchers {sum(1 for watcher in idle_watchers.values() if watcher.is_alive())}")
+    if lease_manager.enabled:
+        lines.append("# HELP mail_leased_accounts 本进程持有租约的邮箱数")
+        lines.append("# TYPE mail_leased_accounts gauge")
+        lines.append(f"mail_leased_accounts {len(lease_manager.owned)}")
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
 @app.get("/test")
 async def test_webhook():
     """测试微信机器人"""
-    return send_test_message()
+    return await asyncio.get_running_loop().run_in_executor(None, send_test_message)
 
 @app.on_event("startup")
 async def startup_event():
+    loop = asyncio.get_running_loop()
+
     async def keep_alive():
         while True:
             try:
-                # 只保持服务活跃，不执行检查
+                # 只保持服务活跃，不执行检查；请求放到线程中，不阻塞事件循环
                 if os.getenv('VERCEL_URL'):
-                    requests.get(f"https://{os.getenv('VERCEL_URL')}")
+                    await loop.run_in_executor(None, partial(
+                        requests.get, f"https://{os.getenv('VERCEL_URL')}", timeout=NETWORK_TIMEOUT
+                    ))
             except Exception as e:
                 logger.error(f"keep-alive请求失败: {str(e)}")
             
             await asyncio.sleep(60)  # 每分钟ping一次
     
     # 创建keep-alive任务
-    asyncio.create_task(keep_alive()) 
+    asyncio.create_task(keep_alive())
+
+    async def renew_leases():
+        try:
+            accounts = [account.account_key for account in config_manager.current().accounts.values()]
+            await loop.run_in_executor(None, lease_manager.heartbeat, accounts)
+        except Exception as e:
+            logger.error(f"续约邮箱租约失败: {str(e)}")
+
+    async def lease_keeper():
+        # 定期续约，进程增减或邮箱配置变化时重新分配
+        while True:
+            await asyncio.sleep(LEASE_TTL / 3)
+            await renew_leases()
+
+    if SHARDING:
+        # 先登记心跳再重新投递发件箱，避免本进程的通知被其他进程当作无主通知接管
+        await renew_leases()
+        asyncio.create_task(lease_keeper())
+
+    async def outbox_drainer():
+        # 启动时重新投递上次未发完的通知，之后定期重试失败的通知
+        while True:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, webhook_sender.replay)
+            except Exception as e:
+                logger.error(f"重新投递发件箱通知失败: {str(e)}")
+            await asyncio.sleep(min(OUTBOX_RETRY_INTERVAL, DIGEST_INTERVAL))
+
+    webhook_sender.start_async()
+    asyncio.create_task(outbox_drainer())
+
+    if SCHEDULER:
+        poll_scheduler.start()
+
+    if IMAP_IDLE or EWS_NOTIFY in ('streaming', 'pull'):
+        start_idle_watchers(asyncio.get_running_loop())
+
+    # kill -HUP 立即重新加载配置，另外定期检查配置文件是否修改
+    try:
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(reload_config(force=True)))
+    except (AttributeError, NotImplementedError, RuntimeError):
+        pass  # Windows没有SIGHUP；不在主线程中运行时也无法注册
+
+    async def config_watcher():
+        while True:
+            await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+            try:
+                await reload_config()
+            except Exception as e:
+                logger.error(f"重新加载配置失败: {str(e)}")
+
+    if CONFIG_RELOAD_INTERVAL > 0:
+        asyncio.create_task(config_watcher())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for watcher in idle_watchers.values():
+        watcher.stop()
+    # 尽量把队列中的通知发完再退出，之后释放租约，未发完的通知由其他进程接管
+    await asyncio.get_running_loop().run_in_executor(None, webhook_sender.drain, 10)
+    await asyncio.get_running_loop().run_in_executor(None, lease_manager.release)
+    imap_pool.close_all()
+    async_imap_pool.close_all()
+    ews_pool.close_all()
+    if webhook_sender.client is not None:
+        await webhook_sender.client.aclose()
 
 @app.get("/")
 async def root():
@@ -535,9 +3927,10 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "/": "服务信息",
-            "/wake": "触发邮件检查（定时任务使用）",
+            "/wake": "唤醒服务（内置调度关闭时触发邮件检查）",
             "/check": "手动触发检查（需要API密钥）",
             "/status": "查看服务状态",
+            "/metrics": "Prometheus监控指标",
             "/test": "测试微信机器人连接"
         },
         "last_check": service_status["last_check_time"],
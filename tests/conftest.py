@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# main在导入时就按环境变量创建发件箱、去重索引等全局对象，先把状态库指向临时目录
+STATE_DIR = tempfile.mkdtemp(prefix='mail-forwarder-tests-')
+os.environ['STATE_DB'] = os.path.join(STATE_DIR, 'state.db')
+os.environ['PROVIDERS_CONFIG'] = os.path.join(STATE_DIR, 'providers.toml')
+os.environ['SCHEDULER'] = 'false'
+os.environ['CONFIG_RELOAD_INTERVAL'] = '0'
+for name in ('WEIXIN_WEBHOOK', 'WECOM_WEBHOOKS', 'DINGTALK_WEBHOOKS', 'FEISHU_WEBHOOKS', 'PUSHME_KEYS'):
+    os.environ.pop(name, None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,225 @@
+import asyncio
+import imaplib
+import threading
+
+import pytest
+
+import main
+
+
+class FakeIMAP:
+    """按UID脚本化的IMAP连接，只实现检查流程用到的UID SEARCH/FETCH/STORE"""
+    uidvalidity = 1
+
+    def __init__(self, tag, count):
+        self.tag = tag
+        self.uids = list(range(1, count + 1))
+        self.broken = set()  # 取这些邮件的邮件头时连接断开
+
+    @staticmethod
+    def parse_set(spec):
+        uids = []
+        for part in spec.split(','):
+            start, _, end = part.partition(':')
+            uids.extend(range(int(start), int(end or start) + 1))
+        return uids
+
+    def uid(self, command, *args):
+        if command == 'SEARCH':
+            if args[1] == 'UID *':
+                return 'OK', [str(self.uids[-1]).encode()]
+            # 首次同步按时间窗口搜索，这里返回全部邮件
+            start = int(args[1].split()[1].split(':')[0]) if args[1].startswith('UID ') else 0
+            return 'OK', [' '.join(str(uid) for uid in self.uids if uid >= start).encode()]
+        if command == 'STORE':
+            return 'OK', []
+        uids = self.parse_set(args[0])
+        if 'BODYSTRUCTURE' in args[1]:
+            if self.broken & set(uids):
+                raise imaplib.IMAP4.abort("连接被服务器关闭")
+            data = []
+            for uid in uids:
+                header = f"From: a@example.com\r\nSubject: mail {uid}\r\nMessage-ID: <{self.tag}-{uid}@x>\r\n\r\n".encode()
+                data.append((f'{uid} (UID {uid} BODY[HEADER.FIELDS (FROM)] {{{len(header)}}}'.encode(), header))
+                data.append(b' BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 5 1))')
+            return 'OK', data
+        data = []
+        for uid in uids:
+            data.append((f'{uid} (UID {uid} BODY[1]<0> {{5}}'.encode(), b'hello'))
+            data.append(b')')
+        return 'OK', data
+
+
+@pytest.fixture
+def results():
+    return {}  # {UID: queue_notification的返回值}，默认入队成功
+
+
+@pytest.fixture
+def queued(monkeypatch, results):
+    queued = []
+
+    def queue_notification(monitor, subject, sender, content, received_at, ack=None, rule=None):
+        result = results.get(ack, True)
+        if result:
+            queued.append(ack)
+        return result
+
+    monkeypatch.setattr(main, 'queue_notification', queue_notification)
+    monkeypatch.setattr(main.webhook_sender, 'wait_for_room', lambda count, timeout: True)
+    monkeypatch.setattr(main, 'FETCH_BATCH_SIZE', 2)
+    return queued
+
+
+def run_check(monitor, imap):
+    monitor.imap = imap
+    monitor.last_error = None
+    return monitor.run_steps(monitor.check_steps())
+
+
+def test_failed_check_saves_progress_and_does_not_resend(queued):
+    monitor = main.EmailMonitor('retry@example.com', 'pw', main.Provider('test', 'imap.test'))
+    main.checkpoint_store.save_uid(monitor.account_key, FakeIMAP.uidvalidity, 0)
+    imap = FakeIMAP('retry', 4)
+    imap.broken = {3}
+    assert run_check(monitor, imap) == 2
+    assert monitor.last_error is not None
+    # 出错前已经入队的邮件也推进了同步位置
+    assert main.checkpoint_store.get(monitor.account_key)['last_uid'] == 2
+
+    imap.broken = set()
+    assert run_check(monitor, imap) == 2
+    assert monitor.last_error is None
+    assert queued == [1, 2, 3, 4]
+    assert main.checkpoint_store.get(monitor.account_key)['last_uid'] == 4
+
+    # 同步位置丢失后重新处理，同一个邮箱已经入队的邮件也由去重跳过
+    main.checkpoint_store.save_uid(monitor.account_key, FakeIMAP.uidvalidity, 0)
+    assert run_check(monitor, imap) == 0
+    assert queued == [1, 2, 3, 4]
+
+
+def test_undeliverable_mail_is_skipped_not_retried(queued, results):
+    monitor = main.EmailMonitor('skip@example.com', 'pw', main.Provider('test', 'imap.test'))
+    main.checkpoint_store.save_uid(monitor.account_key, FakeIMAP.uidvalidity, 0)
+    results[2] = None
+    assert run_check(monitor, FakeIMAP('skip', 4)) == 3
+    # 没有通知渠道的邮件跳过并报错，后面的邮件照常转发，同步位置照常推进
+    assert monitor.last_error is not None
+    assert queued == [1, 3, 4]
+    assert main.checkpoint_store.get(monitor.account_key)['last_uid'] == 4
+
+
+def test_transient_failure_stops_incremental_sync(queued, results):
+    monitor = main.EmailMonitor('stop@example.com', 'pw', main.Provider('test', 'imap.test'))
+    main.checkpoint_store.save_uid(monitor.account_key, FakeIMAP.uidvalidity, 0)
+    imap = FakeIMAP('stop', 4)
+    results[1] = False
+    assert run_check(monitor, imap) == 1
+    # 同步位置停在没能入队的邮件之前，下一批不再处理；同一批里已经入队的邮件下次由去重跳过
+    assert monitor.last_error is not None
+    assert main.checkpoint_store.get(monitor.account_key)['last_uid'] == 0
+    del results[1]
+    assert run_check(monitor, imap) == 3
+    assert queued == [2, 1, 3, 4]
+    assert main.checkpoint_store.get(monitor.account_key)['last_uid'] == 4
+
+
+def test_transient_failure_during_first_sync_retries_first_sync(queued, results):
+    monitor = main.EmailMonitor('first@example.com', 'pw', main.Provider('test', 'imap.test'))
+    imap = FakeIMAP('first', 4)
+    results[1] = False
+    # 首次同步不中断，其余邮件照常转发，但不保存基线
+    assert run_check(monitor, imap) == 3
+    assert monitor.last_error is not None
+    assert main.checkpoint_store.get(monitor.account_key) is None
+    del results[1]
+    assert run_check(monitor, imap) == 1
+    assert queued == [2, 3, 4, 1]
+    assert main.checkpoint_store.get(monitor.account_key)['last_uid'] == 4
+
+
+class AsyncFakeIMAP:
+    def __init__(self, imap):
+        self.imap = imap
+        self.uidvalidity = imap.uidvalidity
+
+    async def uid(self, *args):
+        return self.imap.uid(*args)
+
+
+def test_async_check_runs_sqlite_calls_off_the_event_loop(queued, monkeypatch):
+    monitor = main.EmailMonitor('async@example.com', 'pw', main.Provider('test', 'imap.test'))
+    main.checkpoint_store.save_uid(monitor.account_key, FakeIMAP.uidvalidity, 0)
+    on_loop = []
+
+    def record(function):
+        def wrapper(*args):
+            on_loop.append((function.__name__, threading.current_thread() is threading.main_thread()))
+            return function(*args)
+        return wrapper
+
+    for target, name in ((main.dedup_index, 'claim'), (main.checkpoint_store, 'get'), (main.checkpoint_store, 'save_uid')):
+        monkeypatch.setattr(target, name, record(getattr(target, name)))
+    monitor.imap = AsyncFakeIMAP(FakeIMAP('async', 3))
+    assert asyncio.run(monitor.run_steps_async(monitor.check_steps())) == 3
+    assert {name for name, _ in on_loop} == {'claim', 'get', 'save_uid'}
+    # 写SQLite的调用都在线程池中执行，不阻塞事件循环
+    assert not any(loop for _, loop in on_loop)
+
+
+def test_queued_check_rechecks_lease_after_lock(monkeypatch):
+    monkeypatch.setattr(main.lease_manager, 'enabled', True)
+    monkeypatch.setattr(main.lease_manager, 'owned', {})
+    monitor = main.EmailMonitor('lease@example.com', 'pw', main.Provider('test', 'imap.test'))
+    key = monitor.account_key
+    main.lease_manager.owned[key] = main.time.time() + 60
+    started, gate, calls = threading.Event(), threading.Event(), []
+
+    def check_emails():
+        calls.append(key)
+        started.set()
+        gate.wait(5)
+        return 0
+
+    monitor.check_emails = check_emails
+
+    async def run():
+        first = asyncio.create_task(main.check_account(monitor))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        second = asyncio.create_task(main.check_account(monitor))
+        await asyncio.sleep(0.01)
+        # 两次检查都在计数中，先结束的一次不会让另一次失去租约保护
+        assert main.lease_manager.checking[key] == 2
+        del main.lease_manager.owned[key]
+        gate.set()
+        return await asyncio.gather(first, second)
+
+    first, second = asyncio.run(run())
+    assert first["status"] == "成功"
+    # 等锁期间租约已经交出，排队的检查不再进行
+    assert second is None and calls == [key]
+    assert key not in main.lease_manager.checking
+
+
+def test_reloaded_account_waits_for_running_check(tmp_path):
+    path = tmp_path / 'providers.toml'
+    path.write_text('[[accounts]]\nprovider = "gmail"\nemail = "reload@example.com"\npassword = "old"\n', encoding='utf-8')
+    manager = main.ConfigManager(str(path))
+    account = next(iter(manager.current().accounts.values()))
+    old = manager.monitor(account)
+
+    async def run():
+        await old.lock.acquire()
+        # 检查进行中修改了密码，新的监控对象要等旧的检查结束
+        path.write_text(path.read_text(encoding='utf-8').replace('"old"', '"new"'), encoding='utf-8')
+        added, removed = manager.reload(force=True)
+        assert [a.key for a in added] == [account.key] and [a.key for a in removed] == [account.key]
+        new = manager.monitor(added[0])
+        assert new is not old and new.password == 'new'
+        assert new.lock is old.lock and new.lock.locked()
+        old.lock.release()
+
+    asyncio.run(run())
+    assert not manager.locks
@@ -0,0 +1,135 @@
+import json
+
+import pytest
+
+import main
+
+MESSAGE = {
+    "source": "📧 Gmail", "account": "me@example.com", "time": "2026-01-01 08:00:00",
+    "sender": "Alice <a@example.com>", "subject": "主题 {x}", "content": "第一行\n\"引号\"",
+    "provider": "gmail", "received_at": 1767225600.0
+}
+
+
+def make_notification(index, text=None, digest=False):
+    message = dict(MESSAGE, subject=f"邮件{index}")
+    if digest:
+        message["digest"] = True
+    return main.Notification(index, index, message, text if text is not None else f"通知{index}")
+
+
+def test_text_template_fills_fixed_and_dynamic_fields():
+    template = main.TextTemplate("{source}|{account}|{subject}|{missing_brace}}}", source="S", account="A")
+    assert template.fields == ["subject", "missing_brace"]
+    assert template.render({"subject": "{x}", "missing_brace": 1}) == "S|A|{x}|1}"
+
+
+def test_notifier_templates_are_shared_by_format():
+    first, second = main.WeComNotifier("http://a"), main.DingTalkNotifier("http://b")
+    assert first.template(MESSAGE) is second.template(MESSAGE)
+    text = first.render(MESSAGE)
+    assert text.startswith("📧 Gmail邮件通知\n\n📬 收件邮箱: me@example.com\n")
+    assert "📑 主题: 主题 {x}" in text and text.endswith("第一行\n\"引号\"")
+
+
+def test_templates_of_removed_accounts_are_dropped():
+    main.WeComNotifier("http://a").render(MESSAGE)
+    account = main.AccountConfig(main.Provider('gmail', 'imap.gmail.com', icon="📧 Gmail"), "me@example.com", "pw")
+    assert any(key[2] == "me@example.com" for key in main.Notifier.templates)
+    main.Notifier.forget_templates([account])
+    assert not any(key[2] == "me@example.com" for key in main.Notifier.templates)
+
+
+def test_json_template_encodes_only_fields():
+    template = main.JSONTemplate({"a": main.json_field("body"), "b": [1, "固定"], "c": main.json_field("title")})
+    data = template.render(body='换行\n"引号"\x00', title=None)
+    assert json.loads(data) == {"a": '换行\n"引号"\x00', "b": [1, "固定"], "c": None}
+    assert "固定".encode("utf-8") in data
+
+
+@pytest.mark.parametrize("cls", [main.WeComNotifier, main.DingTalkNotifier, main.FeishuNotifier, main.PushMeNotifier])
+def test_build_request_is_valid_json(cls):
+    notifier = cls("https://example.com/hook?x=1", "secret")
+    url, data = notifier.build_request("正文", "标题")
+    payload = json.loads(data)
+    assert url.startswith("https://example.com/hook?x=1")
+    assert "正文" in json.dumps(payload, ensure_ascii=False)
+    if cls is main.FeishuNotifier:
+        assert payload["timestamp"] and payload["sign"]
+    if cls is main.DingTalkNotifier:
+        assert "&timestamp=" in url and "&sign=" in url
+
+
+def test_token_bucket_stays_within_platform_quota(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    channel = main.WebhookChannel(main.WeComNotifier("http://a"))
+    assert channel.capacity == 5
+    # 一直有通知排队时按令牌桶发送，第一分钟内不能超过企业微信每分钟20条的配额
+    sent = 0
+    while clock[0] < 1059.5:
+        wait = channel.wait_time()
+        if wait:
+            clock[0] += wait
+            continue
+        channel.tokens -= 1
+        sent += 1
+    assert 19 <= sent <= 20
+
+
+def test_webhook_settings_per_platform_and_url(monkeypatch):
+    monkeypatch.setenv("WECOM_WEBHOOKS", "http://a,http://b")
+    monkeypatch.setenv("FEISHU_WEBHOOKS", "http://c")
+    webhooks = main.get_webhook_settings({
+        "webhooks": {"wecom": {"rate_limit": 10}, "http://b": {"burst": 3, "max_bytes": 1000}}
+    })
+    notifiers = {notifier.url: notifier for notifier in main.create_notifiers(webhooks)}
+    assert (notifiers["http://a"].rate_limit, notifiers["http://a"].burst, notifiers["http://a"].max_bytes) == (10, 5, 2048)
+    assert (notifiers["http://b"].rate_limit, notifiers["http://b"].burst, notifiers["http://b"].max_bytes) == (10, 3, 1000)
+    # 没有设置的平台不受影响
+    assert notifiers["http://c"].rate_limit == 100
+    with pytest.raises(ValueError):
+        main.get_webhook_settings({"webhooks": {"wecom": {"rate": 10}}})
+
+
+def test_channel_configure_keeps_pending():
+    channel = main.WebhookChannel(main.WeComNotifier("http://a"))
+    channel.pending.append(make_notification(1))
+    channel.configure(main.WeComNotifier("http://a", settings={"rate_limit": 10, "burst": 2}))
+    assert channel.capacity == 2 and channel.rate == pytest.approx(8 / 60)
+    assert len(channel.pending) == 1
+
+
+def test_take_batch_coalesces_within_max_bytes():
+    notifier = main.WeComNotifier("http://a")
+    notifier.max_bytes = 200
+    channel = main.WebhookChannel(notifier)
+    channel.digest = True
+    channel.tokens = 0
+    channel.pending.extend(make_notification(i, "x" * 40) for i in range(10))
+    sent = []
+    while channel.pending:
+        batch, body, title = channel.take_batch()
+        assert len(body.encode("utf-8")) <= notifier.max_bytes
+        assert body == notifier.render_digest([n.text for n in batch])
+        sent.extend(n.entry_id for n in batch)
+    assert sent == list(range(10))
+
+
+def test_take_batch_sends_single_when_tokens_available():
+    channel = main.WebhookChannel(main.WeComNotifier("http://a"))
+    channel.pending.extend([make_notification(1), make_notification(2)])
+    batch, body, title = channel.take_batch()
+    assert [n.entry_id for n in batch] == [1] and body == "通知1"
+
+
+def test_digest_notifications_are_not_mixed_with_normal_ones():
+    channel = main.WebhookChannel(main.WeComNotifier("http://a"))
+    channel.tokens = 0
+    channel.pending.extend([make_notification(1, "", digest=True), make_notification(2, "", digest=True),
+                            make_notification(3)])
+    batch, body, title = channel.take_batch()
+    assert [n.entry_id for n in batch] == [1, 2]
+    assert "定时摘要" in body and "邮件1" in body and "邮件2" in body
+    batch, body, title = channel.take_batch()
+    assert [n.entry_id for n in batch] == [3]
@@ -0,0 +1,125 @@
+import asyncio
+import base64
+
+import main
+
+NESTED_STRUCTURE = (
+    b'1 (UID 42 BODYSTRUCTURE ((('
+    b'"TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "BASE64" 120 2)('
+    b'"TEXT" "HTML" ("CHARSET" "gbk") NIL NIL "QUOTED-PRINTABLE" 300 5) "ALTERNATIVE")('
+    b'"APPLICATION" "PDF" ("NAME" "a.pdf") NIL NIL "BASE64" 5000 NIL ("ATTACHMENT" ("FILENAME" "a.pdf")) NIL)'
+    b' "MIXED") RFC822.SIZE 6012)'
+)
+
+
+def test_fetch_tokens_literal_and_quoted():
+    data = [(b'1 (UID 7 BODY[HEADER] {9}', b'abc\r\ndef\r'), b' FLAGS ("a \\"b\\"" NIL))']
+    tokens = list(main.fetch_tokens(data))
+    assert tokens == [
+        ('value', '1'), ('(', None), ('value', 'UID'), ('value', '7'), ('value', 'BODY[HEADER]'),
+        ('value', b'abc\r\ndef\r'), ('value', 'FLAGS'), ('(', None), ('value', 'a "b"'), ('value', None),
+        (')', None), (')', None)
+    ]
+
+
+def test_parse_fetch_response_multiple_messages_with_literals():
+    data = [
+        (b'1 (UID 10 BODY[HEADER.FIELDS (FROM SUBJECT)] {24}', b'From: a@b\r\nSubject: x\r\n'),
+        b' RFC822.SIZE 100)',
+        (b'2 (UID 11 BODY[HEADER.FIELDS (FROM SUBJECT)] {3}', b')(\r'),
+        b')',
+        None,
+    ]
+    result = main.parse_fetch_response(data)
+    assert set(result) == {10, 11}
+    assert main.fetch_item(result[10], 'BODY[HEADER') == b'From: a@b\r\nSubject: x\r\n'
+    assert result[10]['RFC822.SIZE'] == '100'
+    # 字面量里的括号不影响结构
+    assert main.fetch_item(result[11], 'BODY[HEADER') == b')(\r'
+
+
+def test_parse_fetch_response_truncated():
+    result = main.parse_fetch_response([b'1 (UID 5 FLAGS (\\Seen'])
+    assert result[5]['FLAGS'] == ['\\Seen']
+
+
+def test_find_text_part_nested_bodystructure():
+    fields = main.parse_fetch_response([NESTED_STRUCTURE])[42]
+    structure = fields['BODYSTRUCTURE']
+    assert list(main.text_part_candidates(structure)) == [
+        ('1.1', 'plain', 'BASE64', 'utf-8'),
+        ('1.2', 'html', 'QUOTED-PRINTABLE', 'gbk'),
+    ]
+    assert main.find_text_part(structure) == ('1.1', 'plain', 'BASE64', 'utf-8')
+
+
+def test_find_text_part_html_only_skips_text_attachment():
+    line = (
+        b'1 (UID 3 BODYSTRUCTURE (('
+        b'"TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 10 1 NIL ("ATTACHMENT" ("FILENAME" "a.txt")) NIL)('
+        b'"TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "7BIT" 30 1) "MIXED"))'
+    )
+    structure = main.parse_fetch_response([line])[3]['BODYSTRUCTURE']
+    assert main.find_text_part(structure) == ('2', 'html', '7BIT', 'utf-8')
+
+
+def test_find_text_part_single_part_and_none():
+    structure = main.parse_fetch_response([b'1 (UID 1 BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1))'])[1]
+    assert main.find_text_part(structure['BODYSTRUCTURE'])[:2] == ('1', 'plain')
+    assert main.find_text_part(None) is None
+
+
+def test_decode_part_truncated_base64_and_gbk():
+    encoded = base64.encodebytes('你好，世界'.encode('utf-8'))
+    # 截断在base64分组中间，也只解码完整的部分
+    assert main.decode_part(encoded[:10], 'base64', 'utf-8').startswith('你好')
+    assert main.decode_part('中文'.encode('gb18030'), '8bit', 'gb2312') == '中文'
+    assert main.decode_part(b'caf=C3=A9', 'quoted-printable', 'utf-8') == 'café'
+    assert main.decode_part(b'abc', '7bit', 'no-such-charset') == 'abc'
+
+
+def test_html_to_text():
+    html = '<style>p{}</style><p>Hello&nbsp;<b>world</b></p><br><div>second   line</div><script>x()</script>'
+    assert main.html_to_text(html) == 'Hello world\nsecond line'
+
+
+def test_uid_set():
+    assert main.uid_set([7, 1, 3, 2]) == '1:3,7'
+    assert main.uid_set([5]) == '5'
+    assert main.uid_set([]) == ''
+
+
+def test_chunked_by_size():
+    sizes = [(1, 40), (2, 40), (3, 40), (4, 200), (5, 10)]
+    assert list(main.chunked_by_size(sizes, 100)) == [[1, 2], [3], [4], [5]]
+    assert list(main.chunked_by_size([], 100)) == []
+
+
+def read_async_response(chunks):
+    async def run():
+        reader = asyncio.StreamReader()
+        for chunk in chunks:
+            reader.feed_data(chunk)
+        reader.feed_eof()
+        return await main.AsyncIMAP(reader, None).read_response()
+    return asyncio.run(run())
+
+
+def test_async_imap_read_response_literals():
+    items = read_async_response([
+        b'* 1 FETCH (UID 9 BODY[1] {5}\r\nab\r\nc',
+        b' BODY[2] {2}\r\nxy)\r\n',
+        b'A1 OK done\r\n'
+    ])
+    assert items == [
+        (b'* 1 FETCH (UID 9 BODY[1] {5}', b'ab\r\nc'),
+        (b' BODY[2] {2}', b'xy'),
+        b')'
+    ]
+    # 与imaplib的返回格式相同，可以直接交给parse_fetch_response
+    fields = main.parse_fetch_response(items)[9]
+    assert fields['BODY[1]'] == b'ab\r\nc' and fields['BODY[2]'] == b'xy'
+
+
+def test_async_imap_read_response_plain_line():
+    assert read_async_response([b'* SEARCH 1 2 3\r\n']) == [b'* SEARCH 1 2 3']
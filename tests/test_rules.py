@@ -0,0 +1,56 @@
+import pytest
+
+import main
+
+
+def test_rule_set_routes_by_sender_domain_and_subject():
+    rules = main.RuleSet([
+        {"name": "drop-news", "from": ["news.example.com"], "action": "drop"},
+        {"name": "weekly", "subject": "(?i)weekly", "action": "digest"},
+        {"name": "boss", "from": ["boss@corp.com"], "subject": "urgent|紧急", "action": "route", "targets": ["wecom"]},
+    ])
+    # 带(?i)的正则不能合并，逐条匹配
+    assert rules.subject_filter is None
+    assert rules.match("N <x@mail.news.example.com>", "me", "Sale", {}).name == "drop-news"
+    assert rules.match("a@b.com", "me", "My WEEKLY report", {}).name == "weekly"
+    assert rules.match("Boss <BOSS@corp.com>", "me", "紧急: 上线", {}).name == "boss"
+    assert rules.match("Boss <boss@corp.com>", "me", "hello", {}) is None
+    assert rules.match("other@corp.com", "me", "urgent", {}) is None
+
+
+def test_rule_set_combined_filter_and_backreference():
+    rules = main.RuleSet([{"name": "a", "subject": "foo", "action": "drop"}, {"name": "b", "subject": "ba[rz]", "action": "drop"}])
+    assert rules.subject_filter is not None
+    assert rules.match("x@y", "me", "a baz", {}).name == "b"
+    backref = main.RuleSet([{"name": "a", "subject": "x", "action": "drop"}, {"name": "b", "subject": r"(o)\1", "action": "drop"}])
+    assert backref.subject_filter is None
+    assert backref.match("x@y", "me", "foo", {}).name == "b"
+    assert backref.match("x@y", "me", "fo", {}) is None
+
+
+def test_rule_set_list_and_size_conditions():
+    rules = main.RuleSet([{"name": "big-list", "list": True, "min_size": 1000, "action": "drop"}])
+    assert rules.header_fields and rules.needs_size
+    assert rules.match("x@y", "me", "s", {"list-id": "<l.example.com>"}, 5000).name == "big-list"
+    assert rules.match("x@y", "me", "s", {"precedence": "bulk"}, 500) is None
+    assert rules.match("x@y", "me", "s", {}, 5000) is None
+
+
+def test_invalid_rule_raises():
+    with pytest.raises(ValueError):
+        main.RuleSet([{"action": "route"}])
+
+
+def test_unknown_targets_are_reported_when_config_loads(monkeypatch, tmp_path, caplog):
+    monkeypatch.setenv('WECOM_WEBHOOKS', 'https://qyapi.weixin.qq.com/a')
+    path = tmp_path / 'providers.toml'
+    path.write_text(
+        '[[rules]]\nname = "typo"\nsubject = "x"\naction = "route"\ntargets = ["dingtak"]\n'
+        '[[rules]]\nname = "ok"\nsubject = "y"\naction = "route"\ntargets = ["wecom"]\n',
+        encoding='utf-8'
+    )
+    snapshot = main.ConfigManager(str(path)).current()
+    assert len(snapshot.rules.rules) == 2
+    errors = [record.getMessage() for record in caplog.records if record.levelname == 'ERROR']
+    assert any('typo' in message and 'dingtak' in message for message in errors)
+    assert not any('规则ok' in message for message in errors)
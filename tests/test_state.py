@@ -0,0 +1,153 @@
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return main.Outbox(os.path.join(tmp_path, 'outbox.db'))
+
+
+def notification_for(outbox, entry_id, account='acct', ack='ack'):
+    entry = next(row for row in outbox.pending(set()) if row[0] == entry_id)
+    entry_id, group_id, url, message, account, ack, description = entry
+    return main.Notification(entry_id, group_id, message, "", account, ack, description)
+
+
+def test_dedup_claim_and_forget():
+    index = main.DedupIndex(3600, 100)
+    assert index.claim('id:1')
+    # 同一个邮箱重新处理时也算重复，已经入队的邮件不会再发一次
+    assert not index.claim('id:1')
+    index.forget('id:1')
+    assert index.claim('id:1')
+
+
+def test_dedup_expired_entry_can_be_claimed(monkeypatch):
+    index = main.DedupIndex(10, 100)
+    now = [1000.0]
+    monkeypatch.setattr(main.time, 'time', lambda: now[0])
+    assert index.claim('id:1')
+    now[0] += 11
+    assert index.claim('id:1')
+
+
+def test_dedup_spilled_entries_still_count(tmp_path):
+    path = os.path.join(tmp_path, 'dedup.db')
+    index = main.DedupIndex(3600, 1, path)
+    assert index.claim('id:1')
+    assert index.claim('id:2')
+    assert 'id:1' not in index.entries
+    assert not index.claim('id:1')
+    assert not main.DedupIndex(3600, 1, path).claim('id:1')
+
+
+def test_dedup_shared_between_processes(tmp_path):
+    path = os.path.join(tmp_path, 'dedup.db')
+    first, second = main.DedupIndex(3600, 100, path, True), main.DedupIndex(3600, 100, path, True)
+    assert first.claim('id:1')
+    assert not second.claim('id:1')
+    first.forget('id:1')
+    second.entries.clear()
+    assert second.claim('id:1')
+
+
+def test_outbox_group_completes_after_all_channels(outbox):
+    main.pop_delivered('acct')
+    group_id, entry_ids = outbox.add(['http://a', 'http://b'], {"subject": "s"}, 'acct', 'uid-1', 'test')
+    assert outbox.flush(5)
+    outbox.remove(notification_for(outbox, entry_ids[0]))
+    assert outbox.flush(5)
+    assert main.pop_delivered('acct') == []
+    outbox.remove(notification_for(outbox, entry_ids[1]))
+    assert outbox.flush(5)
+    assert main.pop_delivered('acct') == ['uid-1']
+    assert outbox.count() == 0
+
+
+def test_outbox_give_up_completes_group(outbox, monkeypatch):
+    monkeypatch.setattr(main, 'OUTBOX_MAX_ATTEMPTS', 2)
+    main.pop_delivered('acct')
+    group_id, entry_ids = outbox.add(['http://a', 'http://b'], {"subject": "s"}, 'acct', 'uid-2', 'test')
+    assert outbox.flush(5)
+    outbox.remove(notification_for(outbox, entry_ids[0]))
+    failed = notification_for(outbox, entry_ids[1])
+    outbox.fail(failed)
+    assert outbox.flush(5)
+    assert main.pop_delivered('acct') == [] and outbox.count() == 1
+    outbox.fail(failed)
+    assert outbox.flush(5)
+    # 放弃的渠道也算处理完，整组照常标记已读
+    assert main.pop_delivered('acct') == ['uid-2']
+    assert outbox.count() == 0
+
+
+def test_outbox_write_failure_is_retried(outbox, monkeypatch):
+    monkeypatch.setattr(main, 'OUTBOX_RETRY_DELAY', 0.05)
+    broken = [True]
+    apply_operations = outbox.apply_operations
+
+    def flaky(operations, completed):
+        if broken[0]:
+            raise main.sqlite3.OperationalError("disk I/O error")
+        apply_operations(operations, completed)
+
+    monkeypatch.setattr(outbox, 'apply_operations', flaky)
+    outbox.add(['http://a'], {"subject": "s"}, 'acct', 'uid-3', 'test')
+    # 写入失败时flush不能返回成功，否则邮箱检查会保存同步位置
+    assert not outbox.flush(0.3)
+    assert outbox.count() == 0
+    broken[0] = False
+    assert outbox.flush(5)
+    assert outbox.count() == 1
+
+
+def test_outbox_pending_skips_settling_entries(outbox, monkeypatch):
+    group_id, entry_ids = outbox.add(['http://a', 'http://b'], {"subject": "s"}, 'acct', None, 'test')
+    assert outbox.flush(5)
+    monkeypatch.setattr(main, 'OUTBOX_COMMIT_DELAY', 0.3)
+    outbox.remove(notification_for(outbox, entry_ids[0]))
+    # 删除还没落盘时replay也不能把已送达的通知再放入队列
+    assert [row[0] for row in outbox.pending(set())] == [entry_ids[1]]
+    assert outbox.flush(5)
+    assert [row[0] for row in outbox.pending(set())] == [entry_ids[1]]
+    assert not outbox.settling
+
+
+def test_submit_defers_channels_when_queue_is_full(outbox, monkeypatch):
+    monkeypatch.setattr(main, 'ACCOUNT_TIMEOUT', 0.05)
+    sender = main.WebhookSender(1, 1, outbox)
+    sender.channels = {
+        url: main.WebhookChannel(main.WeComNotifier(url)) for url in ('http://a', 'http://b')
+    }
+    sender.workers = [None]  # 不启动发送线程，通知留在内存队列中
+    deferred = sender.stats["deferred"]
+    message = {
+        "source": "S", "account": "me", "time": "t", "sender": "x", "subject": "s", "content": "c"
+    }
+    assert sender.submit(message, 'acct', 'uid-4', 'test')
+    assert sender.stats["deferred"] == deferred + 1
+    assert outbox.flush(5)
+    entries = outbox.pending(set())
+    assert len(entries) == 2
+    # 没有空位的渠道不在途，留给replay投递而不是丢掉
+    assert len(sender.in_flight) == 1
+    assert [row[2] for row in outbox.pending(sender.in_flight)] == ['http://b']
+
+
+def test_submit_routes_unknown_targets_to_all_channels(outbox):
+    sender = main.WebhookSender(1, 10, outbox)
+    sender.channels = {url: main.WebhookChannel(main.WeComNotifier(url)) for url in ('http://a', 'http://b')}
+    sender.workers = [None]
+    unrouted = sender.stats["unrouted"]
+    message = {"source": "S", "account": "me", "time": "t", "sender": "x", "subject": "s", "content": "c"}
+    # 规则指定的渠道写错或没有配置时不能让邮件卡住
+    assert sender.submit(message, 'acct', 'uid-5', 'test', {'feishu'})
+    assert sender.stats["unrouted"] == unrouted + 1
+    assert sorted(channel.notifier.url for channel in sender.channels.values() if channel.pending) == [
+        'http://a', 'http://b'
+    ]
+    sender.channels = {}
+    assert sender.submit(message, 'acct', 'uid-6', 'test') is None